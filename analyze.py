@@ -0,0 +1,6 @@
+import sys
+
+from mapy import cli
+
+if __name__ == '__main__':
+    sys.exit(cli.main())
@@ -0,0 +1,89 @@
+"""
+Benchmark of the gzip compression of dynamic responses.
+
+Renders result pages and JSON API responses for mails of the synthetic corpus and compresses
+them with different gzip levels. Reports the bandwidth saved, the CPU time of the compression
+and the transfer time over a slow link, e.g. a VPN, with and without compression.
+
+Run it from the root directory of the project:
+
+    python -m benchmarks.compression --bandwidth 10
+"""
+import argparse
+import gzip
+import statistics
+import tempfile
+import time
+import warnings
+
+from benchmarks.corpus import generate_corpus
+from mapy.app import create_app
+
+SCENARIOS = ('hops-10', 'hops-100', 'hops-500', 'exotic-dates', 'large-html', 'large-attachment')
+
+
+def render_responses(scenarios: tuple) -> dict:
+    """
+    Render the uncompressed responses of the app.
+
+    :param scenarios: Names of the corpus scenarios
+
+    :return: A dictionary of 'page/scenario' and 'api/scenario' -> response body
+    """
+    app = create_app({
+        'SECRET_KEY': 'benchmark',
+        'GEOLOCATION_CACHE_PATH': None,
+        'GEOLOCATION_HTTP_FALLBACK': False,
+        'ATTACHMENT_SPOOL_DIR': tempfile.mkdtemp(),
+        'RESULT_SPOOL_DIR': tempfile.mkdtemp(),
+        'WTF_CSRF_ENABLED': False,
+        'COMPRESS_LEVEL': 0,
+    })
+    client = app.test_client()
+
+    responses = {}
+    for scenario, mails in generate_corpus(mails=1, scenarios=list(scenarios)).items():
+        responses[f'page/{scenario}'] = client.post('/', data={'headers': mails[0]}).data
+        responses[f'api/{scenario}'] = client.post('/api/analyze', json={'messages': mails, 'geolocate': False}).data
+    return responses
+
+
+def measure(data: bytes, level: int, repeat: int) -> tuple:
+    """
+    Compress data like the app does.
+
+    :return: The compressed size and the median time in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        compressed = gzip.compress(data, compresslevel=level, mtime=0)
+        times.append(time.perf_counter() - start)
+    return len(compressed), statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the gzip compression of dynamic responses")
+    parser.add_argument("-l", "--levels", default="1,6,9", help="Compression levels to compare (default: 1,6,9)")
+    parser.add_argument("-b", "--bandwidth", default=10, type=float,
+                        help="Bandwidth of the link in Mbit/s for the transfer times (default: 10)")
+    parser.add_argument("-r", "--repeat", default=5, type=int, help="Compressions per response (default: 5)")
+    args = parser.parse_args()
+    levels = [int(level) for level in args.levels.split(',')]
+
+    # dateutil warns about the time zone names of the exotic dates
+    warnings.simplefilter('ignore')
+
+    bytes_per_second = args.bandwidth * 1000 * 1000 / 8
+    print(f"{'response':<28} {'level':>5} {'size':>10} {'gzip':>10} {'saved':>6} {'cpu':>9}  "
+          f"transfer at {args.bandwidth:g} Mbit/s")
+    for name, data in render_responses(SCENARIOS).items():
+        for level in levels:
+            size, seconds = measure(data, level, args.repeat)
+            print(f"{name:<28} {level:>5} {len(data):>10} {size:>10} {1 - size / len(data):>6.0%} "
+                  f"{seconds * 1000:>6.2f} ms  {len(data) / bytes_per_second * 1000:8.1f} ms -> "
+                  f"{(size / bytes_per_second + seconds) * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Deterministic generator for a synthetic corpus of emails.
+
+The same seed always produces the same mails, byte for byte, so benchmark results of
+different runs and machines can be compared. The corpus covers the inputs which are
+expensive to analyze: long chains of Received hops, exotic date formats, deeply nested
+multipart trees, large HTML bodies and large attachments.
+
+Print a sample mail of a scenario:
+
+    python -m benchmarks.corpus hops-10
+"""
+import argparse
+import base64
+import random
+
+from datetime import datetime, timedelta, timezone
+
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+ZONES = [(0, 'UTC'), (2, 'CEST'), (-7, 'PDT'), (-4, 'EDT'), (9, 'JST')]
+
+# Date formats seen in Received headers with an explicit UTC offset, the later ones need the fuzzy parser
+DATE_FORMATS = [
+    lambda t, z: f"{WEEKDAYS[t.weekday()]}, {t.day} {MONTHS[t.month - 1]} {t.year} {t:%H:%M:%S} {z[0]:+03d}00",
+    lambda t, z: f"{WEEKDAYS[t.weekday()]}, {t.day:02} {MONTHS[t.month - 1]} {t.year} {t:%H:%M:%S} "
+                 f"{z[0]:+03d}00 ({z[1]})",
+    lambda t, z: f"{t.day} {MONTHS[t.month - 1]} {t.year} {t:%H:%M:%S}.{t.microsecond:06d} {z[0]:+03d}00",
+    lambda t, z: f"{t:%Y-%m-%d %H:%M:%S} {z[0]:+03d}00",
+    lambda t, z: f"{t:%Y-%m-%dT%H:%M:%S}{z[0]:+03d}:00",
+]
+
+# Formats without a usable offset, they parse to naive datetimes and are only used for parse_date
+NAIVE_DATE_FORMATS = [
+    lambda t, z: f"{WEEKDAYS[t.weekday()]} {MONTHS[t.month - 1]} {t.day} {t:%H:%M:%S} {t.year}",
+    lambda t, z: f"{WEEKDAYS[t.weekday()]},  {t.day} {MONTHS[t.month - 1]} {t:%y} {t:%H:%M:%S} {z[1]}",
+]
+
+WORDS = ('account', 'verify', 'offer', 'update', 'password', 'invoice', 'shipping', 'security',
+         'team', 'your', 'the', 'and', 'now', 'today', 'limited', 'click', 'here', 'free')
+
+# Scenario name -> keyword arguments for generate_mail
+SCENARIOS = {
+    'hops-1': {'hops': 1},
+    'hops-10': {'hops': 10},
+    'hops-100': {'hops': 100},
+    'hops-500': {'hops': 500},
+    'exotic-dates': {'hops': 20, 'exotic_dates': True},
+    'deep-multipart': {'hops': 5, 'multipart_depth': 25},
+    'large-html': {'hops': 5, 'html_size': 2 * 1024 * 1024},
+    'large-attachment': {'hops': 5, 'attachment_size': 5 * 1024 * 1024},
+}
+
+
+def format_date(rng: random.Random, moment: datetime, formats: list) -> str:
+    offset, name = rng.choice(ZONES)
+    local = moment.astimezone(timezone(timedelta(hours=offset)))
+    return rng.choice(formats)(local, (offset, name))
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def received_headers(rng: random.Random, hops: int, sent: datetime, exotic_dates: bool) -> list:
+    """Generate a chain of Received headers, the newest first like in a real mail."""
+    headers = []
+    formats = DATE_FORMATS if exotic_dates else DATE_FORMATS[:2]
+    moment = sent
+    previous = f'sender{rng.randrange(1000)}.example.org'
+    for hop in range(hops):
+        moment += timedelta(seconds=rng.choice([0, 1, 1, 2, 5, 30, 300]))
+        host = f'mx{hop}.relay{rng.randrange(100)}.example.net'
+        ip = f'{rng.randrange(1, 224)}.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(1, 255)}'
+        headers.append(
+            f"Received: from {previous} ({previous} [{ip}])\n"
+            f"    by {host} with {rng.choice(['ESMTPS', 'ESMTP', 'SMTP', 'LMTP'])} id {rng.getrandbits(48):x}\n"
+            f"    for <user@example.com>; {format_date(rng, moment, formats)}"
+        )
+        previous = host
+    return headers[::-1]
+
+
+def html_body(rng: random.Random, size: int) -> str:
+    parts = ['<html><head><title>Newsletter</title><style>td { font-family: Arial; }</style></head><body>']
+    length = len(parts[0])
+    while length < size:
+        part = (
+            f'<table width="600"><tr><td style="padding:12px;color:#333">'
+            f'<h2>{sentence(rng, 4)}</h2><p>{sentence(rng, 40)} &amp; {sentence(rng, 10)}</p>'
+            f'<a href="https://click.example.com/?u={rng.getrandbits(64):x}">{sentence(rng, 3)}</a>'
+            f'</td></tr></table>\n'
+        )
+        parts.append(part)
+        length += len(part)
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def multipart(rng: random.Random, depth: int, html_size: int, attachment_size: int) -> str:
+    """Build a MIME body, nested depth levels deep, with a text and an HTML part at the bottom."""
+    boundary = f'b{depth}-{rng.getrandbits(32):x}'
+    parts = [
+        f"Content-Type: text/plain; charset=utf-8\n\n{sentence(rng, 60)}\n",
+        f"Content-Type: text/html; charset=utf-8\n\n{html_body(rng, html_size)}\n",
+    ]
+    if depth > 1:
+        parts = [multipart(rng, depth - 1, html_size, 0)]
+    if attachment_size:
+        data = base64.encodebytes(rng.randbytes(attachment_size)).decode()
+        parts.append(
+            'Content-Type: application/octet-stream\n'
+            'Content-Disposition: attachment; filename="report.bin"\n'
+            f'Content-Transfer-Encoding: base64\n\n{data}'
+        )
+    body = ''.join(f'--{boundary}\n{part}' for part in parts)
+    return f'Content-Type: multipart/mixed; boundary="{boundary}"\n\n{body}--{boundary}--\n'
+
+
+def generate_mail(rng: random.Random, hops: int = 5, exotic_dates: bool = False, multipart_depth: int = 1,
+                  html_size: int = 4096, attachment_size: int = 0) -> str:
+    """
+    Generate a single email.
+
+    :param rng: The random generator, seeded by the caller
+    :param hops: Number of Received headers
+    :param exotic_dates: Whether the dates of the hops use unusual formats
+    :param multipart_depth: Nesting depth of the multipart tree
+    :param html_size: Approximate size of the HTML body in bytes
+    :param attachment_size: Size of a binary attachment in bytes, 0 for none
+
+    :return: The raw email
+    """
+    sent = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+    headers = received_headers(rng, hops, sent, exotic_dates) + [
+        f"Date: {format_date(rng, sent, DATE_FORMATS[:2])}",
+        f"From: {sentence(rng, 2).title()} <sender@example.org>",
+        "To: user@example.com",
+        f"Subject: {sentence(rng, 6)}",
+        f"Message-ID: <{rng.getrandbits(64):x}@example.org>",
+        "MIME-Version: 1.0",
+        "Authentication-Results: mx.example.com; spf=pass smtp.mailfrom=example.org",
+        f"X-Mailer: Generator {rng.randrange(10)}",
+    ]
+    return '\n'.join(headers) + '\n' + multipart(rng, multipart_depth, html_size, attachment_size)
+
+
+def generate_corpus(seed: int = 42, mails: int = 3, scenarios: list = None) -> dict:
+    """
+    Generate the corpus.
+
+    :param seed: Seed for the random generator
+    :param mails: Number of mails per scenario
+    :param scenarios: Names of the scenarios to generate (default: all)
+
+    :return: A dictionary of scenario name -> list of raw emails
+    """
+    corpus = {}
+    for name in scenarios or SCENARIOS:
+        # Every scenario has its own generator, so selecting scenarios doesn't change the mails
+        rng = random.Random(f'{seed}-{name}')
+        corpus[name] = [generate_mail(rng, **SCENARIOS[name]) for _ in range(mails)]
+    return corpus
+
+
+def generate_dates(seed: int = 42, count: int = 2000) -> list:
+    """
+    Generate date strings in all supported formats, like they appear in Received headers.
+
+    :param seed: Seed for the random generator
+    :param count: Number of date strings
+
+    :return: A list of date strings
+    """
+    rng = random.Random(f'{seed}-dates')
+    start = datetime(2015, 1, 1, tzinfo=timezone.utc)
+    formats = DATE_FORMATS + NAIVE_DATE_FORMATS
+    return [format_date(rng, start + timedelta(seconds=rng.randrange(10 * 365 * 24 * 3600)), formats)
+            for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenario', choices=list(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    print(generate_corpus(args.seed, 1, [args.scenario])[args.scenario][0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark for the HTML to text extraction of message bodies.
+
+Compares the streaming extract_text_from_html with the BeautifulSoup tree it replaced, on
+generated samples which look like the large HTML mails seen in practice: a table-heavy
+newsletter and a phishing page with inlined scripts, styles and images. Reports the time
+and the peak of allocated memory (tracemalloc) of both, with the default size limit of
+the streaming extractor and without it.
+
+Run it from the root directory of the project (BeautifulSoup is optional):
+
+    python -m benchmarks.html_text
+"""
+import argparse
+import base64
+import random
+import time
+import tracemalloc
+
+from mapy.utils import extract_text_from_html
+
+WORDS = ('account', 'verify', 'offer', 'update', 'password', 'newsletter', 'click', 'here', 'free',
+         'shipping', 'security', 'invoice', 'team', 'your', 'the', 'and', 'now', 'today', 'limited')
+
+
+def sentence(rng: random.Random, n: int = 12) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def newsletter(size: int, rng: random.Random) -> str:
+    """Nested layout tables with inline styles, tracking links and entities, like a marketing mail."""
+    parts = ['<!DOCTYPE html><html><head><title>Weekly deals</title>'
+             '<style>td { font-family: Arial; } .btn { color: #fff; }</style></head><body>']
+    length = sum(len(part) for part in parts)
+    while length < size:
+        part = (
+            '<table width="600" cellpadding="0" cellspacing="0" style="border:0;margin:0 auto">'
+            '<tr><td style="padding:12px 24px;font-size:14px;line-height:20px;color:#333333">'
+            f'<h2 style="margin:0">{sentence(rng, 4).title()}</h2>'
+            f'<p style="margin:8px 0">{sentence(rng, 40)} &amp; {sentence(rng, 20)}&nbsp;&euro;9.99</p>'
+            f'<a class="btn" href="https://click.example.com/?u={rng.getrandbits(64):x}">'
+            f'<span style="display:inline-block;padding:6px">{sentence(rng, 3)}</span></a>'
+            '</td></tr></table>\n'
+        )
+        parts.append(part)
+        length += len(part)
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def phishing_kit(size: int, rng: random.Random) -> str:
+    """A login page with large inlined scripts, styles and base64 images around a little text."""
+    image = base64.b64encode(rng.randbytes(48 * 1024)).decode()
+    script = 'var _0x' + ';var _0x'.join(f'{i:x}=["{rng.getrandbits(128):x}"]' for i in range(2000))
+    parts = ['<html><head><title>Sign in to your account</title>']
+    length = 0
+    while length < size:
+        part = (
+            f'<style>.c{rng.getrandbits(32):x} {{ background: url(data:image/png;base64,{image[:4096]}); }}</style>'
+            f'<script>{script}</script>'
+            f'<div class="panel"><img src="data:image/png;base64,{image}" alt="logo">'
+            f'<form action="https://evil.example.net/{rng.getrandbits(32):x}" method="post">'
+            f'<label>{sentence(rng, 6)}</label><input type="password" name="p"></form>'
+            f'<p>{sentence(rng, 25)}</p></div>\n'
+        )
+        parts.append(part)
+        length += len(part)
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def extract_with_beautifulsoup(html: str) -> str:
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(html, 'html.parser').get_text()
+
+
+def measure(func, html: str) -> tuple:
+    # Timed without tracing, tracemalloc slows down allocations considerably
+    start = time.perf_counter()
+    text = func(html)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(html)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, len(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=float, default=5, help="Size of the samples in MB")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    try:
+        import bs4  # noqa: F401
+    except ImportError:
+        print("BeautifulSoup is not installed, only the streaming extractor is measured\n")
+        bs4 = None
+
+    candidates = {
+        'streaming': extract_text_from_html,
+        'unlimited': lambda html: extract_text_from_html(html, max_chars=len(html)),
+    }
+    if bs4:
+        candidates['BeautifulSoup'] = extract_with_beautifulsoup
+
+    size = int(args.size * 1024 * 1024)
+    samples = {
+        'newsletter': newsletter(size, random.Random(args.seed)),
+        'phishing kit': phishing_kit(size, random.Random(args.seed)),
+    }
+
+    print(f"{'sample':<14} {'extractor':<14} {'time s':>8} {'peak MB':>9} {'text chars':>11}")
+    for name, html in samples.items():
+        for label, func in candidates.items():
+            elapsed, peak, length = measure(func, html)
+            print(f"{name:<14} {label:<14} {elapsed:>8.2f} {peak / 1024 / 1024:>9.1f} {length:>11}")
+
+
+if __name__ == '__main__':
+    main()
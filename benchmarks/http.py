@@ -0,0 +1,114 @@
+"""
+Load test for a running instance of the app, reporting requests per second and latencies.
+
+Start the app first, e.g. with the production settings:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Then run the benchmark from the root directory of the project:
+
+    python -m benchmarks.http --url http://127.0.0.1:8080 --clients 16 --duration 30
+
+By default every request sends a slightly different mail, so the result cache doesn't
+answer them. Use --cached to measure cache hits instead.
+"""
+import argparse
+import itertools
+import re
+import statistics
+import threading
+import time
+
+import requests
+
+MAIL = """Received: from client.example.com (client.example.com [198.51.100.1])
+    by mail.example.com with ESMTPS id j0siq34k2i; Fri, 23 Jul 2024 10:21:35 -0700 (PDT)
+Received: from sender.example.org (sender.example.org [203.0.113.2])
+    by client.example.com with SMTP id abc; Fri, 23 Jul 2024 10:20:35 -0700 (PDT)
+From: sender@example.org
+To: recipient@example.com
+Subject: Benchmark {n}
+Date: Fri, 23 Jul 2024 10:20:30 -0700
+Content-Type: text/plain
+
+This is the body of the email."""
+
+CSRF_TOKEN = re.compile(r'name="csrf_token"\s*value="([^"]+)"')
+
+
+class Client(threading.Thread):
+    """
+    Sends requests over a single keep-alive connection until the deadline.
+    """
+
+    def __init__(self, url: str, endpoint: str, deadline: float, cached: bool, counter):
+        super().__init__(daemon=True)
+        self.url = url.rstrip('/')
+        self.endpoint = endpoint
+        self.deadline = deadline
+        self.cached = cached
+        self.counter = counter
+        self.session = requests.Session()
+        self.latencies = []
+        self.errors = 0
+
+    def request(self):
+        mail = MAIL.format(n=0 if self.cached else next(self.counter))
+        if self.endpoint == 'api':
+            return self.session.post(f'{self.url}/api/analyze', json={'messages': [mail], 'geolocate': False})
+        if self.endpoint == 'page':
+            return self.session.post(f'{self.url}/', data={'headers': mail, 'csrf_token': self.csrf_token})
+        return self.session.get(f'{self.url}/')
+
+    def run(self):
+        if self.endpoint == 'page':
+            self.csrf_token = CSRF_TOKEN.search(self.session.get(f'{self.url}/').text).group(1)
+
+        while time.perf_counter() < self.deadline:
+            start = time.perf_counter()
+            try:
+                ok = self.request().status_code == 200
+            except requests.RequestException:
+                ok = False
+            if ok:
+                self.latencies.append(time.perf_counter() - start)
+            else:
+                self.errors += 1
+
+
+def percentile(values: list, p: float) -> float:
+    return statistics.quantiles(values, n=100)[p - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:8080', help="Base URL of the app")
+    parser.add_argument('--endpoint', choices=['page', 'api', 'index'], default='page',
+                        help="Submit mails through the form (page), the JSON API (api) or just load the form (index)")
+    parser.add_argument('--clients', type=int, default=16, help="Number of concurrent clients")
+    parser.add_argument('--duration', type=float, default=10, help="Duration of the test in seconds")
+    parser.add_argument('--cached', action='store_true', help="Send the same mail every time")
+    args = parser.parse_args()
+
+    counter = itertools.count(1)  # next() on a count is atomic, the clients can share it
+
+    start = time.perf_counter()
+    clients = [Client(args.url, args.endpoint, start + args.duration, args.cached, counter)
+               for _ in range(args.clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    errors = sum(client.errors for client in clients)
+    print(f"{len(latencies)} requests, {errors} errors in {elapsed:.1f} s with {args.clients} clients")
+    if latencies:
+        print(f"{len(latencies) / elapsed:.1f} requests/s")
+        print("latency ms: p50 {:.1f}  p95 {:.1f}  p99 {:.1f}  max {:.1f}".format(
+            *(1000 * percentile(latencies, p) for p in (50, 95, 99)), 1000 * latencies[-1]))
+
+
+if __name__ == '__main__':
+    main()
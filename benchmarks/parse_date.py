@@ -0,0 +1,90 @@
+"""
+Benchmark for the date parsing of Received headers.
+
+Compares the fuzzy dateutil parsing with the RFC 5322 fast path and the memoized
+parse_date on a corpus of realistic Received timestamps, where the same timestamps
+repeat across hops and mails like they do in bulk runs.
+
+Run it from the root directory of the project:
+
+    python -m benchmarks.parse_date
+"""
+import argparse
+import random
+import time
+
+from mapy.utils import parse_date, parse_date_fuzzy, parse_rfc5322_date
+
+FORMATS = [
+    # The usual suspects, about 90% of all Received timestamps
+    ('{wd}, {d} {mon} {y} {H:02}:{M:02}:{S:02} {tz}', 30),
+    ('{wd}, {d} {mon} {y} {H:02}:{M:02}:{S:02} {tz} ({tzname})', 40),
+    ('{wd}, {d:02} {mon} {y} {H:02}:{M:02}:{S:02}.{f} {tz}', 10),
+    ('{d} {mon} {y} {H:02}:{M:02}:{S:02} GMT', 10),
+    # Exotic formats which need the fuzzy parser
+    ('{y}-{m:02}-{d:02} {H:02}:{M:02}:{S:02} {tz}', 5),
+    ('{wd} {mon} {d} {H:02}:{M:02}:{S:02} {y}', 5),
+]
+
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+TIMEZONES = [('+0000', 'UTC'), ('+0200', 'CEST'), ('-0700', 'PDT'), ('-0400', 'EDT'), ('+0530', 'IST')]
+
+
+def generate_dates(count: int, unique: int, seed: int = 42) -> list:
+    """
+    Generate a corpus of date strings.
+
+    :param count: Number of date strings
+    :param unique: Number of distinct date strings in the corpus
+    :param seed: Seed for the random generator, so runs are comparable
+
+    :return: A list of date strings
+    """
+    rnd = random.Random(seed)
+    formats, weights = zip(*FORMATS)
+    distinct = []
+    for _ in range(unique):
+        m = rnd.randint(1, 12)
+        tz, tzname = rnd.choice(TIMEZONES)
+        distinct.append(rnd.choices(formats, weights)[0].format(
+            wd=rnd.choice(WEEKDAYS), d=rnd.randint(1, 28), m=m, mon=MONTHS[m - 1], y=rnd.randint(2015, 2024),
+            H=rnd.randint(0, 23), M=rnd.randint(0, 59), S=rnd.randint(0, 59), f=rnd.randint(0, 999999),
+            tz=tz, tzname=tzname
+        ))
+    return [rnd.choice(distinct) for _ in range(count)]
+
+
+def measure(func, dates: list) -> float:
+    start = time.perf_counter()
+    for date in dates:
+        func(date)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the date parsing of Received headers")
+    parser.add_argument("-n", "--count", default=20000, type=int, help="Number of timestamps (default: 20000)")
+    parser.add_argument("-u", "--unique", default=2000, type=int, help="Number of distinct timestamps (default: 2000)")
+    args = parser.parse_args()
+
+    dates = generate_dates(args.count, args.unique)
+
+    # Make sure the fast path doesn't change any result
+    mismatches = [d for d in set(dates) if parse_rfc5322_date(d) not in (None, parse_date_fuzzy(d))]
+    assert not mismatches, f"Fast path disagrees with dateutil for {mismatches[:5]}"
+    fast_share = sum(parse_rfc5322_date(d) is not None for d in dates) / len(dates)
+
+    parse_date.cache_clear()
+    baseline = measure(parse_date_fuzzy, dates)
+    uncached = measure(parse_date.__wrapped__, dates)
+    cached = measure(parse_date, dates)
+
+    print(f"{len(dates)} timestamps, {args.unique} distinct, {fast_share:.0%} handled by the fast path")
+    print(f"{'dateutil fuzzy':<24}{baseline * 1000:>10.1f} ms")
+    print(f"{'fast path':<24}{uncached * 1000:>10.1f} ms  ({baseline / uncached:.1f}x)")
+    print(f"{'fast path + memoized':<24}{cached * 1000:>10.1f} ms  ({baseline / cached:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Worst-case benchmark for the tokenizing of Received headers.
+
+Feeds crafted Received headers of growing size to tokenize_received and to the regular
+expressions it replaced. When the input doubles, a linear algorithm takes about twice as
+long, the old expressions about four times as long.
+
+Run it from the root directory of the project:
+
+    python -m benchmarks.received
+"""
+import argparse
+import re
+import time
+
+from mapy.utils import tokenize_received
+
+# The expressions used before tokenize_received, kept here for comparison
+LEGACY_DIRECTION = re.compile(r"""
+    from\s+
+    (.*?)\s+
+    by\s+(.*?)
+    (?:
+        (?:with|via)
+        (.*?)
+        (?:\sid\s|$)
+        |\sid\s|$
+    )""", re.DOTALL | re.X)
+LEGACY_FALLBACK = re.compile(r'Received:\s*(.*?)\n\S+:\s+', re.X | re.DOTALL | re.I)
+
+INPUTS = {
+    'repeated from': lambda n: 'from ' * n,
+    'folded lines': lambda n: 'Received: x\n ' * n,
+    'nested comments': lambda n: 'from ' + '(' * n + 'by ' * n + ')' * n,
+    'many clauses': lambda n: 'from a by b with c id d for <e> ' * (n // 8) + '; Thu, 4 Jul 2024 10:42:48 +0200',
+}
+
+
+def measure(func, value: str, limit: float) -> float | None:
+    start = time.perf_counter()
+    func(value)
+    elapsed = time.perf_counter() - start
+    return elapsed if elapsed < limit else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Worst-case benchmark for Received header tokenizing")
+    parser.add_argument("-s", "--steps", default=6, type=int, help="Number of doublings (default: 6)")
+    parser.add_argument("-n", "--size", default=500, type=int, help="Initial number of words (default: 500)")
+    parser.add_argument("--legacy", action="store_true", help="Also run the old regular expressions")
+    args = parser.parse_args()
+
+    for name, make in INPUTS.items():
+        print(f"{name}:")
+        previous = None
+        for step in range(args.steps):
+            value = make(args.size * 2 ** step)
+            elapsed = measure(tokenize_received, value, float('inf'))
+            growth = f"{elapsed / previous:4.1f}x" if previous else "     "
+            line = f"  {len(value):>9} chars  tokenizer {elapsed * 1000:9.2f} ms {growth}"
+            if args.legacy:
+                legacy = LEGACY_FALLBACK if name == 'folded lines' else LEGACY_DIRECTION
+                legacy_elapsed = measure(legacy.findall, value, 30)
+                line += f"  regex {legacy_elapsed * 1000:9.2f} ms" if legacy_elapsed else "  regex > 30 s"
+            print(line)
+            previous = elapsed
+
+
+if __name__ == '__main__':
+    main()
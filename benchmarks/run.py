@@ -0,0 +1,167 @@
+"""
+Micro-benchmarks of the analysis steps on the synthetic corpus.
+
+Times parse_date, parse_received_headers, process_email_headers, extract_ip_addresses,
+extract_message_data and create_chart one by one on every scenario of benchmarks.corpus.
+The memoization caches are cleared before every call, so each call does the full work.
+Results can be saved as JSON and compared against a saved baseline, which fails the run
+when a benchmark got slower than the threshold.
+
+Run it from the root directory of the project:
+
+    python -m benchmarks.run --save baseline.json
+    python -m benchmarks.run --compare baseline.json
+"""
+import argparse
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+import warnings
+
+from datetime import datetime, timezone
+
+from benchmarks.corpus import SCENARIOS, generate_corpus, generate_dates
+from mapy.chart import render_horizontal_bar_chart
+from mapy.utils import (build_graph_data, calculate_total_delay, create_chart, extract_ip_addresses,
+                        extract_message_data, parse_date, parse_received_headers, process_email_headers)
+
+
+def clear_caches():
+    parse_date.cache_clear()
+    render_horizontal_bar_chart.cache_clear()
+
+
+def build_cases(seed: int, mails: int, dates: int) -> dict:
+    """
+    Build the benchmark cases.
+
+    :param seed: Seed of the corpus
+    :param mails: Number of mails per scenario
+    :param dates: Number of date strings for parse_date
+
+    :return: A dictionary of 'function/scenario' -> (function, list of argument tuples)
+    """
+    cases = {'parse_date/dates': (parse_date, [(date,) for date in generate_dates(seed, dates)])}
+    for scenario, corpus in generate_corpus(seed, mails).items():
+        charts = []
+        for mail in corpus:
+            data = process_email_headers(mail, render_chart=False)[0]
+            charts.append((build_graph_data(data), calculate_total_delay(data)))
+        cases.update({
+            f'parse_received_headers/{scenario}': (parse_received_headers, [(mail,) for mail in corpus]),
+            f'process_email_headers/{scenario}': (process_email_headers, [(mail,) for mail in corpus]),
+            f'extract_ip_addresses/{scenario}': (extract_ip_addresses, [(mail,) for mail in corpus]),
+            f'extract_message_data/{scenario}': (extract_message_data, [(mail,) for mail in corpus]),
+            f'create_chart/{scenario}': (create_chart, charts),
+        })
+    return cases
+
+
+def measure(func, calls: list, repeat: int) -> dict:
+    """
+    Time a function on a list of inputs.
+
+    :param func: The function to benchmark
+    :param calls: Argument tuples, the function is called once with each of them per round
+    :param repeat: Number of rounds
+
+    :return: Minimum and median time of a call in seconds
+    """
+    rounds = []
+    gc.collect()
+    gc.disable()  # Like timeit, so a collection triggered by earlier benchmarks doesn't count
+    try:
+        for _ in range(repeat):
+            elapsed = 0
+            for args in calls:
+                clear_caches()
+                start = time.perf_counter()
+                func(*args)
+                elapsed += time.perf_counter() - start
+            rounds.append(elapsed / len(calls))
+    finally:
+        gc.enable()
+    return {'min': min(rounds), 'median': statistics.median(rounds), 'calls': len(calls), 'rounds': repeat}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Print the results next to a baseline.
+
+    :param results: Results of this run
+    :param baseline: Results of an earlier run
+    :param threshold: Ratio of the new to the old minimum above which a benchmark counts as slower
+
+    :return: The names of the slower benchmarks
+    """
+    slower = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if old is None:
+            print(f"{name:<48} {result['min'] * 1000:10.3f} ms  (not in baseline)")
+            continue
+        ratio = result['min'] / old['min']
+        mark = ''
+        if ratio > threshold:
+            mark = '  SLOWER'
+            slower.append(name)
+        print(f"{name:<48} {old['min'] * 1000:10.3f} ms -> {result['min'] * 1000:10.3f} ms  {ratio:5.2f}x{mark}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the analysis steps on a synthetic corpus")
+    parser.add_argument("-r", "--repeat", default=5, type=int, help="Rounds per benchmark (default: 5)")
+    parser.add_argument("-m", "--mails", default=3, type=int, help="Mails per scenario (default: 3)")
+    parser.add_argument("-d", "--dates", default=2000, type=int, help="Date strings for parse_date (default: 2000)")
+    parser.add_argument("--seed", default=42, type=int, help="Seed of the corpus (default: 42)")
+    parser.add_argument("-k", "--filter", help="Only run benchmarks whose name contains this text")
+    parser.add_argument("--save", metavar="FILE", help="Save the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="Compare the results against a saved run")
+    parser.add_argument("--threshold", default=1.2, type=float,
+                        help="Slowdown ratio which fails the comparison (default: 1.2)")
+    args = parser.parse_args()
+
+    # dateutil warns about every unknown time zone name in the exotic formats
+    warnings.simplefilter('ignore')
+
+    cases = build_cases(args.seed, args.mails, args.dates)
+    results = {}
+    for name, (func, calls) in cases.items():
+        if args.filter and args.filter not in name:
+            continue
+        results[name] = measure(func, calls, args.repeat)
+        if not args.compare:
+            print(f"{name:<48} min {results[name]['min'] * 1000:10.3f} ms  "
+                  f"median {results[name]['median'] * 1000:10.3f} ms")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'meta': {
+                    'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'seed': args.seed,
+                    'mails': args.mails,
+                    'dates': args.dates,
+                    'scenarios': list(SCENARIOS),
+                },
+                'results': results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline['results'], args.threshold)
+        if slower:
+            print(f"{len(slower)} benchmark(s) slower than {args.threshold}x the baseline")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Startup benchmark: import time and resident memory of the app and of the analysis alone.
+
+Every measurement runs in a fresh interpreter, so nothing is cached between them. The
+baseline is an interpreter which imports nothing, the other rows show the additional cost.
+
+Run it from the root directory of the project:
+
+    python -m benchmarks.startup
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Code run in the fresh interpreter, {setup} is what's measured
+PROBE = """
+import time
+start = time.perf_counter()
+{setup}
+elapsed = time.perf_counter() - start
+
+import json, sys
+with open('/proc/self/status') as f:
+    rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+heavy = [m for m in ('dateutil', 'geoip2', 'requests', 'IPy') if m in sys.modules]
+print(json.dumps({{'seconds': elapsed, 'rss_kb': rss, 'heavy': heavy}}))
+"""
+
+TARGETS = {
+    'baseline': 'pass',
+    'import mapy.utils': 'import mapy.utils',
+    'import mapy.app': 'import mapy.app',
+    'create_app()': "from mapy.app import create_app; create_app({'GEOLOCATION_CACHE_PATH': None})",
+    'first analysis': (
+        "from mapy.utils import analyze_mail; "
+        "analyze_mail('Received: from a by b; Fri, 23 Jul 2024 10:21:35 -0700\\n\\n<p>x</p>', geolocate=False)"
+    ),
+}
+
+
+def measure(setup: str, runs: int) -> dict:
+    results = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(setup=setup)],
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output))
+    return {
+        'ms': 1000 * statistics.median(result['seconds'] for result in results),
+        'rss_mb': statistics.median(result['rss_kb'] for result in results) / 1024,
+        'heavy': results[0]['heavy'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per measurement (median is reported)")
+    args = parser.parse_args()
+
+    baseline = measure(TARGETS['baseline'], args.runs)
+    print(f"{'target':<20} {'time ms':>9} {'RSS MB':>8} {'+RSS MB':>8}  heavy modules loaded")
+    for name, setup in TARGETS.items():
+        result = baseline if name == 'baseline' else measure(setup, args.runs)
+        print(f"{name:<20} {result['ms']:>9.1f} {result['rss_mb']:>8.1f} "
+              f"{result['rss_mb'] - baseline['rss_mb']:>8.1f}  {', '.join(result['heavy']) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+Gunicorn settings for running MAPy in production:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+The app is loaded once in the master process and the workers are forked from it, so the
+GeoIP databases, templates and compiled patterns are shared between them. Most settings can
+be overridden with environment variables.
+"""
+import gc
+import multiprocessing
+import os
+
+bind = os.environ.get('MAPY_BIND', '0.0.0.0:8080')
+workers = int(os.environ.get('MAPY_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('MAPY_THREADS', 4))
+worker_class = 'gthread'
+timeout = int(os.environ.get('MAPY_TIMEOUT', 60))
+keepalive = 5
+
+# Load the app before forking the workers
+preload_app = True
+
+# Restart workers from time to time to bound the growth of caches and fragmentation
+max_requests = int(os.environ.get('MAPY_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+
+
+def pre_fork(server, worker):
+    # Objects loaded so far are never collected, so the garbage collector doesn't touch
+    # (and copy) their pages in the workers
+    gc.freeze()
@@ -0,0 +1,82 @@
+from flask import Blueprint, current_app, jsonify, request
+
+from mapy import metrics
+from mapy.utils import analyze_mail, extract_ip_addresses, serialize_analysis
+
+blueprint = Blueprint('api', __name__, url_prefix='/api')
+
+
+@blueprint.route('/analyze', methods=['POST'])
+def analyze():
+    """
+    Analyze a batch of raw emails and return machine-readable results. The request body is
+    JSON like {"messages": ["<raw mail>", ...], "geolocate": true}. Every message gets its own
+    entry in "results", either with the analysis or with an "error", so one bad mail doesn't
+    fail the whole batch.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('messages'), list):
+        return jsonify(error="Expected a JSON object with a list of raw emails in 'messages'"), 400
+
+    messages = payload['messages']
+    max_batch = current_app.config['API_MAX_BATCH']
+    if len(messages) > max_batch:
+        return jsonify(error=f"A batch can contain at most {max_batch} messages"), 413
+
+    geolocate = bool(payload.get('geolocate', True))
+    executor = current_app.extensions['analysis_executor']
+    cache = current_app.extensions['result_cache']
+    futures = [
+        executor.submit(analyze_item, index, mail_data, geolocate, cache, current_app.logger,
+                        current_app.extensions['metrics'])
+        for index, mail_data in enumerate(messages)
+    ]
+
+    return jsonify(results=[future.result() for future in futures])
+
+
+@blueprint.route('/stats')
+def stats():
+    """
+    Return the statistics of the result cache and of the geolocation cache of this worker process.
+    The geolocation cache is null when it's disabled.
+    """
+    geolocation_cache = current_app.extensions.get('geolocation_cache')
+    return jsonify(
+        result_cache=current_app.extensions['result_cache'].stats(),
+        geolocation_cache=geolocation_cache.stats() if geolocation_cache is not None else None
+    )
+
+
+def analyze_item(index: int, mail_data, geolocate: bool, cache, logger, registry=None) -> dict:
+    """
+    Analyze a single email of a batch. This runs on a worker thread without an app context.
+
+    :param index: Position of the email in the batch
+    :param mail_data: Raw email data
+    :param geolocate: Whether to look up the locations of the IP addresses
+    :param cache: The ResultCache for serialized analyses
+    :param logger: Logger for failed analyses
+    :param registry: Optional Metrics the stages of the analysis are added to. The worker thread
+                     doesn't share the context of the request, so they are collected here.
+
+    :return: The serialized analysis or a dictionary with an error message
+    """
+    if not isinstance(mail_data, str) or not mail_data.strip():
+        return {'index': index, 'error': "Expected a non-empty string"}
+
+    def analyze():
+        result = analyze_mail(mail_data, geolocate=geolocate, render_chart=False)
+        return serialize_analysis(result, extract_ip_addresses(mail_data))
+
+    try:
+        mail_data = mail_data.strip()
+        with metrics.collect() as timings:
+            result = cache.get_or_compute(cache.key(mail_data, 'api', geolocate), analyze)
+        return {'index': index, **result}
+    except Exception as e:
+        logger.exception("Analysis of message %d failed", index)
+        return {'index': index, 'error': f"Analysis failed: {e}"}
+    finally:
+        if registry is not None:
+            registry.observe(timings)
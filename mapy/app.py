@@ -1,36 +1,142 @@
+import importlib
 import logging
 import os
 import sys
+import time
+import tracemalloc
 
-from flask import Flask
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Flask, g, request
 from flask_wtf.csrf import CSRFProtect
 
-from mapy import routes
+from mapy import api, metrics, routes
+from mapy.cache import ResultCache
+from mapy.compression import compress_response
 from mapy.context_processors import register_context_processors
+from mapy.geocache import GeolocationCache
+from mapy.geolocation import HttpProvider, MaxMindProvider, get_country_reader, set_geolocation_providers
+from mapy.jobs import JobQueue
+from mapy.spool import AttachmentSpool
+from mapy.utils import analyze_mail
+
+PRELOAD_MAIL = """Received: from a.example.org (a.example.org [192.0.2.1])
+    by b.example.org with ESMTPS id 1; Fri, 23 Jul 2024 10:21:35 -0700 (PDT)
+From: sender@example.org
+Subject: Preload
+
+Preload"""
+
+# Dependencies the analysis imports on first use, preloading them shares them between all workers
+PRELOAD_MODULES = ('dateutil.parser', 'geoip2.database', 'geoip2.errors', 'IPy', 'requests', 'requests.adapters')
 
 
-def create_app():
+def create_app(test_config=None):
     """
     Create application factory, as explained here:
     http://flask.pocoo.org/docs/patterns/appfactories/.
+
+    The defaults below can be overridden with environment variables prefixed with 'MAPY_',
+    e.g. MAPY_GEOLOCATION_CACHE_TTL=3600.
+
+    :param test_config: Optional mapping which overrides the configuration (used by the tests)
     """
     app = Flask(__name__)
-    app.secret_key = os.urandom(24)
+
+    data_dir = os.path.join(app.root_path, 'static', 'data')
+    app.config.from_mapping(
+        # Signs sessions and CSRF tokens, all worker processes must share it (see configure_secret_key)
+        SECRET_KEY=None,
+        SECRET_KEY_FILE=None,
+        # Local MaxMind databases are preferred, the ASN database is optional
+        GEOLOCATION_CITY_DB=os.path.join(data_dir, 'GeoLite2-City.mmdb'),
+        GEOLOCATION_ASN_DB=os.path.join(data_dir, 'GeoLite2-ASN.mmdb'),
+        # Ask the ipapi.co web service for addresses the local databases don't know
+        GEOLOCATION_HTTP_FALLBACK=True,
+        # Set to an empty value to disable the geolocation cache
+        GEOLOCATION_CACHE_PATH=os.path.join(app.instance_path, 'geolocation.sqlite3'),
+        GEOLOCATION_CACHE_TTL=7 * 24 * 3600,
+        GEOLOCATION_CACHE_NEGATIVE_TTL=3600,
+        # Attachments are kept on disk for downloads, bounded in size and time
+        ATTACHMENT_SPOOL_DIR=os.path.join(app.instance_path, 'attachments'),
+        ATTACHMENT_SPOOL_MAX_BYTES=512 * 1024 * 1024,
+        ATTACHMENT_SPOOL_TTL=3600,
+        # Header tables and message bodies cut off on the result page are kept on disk for loading them
+        RESULT_SPOOL_DIR=os.path.join(app.instance_path, 'results'),
+        RESULT_SPOOL_MAX_BYTES=256 * 1024 * 1024,
+        RESULT_SPOOL_TTL=3600,
+        # Hops beyond this number are combined into a single bar in the delay chart
+        CHART_MAX_BARS=20,
+        # The result page shows this many rows per header table and characters per message body,
+        # the rest is loaded on demand
+        PAGE_HEADER_ROWS=50,
+        PAGE_MESSAGE_CHARS=20000,
+        # Batches of the JSON API are analyzed on a pool of worker threads
+        API_MAX_BATCH=100,
+        API_WORKERS=os.cpu_count() or 4,
+        # Results of identical mails are reused, the TTL must stay below ATTACHMENT_SPOOL_TTL
+        RESULT_CACHE_MAX_BYTES=64 * 1024 * 1024,
+        RESULT_CACHE_TTL=600,
+        # Analyze submissions in the background and stream the progress to the page
+        ASYNC_ANALYSIS=False,
+        JOB_WORKERS=4,
+        JOB_MAX_PENDING=32,
+        JOB_TTL=600,
+        JOB_MAX_FINISHED=100,
+        # Time the stages of every request for the Server-Timing header and the /metrics endpoint
+        METRICS_ENABLED=True,
+        # Account the peak and retained memory of every stage with tracemalloc, slows down the analysis
+        MEMORY_ACCOUNTING=False,
+        # Allow profiling single analyses with ?profile=pstats|stacks or the X-Mapy-Profile header
+        PROFILING_ENABLED=False,
+        PROFILE_DIR=os.path.join(app.instance_path, 'profiles'),
+        # HTML and JSON responses of at least COMPRESS_MIN_SIZE bytes are sent with gzip,
+        # level 1 is the fastest, 9 the smallest and 0 turns compression off
+        COMPRESS_LEVEL=6,
+        COMPRESS_MIN_SIZE=1024,
+    )
+    app.config.from_prefixed_env('MAPY')
+    if test_config:
+        app.config.from_mapping(test_config)
 
     csrf = CSRFProtect(app)
 
     register_blueprints(app)
 
+    # The JSON API is meant for machines, which don't have a CSRF token
+    csrf.exempt(api.blueprint)
+
     register_context_processors(app)
 
     configure_logger(app)
 
+    configure_secret_key(app)
+
+    configure_geolocation(app)
+
+    configure_attachment_spool(app)
+
+    app.extensions['result_cache'] = ResultCache(
+        max_bytes=app.config['RESULT_CACHE_MAX_BYTES'], ttl=app.config['RESULT_CACHE_TTL'])
+
+    app.extensions['job_queue'] = JobQueue(
+        max_workers=app.config['JOB_WORKERS'], max_pending=app.config['JOB_MAX_PENDING'],
+        ttl=app.config['JOB_TTL'], max_finished=app.config['JOB_MAX_FINISHED'])
+
+    app.extensions['analysis_executor'] = ThreadPoolExecutor(
+        max_workers=app.config['API_WORKERS'], thread_name_prefix='mapy-analysis')
+
+    configure_metrics(app)
+
+    configure_compression(app)
+
     return app
 
 
 def register_blueprints(app):
     """Register Flask blueprints."""
     app.register_blueprint(routes.blueprint)
+    app.register_blueprint(api.blueprint)
 
 
 def configure_logger(app):
@@ -38,3 +144,127 @@ def configure_logger(app):
     handler = logging.StreamHandler(sys.stdout)
     if not app.logger.handlers:
         app.logger.addHandler(handler)
+
+
+def configure_secret_key(app):
+    """
+    Configure the key which signs sessions and CSRF tokens. It's read from SECRET_KEY_FILE or
+    taken from SECRET_KEY (e.g. MAPY_SECRET_KEY). Without either, a random key is generated,
+    which is only shared by workers forked from the same preloaded app and lost on restarts.
+    """
+    if app.config['SECRET_KEY_FILE']:
+        with open(app.config['SECRET_KEY_FILE'], 'rb') as f:
+            app.config['SECRET_KEY'] = f.read().strip()
+
+    if not app.config['SECRET_KEY']:
+        app.config['SECRET_KEY'] = os.urandom(24)
+        if not app.testing:
+            app.logger.warning("No secret key configured, CSRF tokens break on restarts and between separate processes")
+
+
+def preload(app):
+    """
+    Load everything which is shared by all requests up front. Called before the server forks
+    its worker processes, the loaded data is then shared copy-on-write instead of being loaded
+    again by every worker.
+    """
+    get_country_reader()
+
+    for module in PRELOAD_MODULES:
+        importlib.import_module(module)
+
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        app.jinja_env.get_template(name)
+
+    # Warm the compiled patterns and lookup tables of the analysis with a small mail
+    analyze_mail(PRELOAD_MAIL, geolocate=False)
+
+
+def configure_geolocation(app):
+    """Configure the geolocation providers and the cache in front of the web service."""
+    providers = []
+
+    city_db = app.config['GEOLOCATION_CITY_DB']
+    asn_db = app.config['GEOLOCATION_ASN_DB']
+    if city_db and os.path.exists(city_db):
+        providers.append(MaxMindProvider(city_db, asn_db if asn_db and os.path.exists(asn_db) else None))
+    else:
+        app.logger.info("No local city database found, geolocation relies on the web service")
+
+    if app.config['GEOLOCATION_HTTP_FALLBACK']:
+        cache = None
+        if app.config['GEOLOCATION_CACHE_PATH']:
+            cache = GeolocationCache(
+                app.config['GEOLOCATION_CACHE_PATH'],
+                ttl=app.config['GEOLOCATION_CACHE_TTL'],
+                negative_ttl=app.config['GEOLOCATION_CACHE_NEGATIVE_TTL']
+            )
+        providers.append(HttpProvider(cache=cache))
+        app.extensions['geolocation_cache'] = cache
+
+    set_geolocation_providers(providers)
+
+
+def configure_metrics(app):
+    """
+    Time every request. The durations of the request and of the analysis stages it ran are sent
+    in the Server-Timing header and added to the histograms of the /metrics endpoint.
+    """
+    app.extensions['metrics'] = metrics.Metrics()
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    if app.config['MEMORY_ACCOUNTING'] and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+    @app.before_request
+    def start_timings():
+        g.timings, g.timings_token = metrics.start()
+
+    @app.after_request
+    def add_timings(response):
+        timings = g.pop('timings', None)
+        if timings is not None:
+            total = time.perf_counter() - timings.started
+            response.headers['Server-Timing'] = timings.server_timing(total)
+            app.extensions['metrics'].observe(timings, request.endpoint or 'unknown', total)
+            if timings.memory:
+                app.logger.info("Memory of %s %s: %s", request.method, request.path, '; '.join(
+                    f'{name} {timings.format_memory(name)}' for name in timings.memory))
+        return response
+
+    @app.teardown_request
+    def stop_timings(exc):
+        token = g.pop('timings_token', None)
+        if token is not None:
+            metrics.stop(token)
+
+
+def configure_compression(app):
+    """
+    Compress dynamic responses for clients which accept gzip. Registered after the metrics, so it
+    runs before their hook and the time it takes shows up as the 'compress' stage.
+    """
+    if not app.config['COMPRESS_LEVEL']:
+        return
+
+    @app.after_request
+    def compress(response):
+        return compress_response(request, response, app.config['COMPRESS_LEVEL'], app.config['COMPRESS_MIN_SIZE'])
+
+
+def configure_attachment_spool(app):
+    """
+    Configure the spools which keep attachments for downloads and the content which is cut off
+    on result pages. Both are on disk, so all worker processes share them.
+    """
+    app.extensions['attachment_spool'] = AttachmentSpool(
+        app.config['ATTACHMENT_SPOOL_DIR'],
+        max_bytes=app.config['ATTACHMENT_SPOOL_MAX_BYTES'],
+        ttl=app.config['ATTACHMENT_SPOOL_TTL']
+    )
+    app.extensions['result_spool'] = AttachmentSpool(
+        app.config['RESULT_SPOOL_DIR'],
+        max_bytes=app.config['RESULT_SPOOL_MAX_BYTES'],
+        ttl=app.config['RESULT_SPOOL_TTL']
+    )
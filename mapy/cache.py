@@ -0,0 +1,191 @@
+import hashlib
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def normalize_mail(mail_data: str) -> str:
+    """
+    Normalize raw mail data, so the same mail pasted from different clients gets the same key.
+
+    :param mail_data: Raw email data
+
+    :return: The mail with LF line endings and without surrounding whitespace
+    """
+    return mail_data.replace('\r\n', '\n').replace('\r', '\n').strip()
+
+
+def estimate_size(value, seen: set = None) -> int:
+    """
+    Estimate the memory used by a value and everything it contains.
+
+    :param value: Any object, containers are followed recursively
+    :param seen: Ids of objects which have already been counted
+
+    :return: The estimated size in bytes
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(k, seen) + estimate_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, seen) for item in value)
+    return size
+
+
+class ResultCache:
+    """
+    Memory-bounded LRU cache for analysis results, keyed by a hash of the normalized mail.
+
+    When the same mail is submitted again while it's still being analyzed, the second request
+    waits for the running analysis instead of starting another one. Failed analyses are not
+    cached. The cache lives in the memory of a single process, every server worker has its own.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: int = 600):
+        """
+        :param max_bytes: Upper bound for the estimated size of all cached results
+        :param ttl: Time in seconds a result is kept, it must be shorter than the time
+                    attachments stay in the spool, so cached download links keep working
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()  # key -> (expires, size, value)
+        self._in_flight = {}  # key -> Future
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(mail_data: str, *params) -> str:
+        """
+        Build the cache key of a mail.
+
+        :param mail_data: Raw email data
+        :param params: Further values the result depends on, e.g. whether IPs are geolocated
+
+        :return: The SHA-256 hex digest of the normalized mail and the parameters
+        """
+        digest = hashlib.sha256(normalize_mail(mail_data).encode('utf-8', errors='surrogatepass'))
+        digest.update(repr(params).encode())
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """
+        Get a cached result without computing it.
+
+        :param key: The cache key
+
+        :return: The cached result or None
+        """
+        with self._lock:
+            return self._lookup(key)
+
+    def _lookup(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, size, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            self.size -= size
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def get_or_compute(self, key: str, compute):
+        """
+        Get a cached result or compute it. Concurrent calls with the same key share one computation.
+
+        :param key: The cache key
+        :param compute: A callable without arguments which returns the result
+
+        :return: The result
+        """
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                self.hits += 1
+                return value
+
+            running = self._in_flight.get(key)
+            if running is not None:
+                self.coalesced += 1
+            else:
+                self.misses += 1
+                future = self._in_flight[key] = Future()
+
+        if running is not None:
+            return running.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            future.set_exception(e)
+            with self._lock:
+                del self._in_flight[key]
+            raise
+
+        with self._lock:
+            self._store(key, value)
+            del self._in_flight[key]
+        future.set_result(value)
+        return value
+
+    def put(self, key: str, value):
+        """
+        Store a result which was computed without get_or_compute, replacing a cached one.
+
+        :param key: The cache key
+        :param value: The result
+        """
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key: str, value):
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+
+        self._entries[key] = (time.monotonic() + self.ttl, size, value)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def clear(self):
+        """Remove all cached results."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        """
+        Get the counters of this cache.
+
+        :return: A dictionary like {'hits': 3, 'misses': 1, 'coalesced': 1, 'hit_rate': 0.8,
+                 'entries': 1, 'bytes': 51234}, where coalesced requests count as hits
+        """
+        with self._lock:
+            total = self.hits + self.coalesced + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': (self.hits + self.coalesced) / total if total else 0.0,
+                'entries': len(self._entries),
+                'bytes': self.size
+            }
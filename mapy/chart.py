@@ -0,0 +1,82 @@
+from functools import lru_cache
+from xml.sax.saxutils import escape, quoteattr
+
+# Same colors as the default pygal style used before
+COLORS = [
+    '#F44336', '#3F51B5', '#009688', '#FFC107', '#FF5722', '#9C27B0',
+    '#03A9F4', '#8BC34A', '#FF9800', '#E91E63', '#2196F3', '#4CAF50',
+    '#FFEB3B', '#673AB7', '#00BCD4', '#CDDC39', '#9E9E9E', '#607D8B'
+]
+
+WIDTH = 600
+LABEL_WIDTH = 220
+BAR_HEIGHT = 18
+BAR_GAP = 6
+TITLE_HEIGHT = 36
+AXIS_HEIGHT = 34
+MAX_LABEL_LENGTH = 32
+
+
+def downsample(bars: list, max_bars: int) -> list:
+    """
+    Reduce the number of bars for long hop chains. The bars with the largest values are kept
+    in their original order, all others are combined into a single bar at the end.
+
+    :param bars: A list of (label, value) pairs
+    :param max_bars: Maximum number of bars, values below 1 count as 1
+
+    :return: A list of at most max_bars (label, value) pairs
+    """
+    max_bars = max(max_bars, 1)
+    if len(bars) <= max_bars:
+        return bars
+
+    keep = sorted(range(len(bars)), key=lambda i: bars[i][1], reverse=True)[:max_bars - 1]
+    keep = set(keep)
+    kept = [bar for i, bar in enumerate(bars) if i in keep]
+    rest = [bar for i, bar in enumerate(bars) if i not in keep]
+    return kept + [(f'{len(rest)} other hops', sum(value for _, value in rest))]
+
+
+@lru_cache(maxsize=256)
+def render_horizontal_bar_chart(title: str, x_title: str, bars: tuple) -> str:
+    """
+    Render a horizontal bar chart as a self-contained SVG. Charts are memoized by their data,
+    since the same hop chains are analyzed again and again.
+
+    :param title: The title above the chart
+    :param x_title: The title below the x axis
+    :param bars: A tuple of (label, value) pairs
+
+    :return: The SVG markup as a string
+    """
+    height = TITLE_HEIGHT + len(bars) * (BAR_HEIGHT + BAR_GAP) + AXIS_HEIGHT
+    plot_width = WIDTH - LABEL_WIDTH - 60
+    maximum = max((value for _, value in bars), default=0) or 1
+
+    svg = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {WIDTH} {height}" '
+        f'width="100%" role="img" font-family="system-ui" font-size="12">',
+        f'<title>{escape(title)}</title>',
+        f'<text x="{WIDTH / 2}" y="22" text-anchor="middle" font-size="16">{escape(title)}</text>',
+    ]
+
+    for i, (label, value) in enumerate(bars):
+        y = TITLE_HEIGHT + i * (BAR_HEIGHT + BAR_GAP)
+        width = plot_width * value / maximum
+        short = label if len(label) <= MAX_LABEL_LENGTH else label[:MAX_LABEL_LENGTH - 1] + '…'
+        svg.append(
+            f'<g><title>{escape(label)}: {value}</title>'
+            f'<text x="{LABEL_WIDTH - 6}" y="{y + BAR_HEIGHT - 5}" text-anchor="end">{escape(short)}</text>'
+            f'<rect x="{LABEL_WIDTH}" y="{y}" width="{width:.1f}" height="{BAR_HEIGHT}" rx="3" '
+            f'fill={quoteattr(COLORS[i % len(COLORS)])} />'
+            f'<text x="{LABEL_WIDTH + width + 4:.1f}" y="{y + BAR_HEIGHT - 5}">{value}</text></g>'
+        )
+
+    axis_y = height - AXIS_HEIGHT + 4
+    svg.append(
+        f'<line x1="{LABEL_WIDTH}" y1="{axis_y}" x2="{LABEL_WIDTH + plot_width}" y2="{axis_y}" stroke="#999" />'
+        f'<text x="{LABEL_WIDTH + plot_width / 2}" y="{height - 8}" text-anchor="middle">{escape(x_title)}</text>'
+        '</svg>'
+    )
+    return ''.join(svg)
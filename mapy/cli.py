@@ -0,0 +1,360 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from mapy.geocache import GeolocationCache
+from mapy.geolocation import HttpProvider, MaxMindProvider, set_geolocation_providers
+from mapy.mbox import iter_messages, open_mbox, split_ranges
+from mapy.utils import analyze_mail, extract_ip_addresses, serialize_analysis
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'static', 'data')
+PROGRESS_INTERVAL = 2  # Seconds between two throughput reports
+MBOX_RANGE_SIZE = 4 * 1024 * 1024  # Approximate number of bytes of an mbox file per task
+FILE_BATCH_SIZE = 64  # Number of message files per task
+
+
+def is_maildir(path: str) -> bool:
+    """
+    Check if a directory is a Maildir, i.e. it has a 'cur' or 'new' subdirectory.
+
+    :param path: Path to a directory
+
+    :return: True if the directory is a Maildir
+    """
+    return os.path.isdir(os.path.join(path, 'cur')) or os.path.isdir(os.path.join(path, 'new'))
+
+
+def iter_maildir_tree(path: str):
+    """
+    Iterate over all message files in a directory tree of Maildirs, including Maildir++ subfolders.
+
+    :param path: Path to a directory
+
+    :return: A generator of paths of message files
+    """
+    for root, dirs, _ in os.walk(path):
+        dirs.sort()
+        if not is_maildir(root):
+            continue
+        for subdir in ('cur', 'new'):
+            directory = os.path.join(root, subdir)
+            if not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                file_path = os.path.join(directory, name)
+                if not name.startswith('.') and os.path.isfile(file_path):
+                    yield file_path
+
+
+def is_mbox(path: str) -> bool:
+    """
+    Check if a file is an mbox file, i.e. it starts with a 'From ' line.
+
+    :param path: Path to a file
+
+    :return: True if the file is an mbox file
+    """
+    with open(path, 'rb') as f:
+        return f.read(5) == b'From '
+
+
+def iter_tasks(paths: list, range_size: int = MBOX_RANGE_SIZE, batch_size: int = FILE_BATCH_SIZE):
+    """
+    Split the given mbox files, Maildirs and single message files into tasks for the workers.
+    mbox files are split into byte ranges, which the workers map and read themselves, so the
+    messages are never copied between processes. Message files are batched by their paths.
+
+    :param paths: A list of paths
+    :param range_size: Approximate size of the byte ranges of mbox files
+    :param batch_size: Number of message files per task
+
+    :return: A generator of ('mbox', path, start, end) and ('files', [path, ...]) tuples
+    """
+    batch = []
+    for path in paths:
+        if os.path.isdir(path):
+            files = iter_maildir_tree(path)
+        elif is_mbox(path):
+            with open_mbox(path) as mm:
+                ranges = split_ranges(mm, max(len(mm) // range_size, 1))
+            for start, end in ranges:
+                yield 'mbox', path, start, end
+            continue
+        else:
+            files = [path]
+
+        for file_path in files:
+            batch.append(file_path)
+            if len(batch) == batch_size:
+                yield 'files', batch
+                batch = []
+
+    if batch:
+        yield 'files', batch
+
+
+def iter_task_messages(task: tuple):
+    """
+    Iterate over the messages of a task.
+
+    :param task: A task from iter_tasks
+
+    :return: A generator of (message id, raw message) tuples. The id is '<mbox file>:<offset>'
+             or the path of the message file. The raw message of an mbox file is a memoryview,
+             which is released as soon as the next message is requested.
+    """
+    if task[0] == 'mbox':
+        _, path, start, end = task
+        with open_mbox(path) as mm:
+            for offset, view in iter_messages(mm, start, end):
+                try:
+                    yield f'{path}:{offset}', view
+                finally:
+                    view.release()
+    else:
+        for file_path in task[1]:
+            with open(file_path, 'rb') as f:
+                yield file_path, f.read()
+
+
+def read_processed_ids(output: str) -> set:
+    """
+    Read the ids of the messages which are already in an output file, to resume an aborted run.
+    A truncated last line (e.g. after the process was killed) is ignored.
+
+    :param output: Path to a JSONL output file
+
+    :return: A set of message ids
+    """
+    processed = set()
+    if not os.path.exists(output):
+        return processed
+
+    with open(output, encoding='utf-8') as f:
+        for line in f:
+            try:
+                processed.add(json.loads(line)['id'])
+            except (ValueError, KeyError, TypeError):
+                continue
+    return processed
+
+
+def drop_partial_line(output: str):
+    """
+    Remove a truncated last line from an output file, so appended lines start on a new line.
+
+    :param output: Path to a JSONL output file
+    """
+    if not os.path.exists(output):
+        return
+
+    with open(output, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        position = size
+        while position > 0:
+            start = max(position - 64 * 1024, 0)
+            f.seek(start)
+            block = f.read(position - start)
+            newline = block.rfind(b'\n')
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+        if position != size:
+            f.truncate(position)
+
+
+_geolocate = False
+_resume_ids = frozenset()
+
+
+def configure_worker(resume_ids: set = frozenset(), geolocation: tuple = None):
+    """
+    Configure a worker process.
+
+    :param resume_ids: Ids of messages which are skipped, because they have been analyzed before
+    :param geolocation: None to skip the geolocation or a tuple (city_db, asn_db, http_fallback,
+                        cache_path) to configure the geolocation providers
+    """
+    global _geolocate, _resume_ids
+    _resume_ids = resume_ids
+    _geolocate = geolocation is not None
+    if geolocation is None:
+        return
+
+    city_db, asn_db, http_fallback, cache_path = geolocation
+    providers = []
+    if city_db and os.path.exists(city_db):
+        providers.append(MaxMindProvider(city_db, asn_db if asn_db and os.path.exists(asn_db) else None))
+    if http_fallback:
+        providers.append(HttpProvider(cache=GeolocationCache(cache_path) if cache_path else None))
+    set_geolocation_providers(providers)
+
+
+def analyze_message(message_id: str, raw, geolocate: bool = False) -> tuple:
+    """
+    Analyze a single message.
+
+    :param message_id: The id of the message
+    :param raw: The raw message as bytes or memoryview
+    :param geolocate: Whether to look up the locations of the IP addresses
+
+    :return: A tuple (JSON line, number of bytes analyzed, True if the analysis failed)
+    """
+    try:
+        mail_data = str(raw, 'utf-8', errors='replace').strip()
+        result = analyze_mail(mail_data, geolocate=geolocate, render_chart=False)
+        record = {'id': message_id, **serialize_analysis(result, extract_ip_addresses(mail_data))}
+        failed = False
+    except Exception as e:
+        record = {'id': message_id, 'error': f"Analysis failed: {e}"}
+        failed = True
+    return json.dumps(record, default=str) + '\n', len(raw), failed
+
+
+def analyze_task(task: tuple) -> tuple:
+    """
+    Analyze all messages of a task. This runs in a worker process.
+
+    :param task: A task from iter_tasks
+
+    :return: A tuple (list of analyze_message results, number of skipped messages)
+    """
+    results = []
+    skipped = 0
+    for message_id, raw in iter_task_messages(task):
+        if message_id in _resume_ids:
+            skipped += 1
+        else:
+            results.append(analyze_message(message_id, raw, geolocate=_geolocate))
+    return results, skipped
+
+
+class Progress:
+    """
+    Report the throughput of a run on stderr.
+    """
+
+    def __init__(self, stream=None, interval: float = PROGRESS_INTERVAL):
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.messages = 0
+        self.bytes = 0
+        self.errors = 0
+        self.skipped = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+
+    def update(self, size: int, failed: bool):
+        self.messages += 1
+        self.bytes += size
+        self.errors += failed
+        now = time.monotonic()
+        if now - self.reported >= self.interval:
+            self.reported = now
+            self.report()
+
+    def report(self, final: bool = False):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        print(
+            f"{'Done: ' if final else ''}{self.messages} messages ({self.errors} failed, "
+            f"{self.skipped} skipped) in {elapsed:.1f} s, {self.messages / elapsed:.1f} messages/s, "
+            f"{self.bytes / elapsed / 1024 / 1024:.2f} MB/s",
+            file=self.stream, flush=True
+        )
+
+
+def run(paths: list, output, jobs: int = None, resume_ids: set = frozenset(), geolocation: tuple = None,
+        progress: Progress = None) -> Progress:
+    """
+    Analyze all messages in the given paths and write one JSON line per message to output.
+    The messages are analyzed on a pool of worker processes and written as soon as a task is
+    done, so the order of the lines can differ from the order in the mailbox.
+
+    :param paths: A list of mbox files, Maildirs and single message files
+    :param output: A writable text stream
+    :param jobs: Number of worker processes, 1 analyzes the messages in this process
+    :param resume_ids: Ids of messages which are skipped, because they have been analyzed before
+    :param geolocation: Geolocation settings for configure_worker or None to skip the geolocation
+    :param progress: Progress instance for the throughput reports
+
+    :return: The progress instance with the final counters
+    """
+    jobs = jobs or os.cpu_count() or 1
+    progress = progress or Progress()
+
+    def write(results, skipped):
+        progress.skipped += skipped
+        for line, size, failed in results:
+            output.write(line)
+            progress.update(size, failed)
+
+    if jobs == 1:
+        configure_worker(resume_ids, geolocation)
+        for task in iter_tasks(paths):
+            write(*analyze_task(task))
+    else:
+        with multiprocessing.Pool(jobs, initializer=configure_worker, initargs=(resume_ids, geolocation)) as pool:
+            for results, skipped in pool.imap_unordered(analyze_task, iter_tasks(paths)):
+                write(results, skipped)
+
+    output.flush()
+    progress.report(final=True)
+    return progress
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="MAPy: Analyze mbox files and Maildirs in bulk and write the results as JSON lines")
+
+    parser.add_argument("paths", nargs='+',
+                        help="mbox files, Maildir directories or single message files")
+    parser.add_argument("-o", "--output", default=None, type=str,
+                        help="Write the results to this file instead of stdout")
+    parser.add_argument("-j", "--jobs", default=os.cpu_count() or 1, type=int,
+                        help="Number of worker processes (default: number of cores)")
+    parser.add_argument("-r", "--resume", action="store_true", default=False,
+                        help="Skip messages which are already in the output file and append the others")
+
+    # Geolocation options
+    parser.add_argument("-g", "--geolocate", action="store_true", default=False,
+                        help="Look up the locations of the IP addresses (default: off)")
+    parser.add_argument("--city-db", default=os.path.join(DATA_DIR, 'GeoLite2-City.mmdb'), type=str,
+                        help="Path to a local MaxMind City database")
+    parser.add_argument("--asn-db", default=os.path.join(DATA_DIR, 'GeoLite2-ASN.mmdb'), type=str,
+                        help="Path to a local MaxMind ASN database")
+    parser.add_argument("--no-http", action="store_true", default=False,
+                        help="Don't ask the web service for addresses the local databases don't know")
+    parser.add_argument("--cache", default=None, type=str,
+                        help="Path to an SQLite geolocation cache for the web service lookups")
+
+    args = parser.parse_args(argv)
+
+    for path in args.paths:
+        if not os.path.exists(path):
+            parser.error(f"{path} does not exist")
+    if args.resume and not args.output:
+        parser.error("--resume requires --output")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    resume_ids = set()
+    if args.resume:
+        drop_partial_line(args.output)
+        resume_ids = read_processed_ids(args.output)
+    geolocation = (args.city_db, args.asn_db, not args.no_http, args.cache) if args.geolocate else None
+
+    output = open(args.output, 'a' if args.resume else 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        run(args.paths, output, jobs=args.jobs, resume_ids=resume_ids, geolocation=geolocation)
+    except KeyboardInterrupt:
+        print("Interrupted, continue with --resume", file=sys.stderr)
+        return 130
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    return 0
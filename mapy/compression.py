@@ -0,0 +1,55 @@
+import gzip
+
+from flask import Request, Response
+
+from mapy import metrics
+
+# Dynamic responses which are compressed, static files are left to the server in front of the app
+COMPRESSIBLE_MIMETYPES = ('text/html', 'application/json', 'text/plain')
+
+
+def is_compressible(response: Response, min_size: int) -> bool:
+    """
+    Check whether a response can be compressed. Streamed responses (like the Server-Sent Events of
+    jobs) and files sent from disk (attachments, static files) are left alone, so they are still
+    sent as they are produced and range requests keep working.
+
+    :param response: The response
+    :param min_size: Responses smaller than this number of bytes aren't worth compressing
+
+    :return: True if the response has a compressible type, is buffered and large enough
+    """
+    return (
+        response.status_code == 200
+        and response.mimetype in COMPRESSIBLE_MIMETYPES
+        and not response.direct_passthrough
+        and not response.is_streamed
+        and 'Content-Encoding' not in response.headers
+        and (response.content_length or 0) >= min_size
+    )
+
+
+def compress_response(request: Request, response: Response, level: int = 6, min_size: int = 1024) -> Response:
+    """
+    Compress a response with gzip if the client accepts it.
+
+    :param request: The request, its Accept-Encoding header is checked
+    :param response: The response
+    :param level: The gzip compression level from 1 (fastest) to 9 (smallest)
+    :param min_size: Minimum size of the response in bytes
+
+    :return: The same response, compressed if possible
+    """
+    if not is_compressible(response, min_size):
+        return response
+
+    # The response depends on the header even when it isn't compressed, caches must know that
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+
+    with metrics.stage('compress'):
+        data = gzip.compress(response.get_data(), compresslevel=level, mtime=0)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -1,35 +1,4 @@
-import re
-from IPy import IP
-import geoip2.database
-import os
-
-mmdb_path = os.path.join(os.path.dirname(__file__), 'static', 'data', 'GeoLite2-Country.mmdb')
-reader = geoip2.database.Reader(mmdb_path)
-
-
-def get_country_from_ip(line) -> dict:
-    """
-    Get country information from an IP address which is part of a header line.
-
-    :param line: A header line
-
-    :return: Country information as a dictionary like {'iso_code': 'us', 'country_name': 'United States'}
-    """
-    ipv4_address = re.compile(r"""
-        \b((?:25[0-5]|2[0-4]\d|1\d\d|[1-9]\d|\d)\.
-        (?:25[0-5]|2[0-4]\d|1\d\d|[1-9]\d|\d)\.
-        (?:25[0-5]|2[0-4]\d|1\d\d|[1-9]\d|\d)\.
-        (?:25[0-5]|2[0-4]\d|1\d\d|[1-9]\d|\d))\b""", re.X)
-    ip = ipv4_address.findall(line)
-    if ip:
-        ip = ip[0]  # Take the 1st IP and ignore the rest
-        if IP(ip).iptype() == 'PUBLIC':
-            r = reader.country(ip).country
-            if r.iso_code and r.name:
-                return {
-                    'iso_code': r.iso_code.lower(),
-                    'country_name': r.name
-                }
+from mapy.geolocation import get_country_from_ip
 
 
 def duration(seconds, _maxweeks=99999999999) -> str:
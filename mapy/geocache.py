@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class GeolocationCache:
+    """
+    Disk-backed cache for geolocation lookups, keyed by IP address.
+
+    The cache is stored in an SQLite database in WAL mode, so it can be shared by several
+    server worker processes at once. Every thread (and every process) opens its own connection.
+    Empty lookups are cached as well, but only for `negative_ttl` seconds, so an address the
+    geolocation service doesn't know yet is asked for again before long.
+    """
+
+    def __init__(self, path: str, ttl: int = 7 * 24 * 3600, negative_ttl: int = 3600):
+        """
+        :param path: Path to the SQLite database file, it's created if it doesn't exist
+        :param ttl: Time in seconds a successful lookup is kept
+        :param negative_ttl: Time in seconds an empty lookup is kept
+        """
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._counter_lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with sqlite3.connect(path, timeout=5) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS geolocation ('
+                'ip TEXT PRIMARY KEY, data TEXT, expires REAL NOT NULL)'
+            )
+        conn.close()
+
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Get the connection of the current thread. Connections are never shared between
+        threads or inherited by forked worker processes.
+
+        :return: An open SQLite connection
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, hit: bool):
+        with self._counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, ip: str) -> tuple:
+        """
+        Look up an IP address in the cache.
+
+        :param ip: The IP address
+
+        :return: A tuple (hit, location), where location is None for a cached empty lookup
+        """
+        try:
+            row = self._connection().execute(
+                'SELECT data FROM geolocation WHERE ip = ? AND expires > ?', (ip, time.time())
+            ).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Geolocation cache lookup failed: %s", e)
+            row = None
+
+        self._count(row is not None)
+        if row is None:
+            return False, None
+        return True, json.loads(row[0]) if row[0] is not None else None
+
+    def set(self, ip: str, location: dict | None):
+        """
+        Store the result of a lookup. A result of None is stored as a negative entry.
+
+        :param ip: The IP address
+        :param location: The geolocation data or None if the service has no location
+        """
+        ttl = self.ttl if location else self.negative_ttl
+        data = json.dumps(location) if location else None
+        try:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO geolocation (ip, data, expires) VALUES (?, ?, ?)',
+                (ip, data, time.time() + ttl)
+            )
+        except sqlite3.Error as e:
+            logger.warning("Geolocation cache update failed: %s", e)
+
+    def purge(self) -> int:
+        """
+        Remove all expired entries.
+
+        :return: The number of removed entries
+        """
+        cursor = self._connection().execute('DELETE FROM geolocation WHERE expires <= ?', (time.time(),))
+        return cursor.rowcount
+
+    def stats(self) -> dict:
+        """
+        Get the hit and miss counters of this process and the number of stored entries.
+
+        :return: A dictionary like {'hits': 3, 'misses': 1, 'hit_rate': 0.75, 'entries': 42}
+        """
+        entries = self._connection().execute('SELECT COUNT(*) FROM geolocation').fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': entries
+        }
@@ -0,0 +1,305 @@
+import ipaddress
+import logging
+import os
+import re
+import threading
+
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+# geoip2, requests and IPy are imported on first use, importing this module stays cheap
+if TYPE_CHECKING:
+    import geoip2.database
+    import requests
+
+logger = logging.getLogger(__name__)
+
+COUNTRY_DB_PATH = os.path.join(os.path.dirname(__file__), 'static', 'data', 'GeoLite2-Country.mmdb')
+
+IPV4_ADDRESS = re.compile(r"""
+    \b((?:25[0-5]|2[0-4]\d|1\d\d|[1-9]\d|\d)\.
+    (?:25[0-5]|2[0-4]\d|1\d\d|[1-9]\d|\d)\.
+    (?:25[0-5]|2[0-4]\d|1\d\d|[1-9]\d|\d)\.
+    (?:25[0-5]|2[0-4]\d|1\d\d|[1-9]\d|\d))\b""", re.X)
+
+GEOLOCATION_URL = 'https://ipapi.co/{ip}/json/'
+GEOLOCATION_TIMEOUT = (3.05, 5)  # (connect, read) timeout for a single lookup in seconds
+GEOLOCATION_POOL_SIZE = 8
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> 'requests.Session':
+    """
+    Get the shared HTTP session used for geolocation lookups. The session keeps connections
+    alive, so consecutive lookups don't pay for a new TCP and TLS handshake every time.
+
+    :return: The shared requests session
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GEOLOCATION_POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _http_session = session
+        return _http_session
+
+
+_country_reader = None
+_country_reader_lock = threading.Lock()
+
+
+def get_country_reader() -> 'geoip2.database.Reader | None':
+    """
+    Get the reader for the local country database, it's opened on first use.
+
+    :return: The shared database reader or None if the database is missing
+    """
+    global _country_reader
+    with _country_reader_lock:
+        if _country_reader is None and os.path.exists(COUNTRY_DB_PATH):
+            import geoip2.database
+
+            _country_reader = geoip2.database.Reader(COUNTRY_DB_PATH)
+        return _country_reader
+
+
+@lru_cache(maxsize=4096)
+def lookup_country(ip: str) -> dict | None:
+    """
+    Look up the country of a public IPv4 address in the local country database.
+    Results are memoized, because the same relays show up over and over again.
+
+    :param ip: The IP address
+
+    :return: Country information as a dictionary like {'iso_code': 'us', 'country_name': 'United States'}
+    """
+    from IPy import IP
+    import geoip2.errors
+
+    reader = get_country_reader()
+    if reader is None or IP(ip).iptype() != 'PUBLIC':
+        return None
+
+    try:
+        r = reader.country(ip).country
+    except geoip2.errors.AddressNotFoundError:
+        return None
+
+    if r.iso_code and r.name:
+        return {
+            'iso_code': r.iso_code.lower(),
+            'country_name': r.name
+        }
+    return None
+
+
+def get_country_from_ip(line) -> dict:
+    """
+    Get country information from an IP address which is part of a header line.
+
+    :param line: A header line
+
+    :return: Country information as a dictionary like {'iso_code': 'us', 'country_name': 'United States'}
+    """
+    ip = IPV4_ADDRESS.search(line)
+    if ip:
+        return lookup_country(ip.group(1))  # Take the 1st IP and ignore the rest
+
+
+class GeolocationProvider:
+    """
+    Base class for geolocation providers. A provider returns a dictionary with at least
+    'ip', 'latitude' and 'longitude' for an IP address, or None if it doesn't know the address.
+    """
+
+    # Local providers answer without any I/O worth parallelizing
+    is_local = False
+
+    def lookup(self, ip: str) -> dict | None:
+        raise NotImplementedError
+
+
+class MaxMindProvider(GeolocationProvider):
+    """
+    Geolocation provider backed by local MaxMind City and (optionally) ASN databases.
+    """
+
+    is_local = True
+
+    def __init__(self, city_path: str, asn_path: str = None):
+        """
+        :param city_path: Path to a GeoLite2/GeoIP2 City database
+        :param asn_path: Optional path to a GeoLite2 ASN database
+        """
+        import geoip2.database
+
+        self.city_reader = geoip2.database.Reader(city_path)
+        self.asn_reader = geoip2.database.Reader(asn_path) if asn_path else None
+
+    def lookup(self, ip: str) -> dict | None:
+        import geoip2.errors
+
+        try:
+            city = self.city_reader.city(ip)
+        except (geoip2.errors.AddressNotFoundError, ValueError):
+            return None
+
+        if city.location.latitude is None or city.location.longitude is None:
+            return None
+
+        location = {
+            'ip': ip,
+            'latitude': city.location.latitude,
+            'longitude': city.location.longitude,
+            'country': city.country.name,
+            'iso_code': city.country.iso_code.lower() if city.country.iso_code else None
+        }
+
+        if self.asn_reader:
+            try:
+                asn = self.asn_reader.asn(ip)
+                location['asn'] = asn.autonomous_system_number
+                location['organization'] = asn.autonomous_system_organization
+            except (geoip2.errors.AddressNotFoundError, ValueError):
+                pass
+
+        return location
+
+
+class HttpProvider(GeolocationProvider):
+    """
+    Geolocation provider which asks the ipapi.co web service. If a cache is given, it's
+    consulted first and every answer of the service (including empty ones) is stored in it.
+    Failed requests aren't cached.
+    """
+
+    def __init__(self, url: str = GEOLOCATION_URL, timeout=GEOLOCATION_TIMEOUT, cache=None):
+        """
+        :param url: URL template of the service with an '{ip}' placeholder
+        :param timeout: Timeout for a request in seconds, either a single value or a (connect, read) tuple
+        :param cache: An optional GeolocationCache instance
+        """
+        self.url = url
+        self.timeout = timeout
+        self.cache = cache
+
+    def lookup(self, ip: str) -> dict | None:
+        if self.cache is not None:
+            hit, location = self.cache.get(ip)
+            if hit:
+                return location
+
+        import requests
+
+        try:
+            location = self.request(ip)
+        except requests.RequestException as e:
+            # Not cached, the service may well answer the next time
+            logger.warning("Fetching the geolocation of %s failed: %s", ip, e)
+            return None
+
+        if self.cache is not None:
+            self.cache.set(ip, location)
+
+        return location
+
+    def request(self, ip: str) -> dict | None:
+        """
+        Request geolocation data for a given IP address from the web service.
+
+        :param ip: The IP address
+
+        :return: A dictionary containing latitude, longitude, and IP address or None if the
+                 service doesn't know the address. Errors of the request, error statuses like
+                 429 when the quota is used up and error replies raise a requests.RequestException.
+        """
+        import requests
+
+        response = get_http_session().get(self.url.format(ip=ip), timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        if data.get('error'):
+            # ipapi.co answers e.g. {"error": true, "reason": "RateLimited", "message": "..."}
+            raise requests.RequestException(f"{data.get('reason')}: {data.get('message')}", response=response)
+        if 'latitude' in data and 'longitude' in data:
+            location = {
+                'ip': ip,
+                'latitude': data['latitude'],
+                'longitude': data['longitude']
+            }
+            if data.get('country_name'):
+                location['country'] = data['country_name']
+                location['iso_code'] = (data.get('country_code') or '').lower() or None
+            asn = parse_asn(data.get('asn'))
+            if asn is not None:
+                location['asn'] = asn
+                location['organization'] = data.get('org')
+            return location
+
+        return None
+
+
+def parse_asn(value) -> int | None:
+    """
+    Parse an autonomous system number like the MaxMind databases return it.
+
+    :param value: The number as int or string, ipapi.co sends e.g. 'AS15169'
+
+    :return: The number, e.g. 15169, or None if there is none
+    """
+    try:
+        return int(str(value).strip().upper().removeprefix('AS')) if value else None
+    except ValueError:
+        return None
+
+
+_providers = [HttpProvider()]
+
+
+def set_geolocation_providers(providers: list):
+    """
+    Set the providers which are asked, in order, for the location of an IP address.
+
+    :param providers: A list of GeolocationProvider instances
+    """
+    global _providers
+    _providers = list(providers)
+
+
+def get_geolocation_providers() -> list:
+    """
+    Get the providers which are asked, in order, for the location of an IP address.
+
+    :return: A list of GeolocationProvider instances
+    """
+    return _providers
+
+
+def lookup_geolocation(ip: str) -> dict | None:
+    """
+    Look up the location of an IP address. The providers are asked in order and the first
+    answer wins. Private, reserved and invalid addresses are skipped right away.
+
+    :param ip: The IP address
+
+    :return: A dictionary containing latitude, longitude, and IP address or None
+    """
+    try:
+        if not ipaddress.ip_address(ip).is_global:
+            return None
+    except ValueError:
+        return None
+
+    for provider in _providers:
+        location = provider.lookup(ip)
+        if location:
+            return location
+
+    return None
@@ -0,0 +1,152 @@
+import logging
+import secrets
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """
+    A single analysis running in the background. Progress is recorded as a list of events,
+    which can be replayed and followed by any number of clients.
+    """
+
+    def __init__(self):
+        self.id = secrets.token_urlsafe(16)
+        self.state = 'queued'
+        self.result = None
+        self.error = None
+        self.finished = None
+        self.events = []  # (name, data) tuples
+        self._condition = threading.Condition()
+
+    def progress(self, stage: str):
+        """
+        Record that a stage of the analysis is done.
+
+        :param stage: Name of the stage, e.g. 'headers'
+        """
+        self._emit('progress', {'stage': stage})
+
+    def start(self):
+        self.state = 'running'
+        self._emit('progress', {'stage': 'started'})
+
+    def finish(self, result):
+        self.result = result
+        self.finished = time.monotonic()
+        self.state = 'done'
+        self._emit('done', {})
+
+    def fail(self, error: str):
+        self.error = error
+        self.finished = time.monotonic()
+        self.state = 'failed'
+        self._emit('failed', {'error': error})
+
+    def _emit(self, name: str, data: dict):
+        with self._condition:
+            self.events.append((name, data))
+            self._condition.notify_all()
+
+    def iter_events(self, timeout: float = 15):
+        """
+        Iterate over all events of the job, from the first one until the job is done or failed.
+
+        :param timeout: Seconds to wait for a new event before None is yielded as a keep-alive
+
+        :return: A generator of (name, data) tuples or None
+        """
+        index = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: len(self.events) > index, timeout)
+                new = self.events[index:]
+            if not new:
+                yield None
+            for name, data in new:
+                yield name, data
+                if name in ('done', 'failed'):
+                    return
+            index += len(new)
+
+
+class JobQueue:
+    """
+    Runs analyses on a bounded pool of worker threads. Finished jobs are kept for `ttl` seconds,
+    so their result can be fetched, but at most `max_finished` of them, and the number of
+    unfinished jobs is limited to `max_pending`.
+    """
+
+    def __init__(self, max_workers: int = 4, max_pending: int = 32, ttl: int = 600, max_finished: int = 100):
+        """
+        :param max_workers: Number of jobs which run at the same time
+        :param max_pending: Maximum number of queued and running jobs
+        :param ttl: Time in seconds the result of a finished job is kept
+        :param max_finished: Maximum number of finished jobs which are kept, the oldest ones are dropped first
+        """
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mapy-job')
+
+    def submit(self, fn) -> Job | None:
+        """
+        Queue a job.
+
+        :param fn: A callable which takes a progress callback and returns the result
+
+        :return: The new job or None if too many jobs are pending
+        """
+        with self._lock:
+            self._cleanup()
+            pending = sum(1 for job in self._jobs.values() if job.state in ('queued', 'running'))
+            if pending >= self.max_pending:
+                return None
+            job = Job()
+            self._jobs[job.id] = job
+
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    @staticmethod
+    def _run(job: Job, fn):
+        job.start()
+        try:
+            result = fn(job.progress)
+        except Exception as e:
+            logger.exception("Job %s failed", job.id)
+            job.fail(f"Analysis failed: {e}")
+        else:
+            job.finish(result)
+
+    def get(self, job_id: str) -> Job | None:
+        """
+        Get a job by its id.
+
+        :param job_id: The id of the job
+
+        :return: The job or None if it's unknown or expired
+        """
+        with self._lock:
+            self._cleanup()
+            return self._jobs.get(job_id)
+
+    def _cleanup(self):
+        now = time.monotonic()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished is not None and job.finished + self.ttl < now]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+        # Results can be large, a burst of submissions mustn't keep all of them for the whole TTL
+        finished = [job for job in self._jobs.values() if job.finished is not None]
+        if len(finished) > self.max_finished:
+            finished.sort(key=lambda job: job.finished)
+            for job in finished[:len(finished) - self.max_finished]:
+                del self._jobs[job.id]
@@ -0,0 +1,115 @@
+import mmap
+import os
+
+from contextlib import contextmanager
+
+SEPARATOR = b'\nFrom '
+
+
+@contextmanager
+def open_mbox(path: str):
+    """
+    Memory-map an mbox file for reading. Nothing is read up front, the pages of the file are
+    loaded by the operating system when they are accessed.
+
+    All memoryviews taken from the map must be released before the context is left.
+
+    :param path: Path to the mbox file
+
+    :return: A context manager yielding the mmap object, or an empty bytes object for an empty file
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''  # Empty files can't be mapped
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield mm
+        finally:
+            mm.close()
+
+
+def find_message_start(mm, position: int, end: int = None) -> int:
+    """
+    Find the first 'From ' separator line at or after a position.
+
+    :param mm: The mapped mbox file
+    :param position: Offset to start searching at
+    :param end: Offset to stop searching at (default: end of the file)
+
+    :return: The offset of the separator line or end if there is none
+    """
+    end = len(mm) if end is None else end
+    if position == 0 and mm[:5] == b'From ':
+        return 0
+    index = mm.find(SEPARATOR, max(position - 1, 0), end)
+    return end if index == -1 else index + 1
+
+
+def iter_message_ranges(mm, start: int = 0, end: int = None):
+    """
+    Iterate over the messages whose 'From ' separator line starts in a byte range. Combined with
+    split_ranges, every message is found exactly once by one of the ranges.
+
+    :param mm: The mapped mbox file
+    :param start: Start offset of the range
+    :param end: End offset of the range (default: end of the file)
+
+    :return: A generator of (offset, body start, body end) tuples, where offset is the start of
+             the separator line and the body is the message without it
+    """
+    end = len(mm) if end is None else end
+    offset = find_message_start(mm, start, end)
+    while offset < end:
+        line_end = mm.find(b'\n', offset)
+        body_start = len(mm) if line_end == -1 else line_end + 1
+        next_offset = find_message_start(mm, body_start, len(mm))
+        # The newline in front of the next separator belongs to the separator
+        body_end = next_offset - 1 if next_offset < len(mm) else next_offset
+        yield offset, body_start, max(body_end, body_start)
+        offset = next_offset
+
+
+def iter_messages(mm, start: int = 0, end: int = None):
+    """
+    Iterate over the messages in (a byte range of) a mapped mbox file without copying them.
+
+    :param mm: The mapped mbox file
+    :param start: Start offset of the range
+    :param end: End offset of the range (default: end of the file)
+
+    :return: A generator of (offset, memoryview) tuples, the memoryview is the raw message
+             without the 'From ' separator line
+    """
+    view = memoryview(mm)
+    try:
+        for offset, body_start, body_end in iter_message_ranges(mm, start, end):
+            yield offset, view[body_start:body_end]
+    finally:
+        view.release()
+
+
+def split_ranges(mm, parts: int) -> list:
+    """
+    Split a mapped mbox file into byte ranges of about the same size for parallel workers.
+    The boundaries are moved to the next separator line, so no message is cut in half.
+
+    :param mm: The mapped mbox file
+    :param parts: The number of ranges to aim for
+
+    :return: A list of (start, end) tuples, fewer than parts if the file has only few messages
+    """
+    size = len(mm)
+    if size == 0:
+        return []
+
+    boundaries = [0]
+    for i in range(1, max(parts, 1)):
+        boundary = find_message_start(mm, max(size * i // parts, boundaries[-1] + 1))
+        if boundary >= size:
+            break
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+    boundaries.append(size)
+
+    return list(zip(boundaries, boundaries[1:]))
@@ -0,0 +1,280 @@
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Upper bounds of the histogram buckets, Prometheus adds +Inf
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = {
+    'hops': (1, 2, 5, 10, 20, 50, 100, 200, 500),
+    'ips': (1, 2, 5, 10, 20, 50, 100, 500),
+    'parts': (1, 2, 5, 10, 20, 50, 100, 500),
+    'attachment_bytes': (0, 1024, 10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 25 * 1024 ** 2, 100 * 1024 ** 2),
+}
+MEMORY_BUCKETS = (0, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2,
+                  256 * 1024 ** 2, 1024 ** 3)
+COUNT_HELP = {
+    'hops': "Received hops per analyzed mail",
+    'ips': "IP addresses per analyzed mail",
+    'parts': "MIME parts per analyzed mail",
+    'attachment_bytes': "Decoded attachment bytes per analyzed mail",
+}
+
+_timings = ContextVar('mapy_timings', default=None)
+
+
+class Timings:
+    """Durations of the stages and counts of a single request or background analysis."""
+
+    def __init__(self, memory: bool = False):
+        """
+        :param memory: Whether to account the memory allocated by the stages, needs tracemalloc to be tracing
+        """
+        self.started = time.perf_counter()
+        self.stages = {}  # name -> seconds, in the order the stages started
+        self.counts = {}  # name -> value
+        self.memory = {} if memory else None  # name -> (peak, retained) bytes
+        self._peaks = []  # Peak of every running stage, tracemalloc only has one for the whole process
+
+    def enter_memory(self) -> int:
+        """
+        Start accounting the memory of a stage.
+
+        :return: The traced memory at the start of the stage
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        if self._peaks:
+            # The peak is reset below, the enclosing stage keeps what it has seen so far
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        self._peaks.append(current)
+        tracemalloc.reset_peak()
+        return current
+
+    def exit_memory(self, name: str, start: int):
+        """
+        Finish accounting the memory of a stage. A stage which runs several times gets the
+        largest peak and the sum of the retained memory.
+
+        :param name: Name of the stage
+        :param start: The value returned by enter_memory
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, self._peaks.pop())
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        old_peak, old_retained = self.memory.get(name, (0, 0))
+        self.memory[name] = (max(old_peak, peak - start), old_retained + current - start)
+
+    def server_timing(self, total: float = None) -> str:
+        """
+        Format the durations for the Server-Timing response header. With memory accounting, the
+        peak and the retained memory of every stage are added as description.
+
+        :param total: Optional duration of the whole request in seconds
+
+        :return: A header value like 'parse;dur=1.2;desc="peak 2.1 MB, retained 0.4 MB", total;dur=9.1'
+                 (in milliseconds)
+        """
+        entries = []
+        for name, seconds in self.stages.items():
+            entry = f'{name};dur={seconds * 1000:.1f}'
+            if self.memory and name in self.memory:
+                entry += f';desc="{self.format_memory(name)}"'
+            entries.append(entry)
+        if total is not None:
+            entries.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(entries)
+
+    def format_memory(self, name: str) -> str:
+        peak, retained = self.memory[name]
+        return f'peak {peak / 1024 ** 2:.1f} MB, retained {retained / 1024 ** 2:.1f} MB'
+
+
+def start() -> tuple:
+    """
+    Start collecting timings in the current context. The memory of the stages is accounted
+    as well while tracemalloc is tracing (see MEMORY_ACCOUNTING).
+
+    :return: The new Timings and a token for stop
+    """
+    timings = Timings(memory=tracemalloc.is_tracing())
+    return timings, _timings.set(timings)
+
+
+def stop(token):
+    """
+    Stop collecting timings in the current context.
+
+    :param token: The token returned by start
+    """
+    _timings.reset(token)
+
+
+@contextmanager
+def collect():
+    """
+    Collect the timings of everything run inside the with block.
+
+    :return: A context manager yielding the Timings
+    """
+    timings, token = start()
+    try:
+        yield timings
+    finally:
+        stop(token)
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a stage of the analysis. Stages can be nested, and the durations of a stage which runs
+    several times are added up. Outside of collect, only the lookup of the context variable remains.
+
+    :param name: Name of the stage, e.g. 'headers'
+    """
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    timings.stages.setdefault(name, 0.0)
+    memory = timings.memory is not None and tracemalloc.is_tracing()
+    if memory:
+        traced = timings.enter_memory()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.stages[name] += time.perf_counter() - started
+        if memory:
+            timings.exit_memory(name, traced)
+
+
+def count(name: str, value: int):
+    """
+    Add to a count of the current request, e.g. the number of hops.
+
+    :param name: Name of the count, one of COUNT_BUCKETS
+    :param value: The value to add
+    """
+    timings = _timings.get()
+    if timings is not None:
+        timings.counts[name] = timings.counts.get(name, 0) + value
+
+
+class Histogram:
+    """A Prometheus histogram with fixed buckets."""
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str = '') -> list:
+        """
+        Render the samples of this histogram in the Prometheus text format.
+
+        :param name: Name of the metric
+        :param labels: Labels of the series, like 'stage="headers"'
+
+        :return: A list of lines
+        """
+        prefix = f'{labels},' if labels else ''
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            cumulative += bucket_count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {self.sum}')
+        lines.append(f'{name}_count{suffix} {self.count}')
+        return lines
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """
+    Histograms of request and stage durations, of the memory of the stages (with memory accounting)
+    and of the counts per analyzed mail, served in the Prometheus text format. Like the result cache,
+    they live in the memory of a single process, so every server worker reports its own numbers.
+    """
+
+    def __init__(self):
+        self._requests = {}  # endpoint -> Histogram
+        self._stages = {}  # stage -> Histogram
+        self._memory_peaks = {}  # stage -> Histogram
+        self._memory_retained = {}  # stage -> Histogram
+        self._counts = {name: Histogram(buckets) for name, buckets in COUNT_BUCKETS.items()}
+        self._lock = threading.Lock()
+
+    def observe(self, timings: Timings, endpoint: str = None, total: float = None):
+        """
+        Add the timings and counts of a request or background analysis to the histograms.
+
+        :param timings: The collected timings
+        :param endpoint: Name of the endpoint of a request
+        :param total: Duration of the whole request in seconds
+        """
+        with self._lock:
+            if endpoint is not None and total is not None:
+                self._requests.setdefault(endpoint, Histogram(DURATION_BUCKETS)).observe(total)
+            for name, seconds in timings.stages.items():
+                self._stages.setdefault(name, Histogram(DURATION_BUCKETS)).observe(seconds)
+            for name, value in timings.counts.items():
+                if name in self._counts:
+                    self._counts[name].observe(value)
+            for name, (peak, retained) in (timings.memory or {}).items():
+                self._memory_peaks.setdefault(name, Histogram(MEMORY_BUCKETS)).observe(peak)
+                self._memory_retained.setdefault(name, Histogram(MEMORY_BUCKETS)).observe(retained)
+
+    def render(self) -> str:
+        """
+        Render all metrics in the Prometheus text format.
+
+        :return: The text served by the /metrics endpoint
+        """
+        with self._lock:
+            lines = [
+                '# HELP mapy_request_duration_seconds Duration of requests by endpoint',
+                '# TYPE mapy_request_duration_seconds histogram',
+            ]
+            for endpoint, histogram in sorted(self._requests.items()):
+                lines += histogram.render('mapy_request_duration_seconds', f'endpoint="{escape_label(endpoint)}"')
+
+            lines += [
+                '# HELP mapy_stage_duration_seconds Duration of the stages of the analysis',
+                '# TYPE mapy_stage_duration_seconds histogram',
+            ]
+            for name, histogram in sorted(self._stages.items()):
+                lines += histogram.render('mapy_stage_duration_seconds', f'stage="{escape_label(name)}"')
+
+            for metric, histograms, description in (
+                ('mapy_stage_memory_peak_bytes', self._memory_peaks, "Peak memory allocated by the stages"),
+                ('mapy_stage_memory_retained_bytes', self._memory_retained,
+                 "Memory still allocated at the end of the stages"),
+            ):
+                if histograms:
+                    lines += [f'# HELP {metric} {description}', f'# TYPE {metric} histogram']
+                for name, histogram in sorted(histograms.items()):
+                    lines += histogram.render(metric, f'stage="{escape_label(name)}"')
+
+            for name, histogram in self._counts.items():
+                lines += [f'# HELP mapy_mail_{name} {COUNT_HELP[name]}', f'# TYPE mapy_mail_{name} histogram']
+                lines += histogram.render(f'mapy_mail_{name}')
+
+        return '\n'.join(lines) + '\n'
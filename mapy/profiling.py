@@ -0,0 +1,180 @@
+import cProfile
+import functools
+import os
+import pstats
+import sys
+import threading
+import time
+
+from collections import Counter
+from contextvars import ContextVar
+
+PROFILE_MODES = ('pstats', 'stacks')
+SAMPLE_INTERVAL = 0.001  # Seconds between two samples of the stack
+
+# The StackSampler or ThreadProfiles of the running run_profiled call, see wrap
+_active = ContextVar('mapy_profiler', default=None)
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of another thread at a fixed interval and counts how often every stack was
+    seen. Unlike cProfile, the full call path of every function is kept, which is what flame graphs need.
+    Worker threads which run functions passed through wrap are sampled as well while they run them.
+    """
+
+    def __init__(self, thread_id: int, root, interval: float = SAMPLE_INTERVAL):
+        """
+        :param thread_id: Identifier of the thread to sample
+        :param root: Frame at which the stacks are cut off, the frames of its callers are left out
+        :param interval: Seconds between two samples
+        """
+        super().__init__(name='mapy-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.root = root
+        self.interval = interval
+        self.stacks = Counter()
+        self.threads = {thread_id: (root, '')}  # thread id -> (root frame, prefix of its stacks)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = list(self.threads.items())
+            for thread_id, (root, prefix) in threads:
+                stack = self.format_stack(frames.get(thread_id), root)
+                if stack:
+                    self.stacks[prefix + stack] += 1
+
+    @staticmethod
+    def format_stack(frame, root) -> str:
+        """
+        Format a stack like 'mapy.utils:analyze_mail;mapy.utils:parse_mail', outermost function first.
+
+        :param frame: The innermost frame
+        :param root: Frame at which the stack is cut off
+        """
+        stack = []
+        while frame is not None and frame is not root:
+            stack.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def call(self, prefix: str, fn, *args):
+        """
+        Call a function on a worker thread and sample that thread until the function returns.
+
+        :param prefix: Stack of the caller which handed the function to the worker, the stacks of
+                       the worker are nested below it
+        """
+        thread_id = threading.get_ident()
+        with self._lock:
+            self.threads[thread_id] = (sys._getframe(), prefix)
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                del self.threads[thread_id]
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def write(self, path: str):
+        """
+        Write the stacks in the collapsed format of flamegraph.pl and speedscope, one line per stack
+        like 'mapy.utils:analyze_mail;mapy.utils:parse_mail 12'.
+
+        :param path: Path of the file
+        """
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class ThreadProfiles:
+    """Profiles of the functions which a profiled call hands to worker threads, see wrap."""
+
+    def __init__(self):
+        self.profilers = []
+        self._lock = threading.Lock()
+
+    def call(self, fn, *args):
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(fn, *args)
+        finally:
+            with self._lock:
+                self.profilers.append(profiler)
+
+
+def wrap(fn):
+    """
+    Wrap a function before it's submitted to a worker pool, so it's profiled along with the
+    profiled call which submits it. cProfile and the stack sampler only see their own thread,
+    without this the time spent on the pool shows up as waiting for it.
+
+    :param fn: The function
+
+    :return: A function which profiles fn, or fn itself outside of run_profiled
+    """
+    active = _active.get()
+    if active is None:
+        return fn
+    if isinstance(active, StackSampler):
+        return functools.partial(active.call, active.format_stack(sys._getframe(1), active.root) + ';', fn)
+    return functools.partial(active.call, fn)
+
+
+def profile_path(directory: str, name: str, mode: str) -> str:
+    """
+    Build the path of a new profile file and create its directory.
+
+    :param directory: Directory of the profiles
+    :param name: Identifies what was profiled, e.g. the cache key of the mail
+    :param mode: 'pstats' or 'stacks'
+
+    :return: The path, like '<directory>/20240723-102135-<name>.pstats'
+    """
+    os.makedirs(directory, exist_ok=True)
+    extension = 'pstats' if mode == 'pstats' else 'collapsed'
+    return os.path.join(directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}.{extension}")
+
+
+def run_profiled(fn, path: str, mode: str = 'pstats'):
+    """
+    Call a function under a profiler and save the profile, also when the function raises.
+
+    :param fn: A callable without arguments
+    :param path: Path of the profile file
+    :param mode: 'pstats' to record every call with cProfile (open it with pstats, snakeviz or
+                 convert it with flameprof), 'stacks' to sample the call stacks for flame graphs.
+                 Functions handed to worker pools through wrap are profiled in both modes.
+
+    :return: The return value of fn
+    """
+    if mode == 'stacks':
+        sampler = StackSampler(threading.get_ident(), sys._getframe())
+        token = _active.set(sampler)
+        sampler.start()
+        try:
+            return fn()
+        finally:
+            _active.reset(token)
+            sampler.stop()
+            sampler.write(path)
+
+    profiler = cProfile.Profile()
+    threads = ThreadProfiles()
+    token = _active.set(threads)
+    try:
+        return profiler.runcall(fn)
+    finally:
+        _active.reset(token)
+        stats = pstats.Stats(profiler)
+        with threads._lock:
+            if threads.profilers:
+                stats.add(*threads.profilers)
+        stats.dump_stats(path)
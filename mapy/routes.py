@@ -1,32 +1,269 @@
-from flask import Blueprint, render_template, request
+import json
+import os
 
-from mapy.utils import process_email_headers, extract_ip_geolocations, extract_message_data
+from flask import (Blueprint, Response, abort, current_app, jsonify, make_response, redirect, render_template,
+                   request, send_file, url_for)
+
+from mapy import metrics
+from mapy.profiling import PROFILE_MODES, profile_path, run_profiled
+from mapy.utils import analyze_mail, group_headers, iter_encoded_payload
 
 blueprint = Blueprint('mapy', __name__)
 
+# Values of the profile parameter which ask for the default mode, anything else unknown is ignored
+PROFILE_DEFAULT_VALUES = ('1', 'true', 'yes', 'on')
+
 
 @blueprint.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         mail_data = request.form['headers'].strip()
-        data, delayed, summary, headers, chart = process_email_headers(mail_data)
-        locations = extract_ip_geolocations(mail_data)
-        messages, attachments = extract_message_data(mail_data)
+        max_bars = current_app.config['CHART_MAX_BARS']
 
-        security_headers = [
-            'Received-SPF', 'Authentication-Results',
-            'DKIM-Signature', 'ARC-Authentication-Results'
-        ]
+        # Identical submissions share one analysis, even while it's still running
+        cache = current_app.extensions['result_cache']
+        key = cache.key(mail_data, 'page', max_bars)
 
-        # Construct downloadable URLs with base64-encoded data
-        for attachment in attachments:
-            if attachment.get('data'):
-                attachment['download_url'] = f"data:application/octet-stream;base64,{attachment['data']}"
+        profile_mode = get_profile_mode()
+        if profile_mode:
+            return profile_analysis(mail_data, max_bars, key, profile_mode)
 
-        return render_template(
-            'index.html', data=data, delayed=delayed, summary=summary,
-            headers=headers, chart=chart, security_headers=security_headers,
-            locations=locations, messages=messages, attachments=attachments
-        )
+        if current_app.config['ASYNC_ANALYSIS']:
+            app = current_app._get_current_object()
+
+            def run(progress):
+                # Background analyses have no response to carry a Server-Timing header, their
+                # stages only go into the metrics
+                with app.app_context(), metrics.collect() as timings:
+                    result = cache.get_or_compute(key, lambda: analyze_for_page(mail_data, max_bars, key, progress))
+                app.extensions['metrics'].observe(timings)
+                return result
+
+            job = current_app.extensions['job_queue'].submit(run)
+            if job is None:
+                abort(503)
+            return redirect(url_for('mapy.show_job', job_id=job.id), code=303)
+
+        result = cache.get_or_compute(key, lambda: analyze_for_page(mail_data, max_bars, key))
+        return render_result(result)
     else:
         return render_template('index.html')
+
+
+def render_result(result: dict):
+    # Large header groups and bodies are cut off, the rest is loaded on demand
+    with metrics.stage('render'):
+        return render_template(
+            'index.html',
+            header_rows=current_app.config['PAGE_HEADER_ROWS'],
+            message_chars=current_app.config['PAGE_MESSAGE_CHARS'],
+            **result
+        )
+
+
+def get_profile_mode() -> str | None:
+    """
+    Get the profiling mode requested with the 'profile' parameter or the X-Mapy-Profile header.
+
+    :return: 'pstats' or 'stacks', or None if no profile was requested or profiling is disabled.
+             '1', 'true', 'yes' and 'on' request 'pstats', other values like '0' or 'off' request nothing.
+    """
+    if not current_app.config['PROFILING_ENABLED']:
+        return None
+    mode = (request.args.get('profile') or request.headers.get('X-Mapy-Profile') or '').lower()
+    if mode in PROFILE_MODES:
+        return mode
+    return 'pstats' if mode in PROFILE_DEFAULT_VALUES else None
+
+
+def profile_analysis(mail_data: str, max_bars: int, key: str, mode: str):
+    """
+    Analyze an email and render the result page under a profiler. The result cache is bypassed,
+    so the analysis runs even for a mail which was analyzed before, and always in the request,
+    even if ASYNC_ANALYSIS is set. The name of the profile file is sent in the X-Mapy-Profile header.
+
+    :param mail_data: Raw email data
+    :param max_bars: Maximum number of bars in the delay chart
+    :param key: The key of the result in the result cache
+    :param mode: 'pstats' or 'stacks', see run_profiled
+    """
+    path = profile_path(current_app.config['PROFILE_DIR'], key[:16], mode)
+
+    def run():
+        result = analyze_for_page(mail_data, max_bars, key)
+        current_app.extensions['result_cache'].put(key, result)
+        return render_result(result)
+
+    response = make_response(run_profiled(run, path, mode))
+    response.headers['X-Mapy-Profile'] = os.path.basename(path)
+    current_app.logger.info("Saved the profile of an analysis to %s", path)
+    return response
+
+
+def analyze_for_page(mail_data: str, max_bars: int, key: str, progress=None) -> dict:
+    """
+    Analyze an email for the result page. The headers are grouped for their tables and the
+    attachments are spooled, so the page only has to carry download links, and the result
+    no longer references the parsed message.
+
+    :param mail_data: Raw email data
+    :param max_bars: Maximum number of bars in the delay chart
+    :param key: The key of the result in the result cache, the page loads more content with it
+    :param progress: Optional callable which is called with the name of every finished stage
+
+    :return: The result of analyze_mail with 'header_groups' instead of 'headers' and attachments
+             marked as 'spooled' instead of carrying their part
+    """
+    result = analyze_mail(mail_data, max_bars=max_bars, progress=progress)
+    result['result_key'] = key
+    result['header_groups'] = group_headers(result.pop('headers'))
+
+    spool = current_app.extensions['attachment_spool']
+    with metrics.stage('spool'):
+        for attachment in result['attachments']:
+            part = attachment.pop('part')
+            encoding, chunks = iter_encoded_payload(part)
+            attachment['spooled'] = bool(attachment['length']) and spool.put_encoded(
+                attachment['sha256'], chunks, encoding, attachment['length'])
+
+    spool_overflow(result, key)
+
+    if progress:
+        progress('attachments')
+    return result
+
+
+def spool_overflow(result: dict, key: str):
+    """
+    Store the header groups and message bodies of a result on disk if the page cuts them off.
+    The rest is loaded from there on demand, so it works in every worker process and for results
+    which are too large for the result cache.
+
+    :param result: The result of analyze_for_page
+    :param key: The key of the result
+    """
+    header_rows = current_app.config['PAGE_HEADER_ROWS']
+    message_chars = current_app.config['PAGE_MESSAGE_CHARS']
+    truncated = (any(len(rows) > header_rows for rows in result['header_groups'].values())
+                 or any(len(message['content']) > message_chars for message in result['messages']))
+    if not truncated:
+        return
+
+    data = json.dumps({
+        'header_groups': result['header_groups'],
+        'messages': [message['content'] for message in result['messages']]
+    }).encode()
+    with metrics.stage('spool'):
+        current_app.extensions['result_spool'].put_encoded(key, [data], 'raw', len(data))
+
+
+def get_result_content(key: str) -> tuple:
+    """
+    Get the header groups and message bodies of a result, from the result cache of this process
+    or from the spool shared by all processes.
+
+    :param key: The key of the result
+
+    :return: The header groups and a list with the content of every message
+    """
+    result = current_app.extensions['result_cache'].get(key)
+    if result is not None:
+        return result['header_groups'], [message['content'] for message in result['messages']]
+
+    path = current_app.extensions['result_spool'].path(key)
+    if path is None:
+        abort(404)
+    with open(path) as f:
+        content = json.load(f)
+    return content['header_groups'], content['messages']
+
+
+def get_offset(name: str, default: int = 0) -> int:
+    value = request.args.get(name, default, type=int)
+    if value < 0:
+        abort(400)
+    return value
+
+
+@blueprint.route('/results/<key>/headers/<group>')
+def result_headers(key, group):
+    """
+    Return a page of a header group of a result as JSON, like {"rows": [[name, value], ...],
+    "next": 100}, where next is the offset of the following page or null.
+    """
+    rows = get_result_content(key)[0].get(group)
+    if rows is None:
+        abort(404)
+
+    offset = get_offset('offset')
+    limit = min(get_offset('limit', current_app.config['PAGE_HEADER_ROWS']) or 1, 1000)
+    end = offset + limit
+    return jsonify(rows=rows[offset:end], next=end if end < len(rows) else None)
+
+
+@blueprint.route('/results/<key>/messages/<int:index>')
+def result_message(key, index):
+    """
+    Return a chunk of a message body of a result as JSON, like {"content": "...",
+    "next": 40000}, where next is the offset of the following chunk or null.
+    """
+    messages = get_result_content(key)[1]
+    if index >= len(messages):
+        abort(404)
+
+    content = messages[index]
+    offset = get_offset('offset')
+    limit = min(get_offset('limit', current_app.config['PAGE_MESSAGE_CHARS']) or 1, 1000000)
+    end = offset + limit
+    return jsonify(content=content[offset:end], next=end if end < len(content) else None)
+
+
+@blueprint.route('/jobs/<job_id>')
+def show_job(job_id):
+    job = current_app.extensions['job_queue'].get(job_id)
+    if job is None:
+        abort(404)
+
+    if job.state == 'done':
+        return render_result(job.result)
+    return render_template('job.html', job=job)
+
+
+@blueprint.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = current_app.extensions['job_queue'].get(job_id)
+    if job is None:
+        abort(404)
+
+    def stream():
+        for event in job.iter_events():
+            if event is None:
+                yield ': keep-alive\n\n'
+            else:
+                name, data = event
+                yield f'event: {name}\ndata: {json.dumps(data)}\n\n'
+
+    # Progress is streamed as Server-Sent Events, proxies must not buffer them
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@blueprint.route('/attachments/<key>')
+def download_attachment(key):
+    path = current_app.extensions['attachment_spool'].path(key)
+    if path is None:
+        abort(404)
+
+    # The file is streamed from disk and range requests are answered with partial content
+    return send_file(
+        path, mimetype='application/octet-stream', as_attachment=True,
+        download_name=request.args.get('filename') or key, conditional=True, max_age=0
+    )
+
+
+@blueprint.route('/metrics')
+def show_metrics():
+    """Return the request and stage durations and the counts per mail in the Prometheus text format."""
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+    return Response(current_app.extensions['metrics'].render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from mapy.utils import decode_payload
+
+KEY_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+# Entries are either decoded ('<key>') or still transfer-encoded ('<key>.<encoding>')
+ENTRY_PATTERN = re.compile(r'^([0-9a-f]{64})(?:\.(base64|quoted-printable|raw))?$')
+
+
+class AttachmentSpool:
+    """
+    Bounded, expiring storage for attachments on disk, keyed by the SHA-256 hash of their content.
+
+    Identical attachments are only stored once. Attachments can be stored as they are in the
+    mail, still transfer-encoded, and are only decoded when they are downloaded for the first
+    time. Files are written atomically, so several worker processes can share the same directory.
+    Entries expire `ttl` seconds after they were last stored, and the oldest entries are evicted
+    once the spool grows beyond `max_bytes`.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 512 * 1024 * 1024, ttl: int = 3600):
+        """
+        :param directory: Directory for the spooled files, it's created if it doesn't exist
+        :param max_bytes: Upper bound for the total size of all spooled files
+        :param ttl: Time in seconds an attachment can be downloaded after it was stored
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, data: bytes) -> str | None:
+        """
+        Store an attachment.
+
+        :param data: The content of the attachment
+
+        :return: The key to retrieve the attachment or None if it's too large for the spool
+        """
+        if len(data) > self.max_bytes:
+            return None
+
+        key = hashlib.sha256(data).hexdigest()
+        if not self._renew(key):
+            self._write(os.path.join(self.directory, key), [data])
+
+        self.cleanup(keep=key)
+        return key
+
+    def put_encoded(self, key: str, chunks, encoding: str, size: int) -> bool:
+        """
+        Store a still transfer-encoded attachment. It's decoded on its first download.
+
+        :param key: SHA-256 hash of the decoded content, or another SHA-256 hex digest which
+                    identifies it, like the key of a result
+        :param chunks: An iterable of transfer-encoded bytes
+        :param encoding: 'base64', 'quoted-printable' or 'raw'
+        :param size: The decoded size, used to reject attachments which are too large
+
+        :return: True if the attachment has been stored
+        """
+        if size > self.max_bytes or not KEY_PATTERN.match(key):
+            return False
+
+        if not self._renew(key):
+            self._write(os.path.join(self.directory, f'{key}.{encoding}'), chunks)
+
+        self.cleanup(keep=key)
+        return True
+
+    def _find(self, key: str) -> str | None:
+        for name in (key, f'{key}.base64', f'{key}.quoted-printable', f'{key}.raw'):
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _renew(self, key: str) -> bool:
+        """Renew the expiry of an already spooled attachment, if there is one."""
+        path = self._find(key)
+        if path is None:
+            return False
+        try:
+            os.utime(path)
+        except OSError:
+            return False  # Removed by another process in the meantime
+        return True
+
+    def _write(self, path: str, chunks):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+
+    def path(self, key: str) -> str | None:
+        """
+        Get the path of a spooled attachment.
+
+        :param key: The key returned by put
+
+        :return: The path of the file or None if the key is invalid, unknown or expired
+        """
+        if not KEY_PATTERN.match(key):
+            return None
+
+        path = self._find(key)
+        try:
+            if path is None or os.path.getmtime(path) + self.ttl < time.time():
+                return None
+        except OSError:
+            return None
+
+        encoding = ENTRY_PATTERN.match(os.path.basename(path)).group(2)
+        if encoding:
+            path = self._decode(key, path, encoding)
+        return path
+
+    def _decode(self, key: str, encoded_path: str, encoding: str) -> str | None:
+        """Decode a transfer-encoded attachment in chunks and replace it with the result."""
+        path = os.path.join(self.directory, key)
+        try:
+            with open(encoded_path, 'rb') as f:
+                self._write(path, decode_payload(iter(lambda: f.read(64 * 1024), b''), encoding))
+        except FileNotFoundError:
+            # Another process decoded it at the same time
+            return path if os.path.exists(path) else None
+        self._remove(encoded_path)
+        return path
+
+    def cleanup(self, keep: str = None):
+        """
+        Remove expired attachments, then the oldest ones until the spool fits into max_bytes.
+
+        :param keep: Key of an attachment which must not be evicted
+        """
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue  # Removed by another process in the meantime
+            match = ENTRY_PATTERN.match(entry.name)
+            is_stale_tmp = entry.name.startswith('.tmp-') and stat.st_mtime + self.ttl < now
+            if is_stale_tmp or (match and stat.st_mtime + self.ttl < now):
+                self._remove(entry.path)
+            elif match:
+                entries.append((stat.st_mtime, stat.st_size, entry.path, match.group(1)))
+
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, path, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key != keep:
+                self._remove(path)
+                total -= size
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,29 @@
+document.addEventListener("DOMContentLoaded", function () {
+    const progress = document.getElementById("jobProgress");
+    const error = document.getElementById("jobError");
+    if (!progress) {
+        return;
+    }
+
+    const source = new EventSource(progress.dataset.events);
+
+    source.addEventListener("progress", function (event) {
+        const stage = JSON.parse(event.data).stage;
+        const item = progress.querySelector('[data-stage="' + stage + '"]');
+        if (item) {
+            item.classList.add("list-group-item-success");
+        }
+    });
+
+    // The finished result is rendered by the job page itself
+    source.addEventListener("done", function () {
+        source.close();
+        window.location.reload();
+    });
+
+    source.addEventListener("failed", function (event) {
+        source.close();
+        error.textContent = JSON.parse(event.data).error;
+        error.style.display = "block";
+    });
+});
@@ -0,0 +1,47 @@
+document.addEventListener("DOMContentLoaded", function () {
+    function appendHeaders(table, rows) {
+        rows.forEach(function (row) {
+            const tr = document.createElement("tr");
+            const th = document.createElement("th");
+            const td = document.createElement("td");
+            th.textContent = row[0];
+            td.textContent = row[1];
+            tr.append(th, td);
+            table.append(tr);
+        });
+    }
+
+    document.querySelectorAll(".load-more").forEach(function (button) {
+        button.addEventListener("click", function () {
+            const target = document.getElementById(button.dataset.target);
+            const url = new URL(button.dataset.url, window.location.href);
+            url.searchParams.set("offset", button.dataset.offset);
+            button.disabled = true;
+
+            fetch(url)
+                .then(function (response) {
+                    if (!response.ok) {
+                        throw new Error("The result has expired, please analyze the mail again.");
+                    }
+                    return response.json();
+                })
+                .then(function (data) {
+                    if (button.dataset.kind === "headers") {
+                        appendHeaders(target, data.rows);
+                    } else {
+                        target.append(document.createTextNode(data.content));
+                    }
+
+                    if (data.next === null) {
+                        button.remove();
+                    } else {
+                        button.dataset.offset = data.next;
+                        button.disabled = false;
+                    }
+                })
+                .catch(function (error) {
+                    button.textContent = error.message;
+                });
+        });
+    });
+});
@@ -21,13 +21,33 @@ document.addEventListener("DOMContentLoaded", function () {
 
         var latlngs = [];
 
+        // The values come from the geolocation services, so the popup is built from text nodes
+        function buildPopup(location) {
+            var popup = document.createElement("div");
+            var title = document.createElement("b");
+            title.textContent = "IP: " + location.ip;
+            popup.append(title);
+
+            var lines = ["Lat: " + location.latitude, "Lon: " + location.longitude];
+            if (location.country) {
+                lines.push("Country: " + location.country);
+            }
+            if (location.asn) {
+                lines.push("ASN: AS" + location.asn + " " + (location.organization || ""));
+            }
+            lines.forEach(function (line) {
+                popup.append(document.createElement("br"), document.createTextNode(line));
+            });
+            return popup;
+        }
+
         // Add a marker for each location in the locations array
         locations.forEach(function (location) {
+            var popup = buildPopup(location);
+
             L.marker([location.latitude, location.longitude])
                 .addTo(map)
-                .bindPopup(
-                    `<b>IP: ${location.ip}</b><br>Lat: ${location.latitude}<br>Lon: ${location.longitude}`
-                );
+                .bindPopup(popup);
 
             latlngs.push([location.latitude, location.longitude]);
         });
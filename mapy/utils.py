@@ -1,24 +1,28 @@
 # Certain parts of this code are adapted from CyberDefenders' MHA project.
 # Original source: https://github.com/cyberdefenders/MHA
 
-import base64
+import binascii
+import hashlib
 import re
+import threading
 import time
 
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
 from email.parser import HeaderParser
 from email import message_from_string
 from email.message import Message
 from email.utils import parseaddr
 
-import dateutil.parser
-import pygal
-import requests
-
-from bs4 import BeautifulSoup
-from pygal.style import Style
+from functools import lru_cache
+from html.parser import HTMLParser
 from typing import Optional
 
+from mapy import metrics, profiling
+from mapy.chart import downsample, render_horizontal_bar_chart
+from mapy.geolocation import get_country_from_ip, get_geolocation_providers, lookup_geolocation
+
 
 def try_parse_date(date_str: str) -> datetime:
     """
@@ -28,6 +32,8 @@ def try_parse_date(date_str: str) -> datetime:
 
     :return: A datetime object or None if parsing fails
     """
+    import dateutil.parser  # Only needed for dates the RFC 5322 fast path doesn't understand
+
     try:
         return dateutil.parser.parse(date_str, fuzzy=True)
     except ValueError:
@@ -51,9 +57,60 @@ def extract_and_parse_date(line: str, regex: str) -> datetime:
     return None
 
 
-def parse_date(line: str) -> datetime:
+MONTHS = {
+    'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5, 'jun': 6,
+    'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10, 'nov': 11, 'dec': 12
+}
+
+# Dates as described in RFC 5322 (and RFC 2822), e.g. 'Thu, 4 Jul 2024 10:42:48 +0200 (CEST)'
+RFC_5322_DATE = re.compile(r"""
+    \s*(?:[a-z]{3},\s*)?                                    # Optional day of the week
+    (\d{1,2})\s+([a-z]{3})\s+(\d{4})\s+                     # Day, month and year
+    (\d{1,2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6}))?)?          # Time with optional seconds and fraction
+    (?:\s+(?:([+-])(\d{2})(\d{2})|(ut|utc|gmt|z)))?          # Optional numeric or universal time zone
+    \s*(?:\([^()]*\))?\s*$                                   # Optional comment like '(PDT)'
+    """, re.X | re.I)
+
+
+def parse_rfc5322_date(date_str: str) -> datetime | None:
+    """
+    Strictly parses a date in the common RFC 5322 format. This is much faster than
+    dateutil's fuzzy parsing, which is only needed for the more exotic formats.
+
+    :param date_str: A date string to parse
+
+    :return: A datetime object or None if the string isn't in RFC 5322 format
     """
-    Parses the date from a line of text from the email header.
+    match = RFC_5322_DATE.match(date_str)
+    if not match:
+        return None
+
+    day, month, year, hour, minute, second, fraction, sign, tz_hours, tz_minutes, utc = match.groups()
+    month = MONTHS.get(month.lower())
+    if month is None:
+        return None
+
+    if sign:
+        offset = timedelta(hours=int(tz_hours), minutes=int(tz_minutes))
+        tzinfo = timezone(-offset if sign == '-' else offset) if offset else timezone.utc
+    elif utc:
+        tzinfo = timezone.utc
+    else:
+        tzinfo = None
+
+    try:
+        return datetime(
+            int(year), month, int(day), int(hour), int(minute), int(second or 0),
+            int(fraction.ljust(6, '0')) if fraction else 0, tzinfo=tzinfo
+        )
+    except ValueError:
+        return None
+
+
+def parse_date_fuzzy(line: str) -> datetime:
+    """
+    Parses the date from a line of text from the email header with dateutil's fuzzy
+    parsing and a few fallbacks for the most exotic formats.
 
     :param line: A line of text from the email header
 
@@ -72,24 +129,75 @@ def parse_date(line: str) -> datetime:
     return result
 
 
-def get_header_value(h: str, data: str, rex: str = r'\s*(.*?)(?:\n\S+:|$)') -> str | None:
+@lru_cache(maxsize=8192)
+def parse_date(line: str) -> datetime:
+    """
+    Parses the date from a line of text from the email header. The common RFC 5322
+    format is parsed directly, everything else falls back to fuzzy parsing. Results
+    are memoized, since the same timestamps show up in many hops and mails.
+
+    :param line: A line of text from the email header
+
+    :return: A datetime object
+    """
+    return parse_rfc5322_date(line) or parse_date_fuzzy(line)
+
+
+# A header line starts with a field name followed by a colon and whitespace. Indented lines
+# are accepted as well, since pasted headers are often indented by the mail client.
+HEADER_FIELD = re.compile(r'[ \t]*([A-Za-z0-9][A-Za-z0-9_-]*)[ \t]*:(?:[ \t]|$)')
+# A line which is empty or only has whitespace, it separates the header block from the body
+HEADER_BLOCK_END = re.compile(r'^[^\S\n]*$', re.M)
+
+
+def build_header_index(mail_data: str) -> dict:
+    """
+    Build an index of the header block of the email data. The block ends at the first empty
+    line and only it is split into lines, so the body and attachments are neither copied nor
+    looked at. Folded lines are unfolded and the names are lowercased,
+    values keep the order in which they appear.
+
+    :param mail_data: Raw email data
+
+    :return: A dictionary like {'received': ['from a by b; date', ...], 'subject': ['Hello']}
+    """
+    end = HEADER_BLOCK_END.search(mail_data)
+    index = {}
+    parts = None
+    for line in mail_data[:end.start() if end else len(mail_data)].split('\n'):
+        line = line.rstrip('\r')
+        if not line.strip():
+            break
+
+        match = HEADER_FIELD.match(line)
+        if match:
+            parts = [line[match.end():].strip()]
+            index.setdefault(match.group(1).lower(), []).append(parts)
+        elif parts is not None and line[0] in ' \t':
+            # Continuation of a folded header line
+            parts.append(line.strip())
+
+    return {name: [' '.join(filter(None, parts)) for parts in values] for name, values in index.items()}
+
+
+def get_header_value(h: str, data: str | dict) -> str | None:
     """
     This function takes a header name and the email header data and
     returns the value of the header. For 'from', 'to', or 'cc' headers,
     it validates if the value is a valid email address.
 
     :param h: The header name
-    :param data: The email header data
-    :param rex: The regular expression pattern for matching the header value
+    :param data: The email header data or a header index built by build_header_index
 
     :return: The value of the header or None if not found or invalid email
     """
-    matches = re.findall(f'{h}:{rex}', data, re.X | re.DOTALL | re.I)
+    index = data if isinstance(data, dict) else build_header_index(data)
+    values = index.get(h.lower())
     
-    if not matches:
+    if not values:
         return None
     
-    header_value = matches[0].strip()
+    header_value = values[0].strip()
     
     if h.lower() not in {'from', 'to', 'cc'}:
         return header_value
@@ -99,97 +207,105 @@ def get_header_value(h: str, data: str, rex: str = r'\s*(.*?)(?:\n\S+:|$)') -> s
     return header_value if re.match(r'^[^@]+@[^@]+\.[^@]+$', email) else None
 
 
-def parse_received_headers(mail_data: str) -> list:
+def parse_mail(mail_data: str) -> Message:
+    """
+    Parse the raw email data once, so that all processing stages can share the result
+    instead of parsing the same text over and over again.
+
+    :param mail_data: Raw email data
+
+    :return: The parsed message
+    """
+    return message_from_string(mail_data)
+
+
+def parse_received_headers(mail_data: str, msg: Message = None) -> list:
     """
     Parse the Received headers from email data.
 
     :param mail_data: Raw email data containing headers
+    :param msg: The already parsed message, if available
 
     :return: A list of Received headers
     """
-    n = HeaderParser().parsestr(mail_data)
+    n = msg if msg is not None else HeaderParser().parsestr(mail_data)
     received = n.get_all('Received')
     if received:
         # Filter headers containing 'from' or 'by'
         received = [i for i in received if ('from' in i or 'by' in i)]
     else:
-        # Regex to find 'Received' headers in raw mail data
-        received = re.findall(
-            r'Received:\s*(.*?)\n\S+:\s+', mail_data, re.X | re.DOTALL | re.I
-        )
+        # Find 'Received' headers in the raw mail data with the more lenient header index
+        received = build_header_index(mail_data).get('received', [])
     return received
 
 
-def parse_header_line(header_line: str) -> list:
-    """
-    Parse a single Received header line.
+RECEIVED_CLAUSES = ('from', 'by', 'via', 'with', 'id', 'for')
+
+# Tokens of a Received header. Every alternative consumes a fixed set of characters without
+# nested repetition, so tokenizing never backtracks and runs in linear time.
+RECEIVED_TOKEN = re.compile(r'\\.|[()<>";]|[^\s()<>";\\]+|\s+')
+
+
+def tokenize_received(value: str) -> dict:
+    """
+    Split a Received header into its clauses (from, by, via, with, id, for) and the date in a
+    single pass. Keywords are only recognized outside of comments, quoted strings and angle
+    brackets, so '(from a by b)' stays part of the surrounding clause. The runtime is linear
+    in the length of the header, regardless of how malformed it is.
+
+    :param value: The value of a Received header
+
+    :return: A dictionary with the clauses and the date, missing parts are empty strings
+    """
+    result = dict.fromkeys(RECEIVED_CLAUSES + ('date',), '')
+    spans = []  # (clause, end of the keyword) of the clauses in the order they appear
+    depth = 0  # Nesting depth of comments
+    quoted = angle = False
+    date_start = last_semicolon = None
+
+    for match in RECEIVED_TOKEN.finditer(value):
+        token = match.group()
+        if token == ';':
+            last_semicolon = match.end()
+        if quoted:
+            quoted = token != '"'
+        elif depth:
+            depth += 1 if token == '(' else -1 if token == ')' else 0
+        elif angle:
+            angle = token != '>'
+        elif token == '(':
+            depth = 1
+        elif token == '"':
+            quoted = True
+        elif token == '<':
+            angle = True
+        elif token == ';':
+            date_start = match.end()
+            break
+        elif token.lower() in RECEIVED_CLAUSES:
+            spans.append((token.lower(), match.end()))
+
+    if date_start is None and (depth or quoted or angle):
+        # An unterminated comment, quoted string or angle bracket ran to the end of the header,
+        # the last semicolon in it is most likely the one in front of the date
+        date_start = last_semicolon
+
+    end = len(value) if date_start is None else date_start - 1
+    parts = {}
+    for i, (clause, start) in enumerate(spans):
+        # The clause ends where the next keyword begins
+        stop = spans[i + 1][1] - len(spans[i + 1][0]) if i + 1 < len(spans) else end
+        parts.setdefault(clause, []).extend(value[start:stop].split())
+    for clause, words in parts.items():
+        result[clause] = ' '.join(words)
+
+    if date_start is not None:
+        result['date'] = ' '.join(value[date_start:].split())
+    elif '\n' in value.strip():
+        # Without a semicolon, the date is usually on the last line of a folded header
+        result['date'] = value.strip().rsplit('\n', 1)[-1].strip()
 
-    :param header_line: A single Received header line
-
-    :return: A list of parts of the header line
-    """
-    if ';' in header_line:
-        line = header_line.split(';')
-    else:
-        line = header_line.split('\r\n')
-    line = list(map(str.strip, line))
-    line = [x.replace('\r\n', ' ') for x in line]
-    return line
-
-
-def get_next_line(received: list, index: int) -> list:
-    """
-    Get the next line of Received headers, if available.
-
-    :param received: List of Received headers
-    :param index: Current index
-
-    :return: Next line of Received headers
-    """
-    try:
-        if ';' in received[index + 1]:
-            next_line = received[index + 1].split(';')
-        else:
-            next_line = received[index + 1].split('\r\n')
-        next_line = list(map(str.strip, next_line))
-        next_line = [x.replace('\r\n', '') for x in next_line]
-    except IndexError:
-        next_line = None
-    return next_line
-
-
-def extract_direction_info(line: list) -> list:
-    """
-    Extract direction information from a header line.
-
-    :param line: A list of parts of the header line
-
-    :return: Extracted direction information
-    """
-    if line[0].startswith('from'):
-        data = re.findall(
-            r"""
-            from\s+
-            (.*?)\s+
-            by\s+(.*?)
-            (?:
-                (?:with|via)
-                (.*?)
-                (?:\sid\s|$)
-                |\sid\s|$
-            )""", line[0], re.DOTALL | re.X)
-    else:
-        data = re.findall(
-            r"""
-            ()by
-            (.*?)
-            (?:
-                (?:with|via)
-                (.*?)
-                (?:\sid\s|$)
-                |\sid\s
-            )""", line[0], re.DOTALL | re.X)
-    return data
+    return result
 
 
 def calculate_delay(org_time: datetime, next_time: datetime) -> int:
@@ -245,29 +361,28 @@ def calculate_total_delay(data: dict) -> int:
     return sum([x['Delay'] for x in list(data.values())])
 
 
-def create_chart(graph: list, total_delay: int) -> str:
+CHART_MAX_BARS = 20
+
+
+def create_chart(graph: list, total_delay: int, max_bars: int = CHART_MAX_BARS) -> str:
     """
-    Create a Pygal chart from graph data.
+    Create a horizontal bar chart from graph data. Long hop chains are downsampled, so
+    the chart never has more than max_bars bars.
 
     :param graph: Graph data for visualization
     :param total_delay: Total delay to display on the chart
+    :param max_bars: Maximum number of bars, the hops with the smallest delays are combined beyond that
 
-    :return: Rendered chart as a unicode string
+    :return: Rendered chart as an SVG string
     """
-    custom_style = Style(
-        background='transparent',
-        plot_background='transparent',
-        font_family='system-ui',
-    )
-    line_chart = pygal.HorizontalBar(
-        style=custom_style, height=250, legend_at_bottom=True,
-        tooltip_border_radius=10)
-    line_chart.tooltip_fancy_mode = False
-    line_chart.title = 'Total Delay is: %s s' % total_delay
-    line_chart.x_title = 'Delay in seconds.'
-    for i in graph:
-        line_chart.add(i[0], i[1])
-    return line_chart.render(is_unicode=True)
+    bars = downsample([(label, delay) for label, delay in graph], max_bars)
+    return render_horizontal_bar_chart('Total Delay is: %s s' % total_delay, 'Delay in seconds.', tuple(bars))
+
+
+SUMMARY_HEADERS = [
+    ('From', 'From'), ('To', 'To'), ('Cc', 'Cc'),
+    ('Subject', 'Subject'), ('MessageID', 'Message-ID'), ('Date', 'Date')
+]
 
 
 def extract_email_summary(headers: HeaderParser, mail_data: str) -> dict:
@@ -279,55 +394,71 @@ def extract_email_summary(headers: HeaderParser, mail_data: str) -> dict:
 
     :return: Email summary information as a dictionary
     """
-    return {
-        'From': headers.get('From') or get_header_value('from', mail_data),
-        'To': headers.get('to') or get_header_value('to', mail_data),
-        'Cc': headers.get('cc') or get_header_value('cc', mail_data),
-        'Subject': headers.get('Subject') or get_header_value('Subject', mail_data),
-        'MessageID': headers.get('Message-ID') or get_header_value('Message-ID', mail_data),
-        'Date': headers.get('Date') or get_header_value('Date', mail_data),
-    }
+    summary = {}
+    index = None
+    for key, name in SUMMARY_HEADERS:
+        value = headers.get(name)
+        if not value:
+            # The header parser gave up on this one, so fall back to the more lenient index
+            if index is None:
+                index = build_header_index(mail_data)
+            value = get_header_value(name, index)
+        summary[key] = value
+    return summary
 
 
-def process_email_headers(mail_data: str) -> tuple:
+def process_email_headers(mail_data: str, msg: Message = None, max_bars: int = CHART_MAX_BARS,
+                          render_chart: bool = True) -> tuple:
     """
     Process email headers and generate graph data.
 
     :param mail_data: Raw email data
+    :param msg: The already parsed message, if available
+    :param max_bars: Maximum number of bars in the chart
+    :param render_chart: Whether to render the chart, it's None otherwise
 
     :return: Processed data, delay status, email summary, parsed headers, and chart
     """
-    received = parse_received_headers(mail_data)
-    headers = HeaderParser().parsestr(mail_data)
+    headers = msg if msg is not None else HeaderParser().parsestr(mail_data)
+    with metrics.stage('received'):
+        received = parse_received_headers(mail_data, headers)
+        hops = [tokenize_received(value) for value in received]
+    metrics.count('hops', len(hops))
+
+    with metrics.stage('dates'):
+        times = [parse_date(hop['date']) for hop in hops]
+
     data = {}
     c = len(received)
 
-    for i in range(len(received)):
-        line = parse_header_line(received[i])
-        next_line = get_next_line(received, i)
+    for i, hop in enumerate(hops):
+        org_time = times[i]
+        next_time = times[i + 1] if i + 1 < len(times) and times[i + 1] else org_time
 
-        org_time = parse_date(line[-1])
-        next_time = parse_date(next_line[-1]) if next_line else org_time
+        # Skip hops without a readable date or without any direction information
+        if org_time is None or not (hop['from'] or hop['by']):
+            continue
 
-        direction_info = extract_direction_info(line)
         delay = calculate_delay(org_time, next_time)
 
-        try:
-            ftime = format_time(org_time)
-            data[c] = {
-                'Timestamp': org_time,
-                'Time': ftime,
-                'Delay': delay,
-                'Direction': [x.replace('\n', ' ') for x in list(map(str.strip, direction_info[0]))]
-            }
-            c -= 1
-        except IndexError:
-            pass
+        direction = [hop['from'], hop['by'], hop['with'] or hop['via']]
+        data[c] = {
+            'Timestamp': org_time,
+            'Time': format_time(org_time),
+            'Delay': delay,
+            'Direction': direction,
+            # Countries of the 'from' and 'by' hosts, looked up once here instead of in the template
+            'Country': [get_country_from_ip(direction[0]), get_country_from_ip(direction[1])]
+        }
+        c -= 1
 
     graph = build_graph_data(data)
     total_delay = calculate_total_delay(data)
     delayed = bool(total_delay)
-    chart = create_chart(graph, total_delay)
+    chart = None
+    if render_chart:
+        with metrics.stage('chart'):
+            chart = create_chart(graph, total_delay, max_bars)
 
     summary = extract_email_summary(headers, mail_data)
 
@@ -354,59 +485,88 @@ def extract_ip_addresses(mail_data: str) -> list:
     return list(set(ipv4_matches + ipv6_matches))
 
 
+GEOLOCATION_TOTAL_TIMEOUT = 10  # Upper bound for all lookups of one mail in seconds
+GEOLOCATION_MAX_WORKERS = 8
+
+_geolocation_executor = None
+_geolocation_lock = threading.Lock()
+
+
+def get_geolocation_executor() -> ThreadPoolExecutor:
+    """
+    Get the shared, bounded worker pool used for geolocation lookups.
+
+    :return: The shared thread pool executor
+    """
+    global _geolocation_executor
+    with _geolocation_lock:
+        if _geolocation_executor is None:
+            _geolocation_executor = ThreadPoolExecutor(
+                max_workers=GEOLOCATION_MAX_WORKERS, thread_name_prefix='mapy-geo')
+        return _geolocation_executor
+
+
 def fetch_geolocation(ip: str) -> dict | None:
     """
-    Fetch geolocation data for a given IP address.
+    Fetch geolocation data for a given IP address from the configured providers.
 
     :param ip: The IP address
 
     :return: A dictionary containing latitude, longitude, and IP address
     """
-    try:
-        response = requests.get(f'https://ipapi.co/{ip}/json/')
-        data = response.json()
-        if 'latitude' in data and 'longitude' in data:
-            return {
-                'ip': ip,
-                'latitude': data['latitude'],
-                'longitude': data['longitude']
-            }
-    except requests.RequestException as e:
-        print(f"Error fetching geolocation for IP {ip}: {e}")
-
-    return None
+    return lookup_geolocation(ip)
 
 
-def extract_ip_geolocations(mail_data: str) -> list:
+def extract_ip_geolocations(mail_data: str, timeout: float = GEOLOCATION_TOTAL_TIMEOUT) -> list:
     """
-    Extract IP addresses from mail data and fetch their geolocations.
+    Extract IP addresses from mail data and fetch their geolocations. The lookups run
+    concurrently on a bounded worker pool, so the total time is close to the slowest
+    lookup instead of the sum of all of them.
 
     :param mail_data: The raw mail data containing headers
+    :param timeout: Upper bound in seconds for all lookups together, unfinished lookups are dropped
 
     :return: A list of dictionaries with IP, latitude, and longitude
     """
     ip_addresses = extract_ip_addresses(mail_data)
-    geolocations = []
+    metrics.count('ips', len(ip_addresses))
+    if not ip_addresses:
+        return []
+
+    # Local databases answer in microseconds, a worker pool would only add overhead
+    if all(provider.is_local for provider in get_geolocation_providers()):
+        return [location for location in map(fetch_geolocation, ip_addresses) if location]
 
-    for ip in ip_addresses:
-        location = fetch_geolocation(ip)
-        if location:
-            geolocations.append(location)
+    executor = get_geolocation_executor()
+    lookup = profiling.wrap(fetch_geolocation)
+    futures = [executor.submit(lookup, ip) for ip in ip_addresses]
+    done, not_done = wait(futures, timeout=timeout)
+
+    for future in not_done:
+        future.cancel()
+
+    geolocations = []
+    for future in futures:
+        # Keep the order of the IP addresses and skip failed or unfinished lookups
+        if future in done and future.exception() is None and future.result():
+            geolocations.append(future.result())
 
     return geolocations
 
 
 # --- Extract message and attachment data --- #
 
-def extract_message_data(mail_data: str) -> tuple:
+def extract_message_data(mail_data: str, msg: Message = None) -> tuple:
     """
     Extract and decode message data from email content, including attachment names and paths.
 
     :param mail_data: Raw email data
+    :param msg: The already parsed message, if available
 
     :return: A tuple containing a list of message data and attachment info (filename and file path)
     """
-    msg = message_from_string(mail_data)
+    if msg is None:
+        msg = parse_mail(mail_data)
     messages = []
     attachments = []
 
@@ -414,6 +574,7 @@ def extract_message_data(mail_data: str) -> tuple:
 
     if msg.is_multipart():
         for part in msg.walk():
+            metrics.count('parts', 1)
             content_type = part.get_content_type()
             content_disposition = str(part.get("Content-Disposition"))
 
@@ -421,6 +582,7 @@ def extract_message_data(mail_data: str) -> tuple:
                 attachment_info = process_attachment(part)
                 if attachment_info:
                     attachments.append(attachment_info)
+                    metrics.count('attachment_bytes', attachment_info['length'])
 
             elif content_type in ['text/plain', 'text/html']:
                 message_info = process_message_part(part, email_date, content_type)
@@ -428,6 +590,7 @@ def extract_message_data(mail_data: str) -> tuple:
                     messages.append(message_info)
 
     else:
+        metrics.count('parts', 1)
         content_type = msg.get_content_type()
         message_info = process_message_part(msg, email_date, content_type)
         if message_info:
@@ -453,7 +616,11 @@ def process_message_part(part: Message, email_date: str, content_type: str) -> O
 
     try:
         decoded_payload = payload.decode(charset, errors='replace')
-        clean_text = extract_text_from_html(decoded_payload) if content_type == 'text/html' else decoded_payload
+        if content_type == 'text/html':
+            with metrics.stage('html'):
+                clean_text = extract_text_from_html(decoded_payload)
+        else:
+            clean_text = decoded_payload
 
         return {
             'date': email_date,
@@ -485,35 +652,324 @@ def filter_duplicate_messages(messages: list) -> list:
     return list(filtered_messages.values())
 
 
-def extract_text_from_html(html_content: str) -> str:
-    """
-    Extract and clean text from HTML content.
+HTML_TEXT_MAX_CHARS = 1000000  # Text extracted from a single HTML part, the rest is dropped
+HTML_FEED_SIZE = 64 * 1024
+
+# Content of these tags is never shown as text
+HTML_SKIPPED_TAGS = {'script', 'style', 'template', 'noscript'}
+# Number of line breaks around block elements, everything else is inline
+HTML_BLOCK_TAGS = {
+    'br': 1, 'li': 1, 'tr': 1, 'dt': 1, 'dd': 1, 'option': 1,
+    'p': 2, 'div': 2, 'title': 2, 'table': 2, 'ul': 2, 'ol': 2, 'dl': 2, 'blockquote': 2,
+    'pre': 2, 'hr': 2, 'h1': 2, 'h2': 2, 'h3': 2, 'h4': 2, 'h5': 2, 'h6': 2,
+    'section': 2, 'article': 2, 'header': 2, 'footer': 2, 'form': 2,
+}
+# Elements without content, they are never closed
+HTML_VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr'}
+
+
+class HTMLTextExtractor(HTMLParser):
+    """
+    Streaming HTML to text converter. The text is collected while the HTML is parsed, no
+    document tree is built. Whitespace is collapsed and block elements become line breaks.
+    """
+
+    def __init__(self, max_chars: int = HTML_TEXT_MAX_CHARS):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.parts = []
+        self.length = 0
+        self.open_tags = []  # Elements which are open, like a browser closes them when a parent ends
+        self.open_counts = Counter()  # tag -> number of open elements
+        self.skip_depth = 0  # Number of open elements of HTML_SKIPPED_TAGS
+        self.separator = ''  # Whitespace which is written before the next text
+        self.truncated = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in HTML_VOID_TAGS:
+            self.open_tags.append(tag)
+            self.open_counts[tag] += 1
+        if tag in HTML_SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in HTML_BLOCK_TAGS:
+            self._break(HTML_BLOCK_TAGS[tag])
+
+    def handle_endtag(self, tag):
+        # Closing an element also closes the elements left open inside it, so an unclosed
+        # <noscript> or <template> in a malformed mail only hides the text up to its parent's end
+        if self.open_counts[tag]:
+            while True:
+                open_tag = self.open_tags.pop()
+                self.open_counts[open_tag] -= 1
+                if open_tag in HTML_SKIPPED_TAGS:
+                    self.skip_depth -= 1
+                if open_tag == tag:
+                    break
+        if tag in HTML_BLOCK_TAGS and tag != 'br':
+            self._break(HTML_BLOCK_TAGS[tag])
+
+    def handle_data(self, data):
+        if self.skip_depth or self.truncated:
+            return
+
+        text = ' '.join(data.split())
+        if text and data[0].isspace():
+            self._space()
+        if text:
+            self._write(text)
+        if data and data[-1].isspace():
+            self._space()
+
+    def _space(self):
+        if self.parts and not self.separator:
+            self.separator = ' '
+
+    def _break(self, lines: int):
+        if self.parts and self.separator.count('\n') < lines:
+            self.separator = '\n' * lines
+
+    def _write(self, text: str):
+        text = self.separator + text
+        self.separator = ''
+        if self.length + len(text) > self.max_chars:
+            text = text[:self.max_chars - self.length] + '…'
+            self.truncated = True
+        self.parts.append(text)
+        self.length += len(text)
+
+    def get_text(self) -> str:
+        return ''.join(self.parts)
+
+
+def extract_text_from_html(html_content: str, max_chars: int = HTML_TEXT_MAX_CHARS) -> str:
+    """
+    Extract readable text from HTML content. Scripts and styles are dropped, whitespace is
+    collapsed and parsing stops as soon as max_chars characters of text have been found.
 
     :param html_content: HTML content to clean
+    :param max_chars: Maximum length of the text, longer text is cut off and ends with '…'
 
     :return: Extracted plain text
     """
-    soup = BeautifulSoup(html_content, 'html.parser')
-    return soup.get_text()
+    parser = HTMLTextExtractor(max_chars)
+    for start in range(0, len(html_content), HTML_FEED_SIZE):
+        parser.feed(html_content[start:start + HTML_FEED_SIZE])
+        if parser.truncated:
+            break
+    else:
+        parser.close()
+    return parser.get_text()
+
+
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+BASE64_JUNK = re.compile(rb'[^A-Za-z0-9+/]')
+
+
+def iter_encoded_payload(part: Message, chunk_size: int = ATTACHMENT_CHUNK_SIZE) -> tuple:
+    """
+    Get the still transfer-encoded payload of an email part in chunks.
+
+    :param part: The email part
+    :param chunk_size: Size of the chunks in characters
+
+    :return: A tuple (encoding, chunks), where encoding is 'base64', 'quoted-printable' or
+             'raw' and chunks is an iterator of bytes. A forwarded mail (message/rfc822) is
+             serialized, a multipart part has no payload of its own.
+    """
+    payload = part.get_payload()
+    encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+
+    if not isinstance(payload, str):
+        if part.get_content_maintype() == 'message' and payload:
+            # The email package parses an attached mail into a message, the file is the mail itself
+            return 'raw', iter([payload[0].as_bytes()])
+        return 'raw', iter(())
+
+    if encoding not in ('base64', 'quoted-printable', '7bit', '8bit', 'binary', ''):
+        # Rare encodings like uuencode are left to the email package
+        return 'raw', iter([part.get_payload(decode=True) or b''])
+
+    def chunks():
+        for i in range(0, len(payload), chunk_size):
+            chunk = payload[i:i + chunk_size]
+            try:
+                yield chunk.encode('ascii', 'surrogateescape')
+            except UnicodeError:
+                yield chunk.encode('raw-unicode-escape')
+
+    return encoding if encoding in ('base64', 'quoted-printable') else 'raw', chunks()
+
+
+def decode_payload(chunks, encoding: str):
+    """
+    Decode a transfer-encoded payload chunk by chunk, so it never has to be held in memory at once.
+
+    :param chunks: An iterable of transfer-encoded bytes
+    :param encoding: 'base64', 'quoted-printable' or 'raw'
+
+    :return: An iterator of decoded bytes
+    """
+    if encoding == 'base64':
+        rest = b''
+        for chunk in chunks:
+            data = rest + BASE64_JUNK.sub(b'', chunk)
+            n = len(data) // 4 * 4
+            if n:
+                yield binascii.a2b_base64(data[:n])
+            rest = data[n:]
+        if len(rest) > 1:
+            # Be as lenient as the email package with missing padding
+            yield binascii.a2b_base64(rest + b'=' * (-len(rest) % 4))
+    elif encoding == 'quoted-printable':
+        rest = b''
+        for chunk in chunks:
+            data = rest + chunk
+            # Only decode complete lines, an escape sequence never spans lines
+            n = data.rfind(b'\n') + 1
+            if n:
+                yield binascii.a2b_qp(data[:n])
+            rest = data[n:]
+        if rest:
+            yield binascii.a2b_qp(rest)
+    else:
+        yield from chunks
 
 
 def process_attachment(part: Message) -> Optional[dict]:
     """
-    Process an email part as an attachment and return attachment information.
+    Process an email part as an attachment and return attachment information. The payload
+    is decoded in chunks to compute its size and hashes, but the decoded bytes are never kept.
+    The part itself is returned as well, so the payload can be spooled for downloads.
 
     :param part: The email part representing the attachment
 
-    :return: A dictionary containing the attachment's filename, base64 encoded data, and length
+    :return: A dictionary containing the attachment's filename, content type, length, hashes and part
     """
     filename = part.get_filename()
-    if not filename:
+    if not filename or (part.is_multipart() and part.get_content_maintype() != 'message'):
+        # A multipart part only contains other parts, which are processed on their own
         return None
 
-    attachment_data = part.get_payload(decode=True)
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    length = 0
+    encoding, chunks = iter_encoded_payload(part)
+    with metrics.stage('attachments'):
+        for chunk in decode_payload(chunks, encoding):
+            sha256.update(chunk)
+            md5.update(chunk)
+            length += len(chunk)
 
-    encoded_data = base64.b64encode(attachment_data).decode('utf-8')
     return {
         'filename': filename,
-        'data': encoded_data,
-        'length': len(attachment_data)
+        'content_type': part.get_content_type(),
+        'length': length,
+        'sha256': sha256.hexdigest(),
+        'md5': md5.hexdigest(),
+        'part': part
+    }
+
+
+SECURITY_HEADERS = ('Received-SPF', 'Authentication-Results', 'DKIM-Signature', 'ARC-Authentication-Results')
+# Headers shown in the summary or the hop table already
+SUMMARIZED_HEADERS = ('Received', 'Subject', 'From', 'To', 'Message-ID', 'CC', 'Date')
+
+
+def group_headers(headers) -> dict:
+    """
+    Sort the headers of an email into the groups shown on the result page, in a single pass.
+
+    :param headers: The parsed headers (an email.message.Message)
+
+    :return: A dictionary with lists of (name, value) pairs for 'security', 'x' and 'other' headers
+    """
+    groups = {'security': [], 'x': [], 'other': []}
+    for name, value in headers.items():
+        if name in SECURITY_HEADERS:
+            groups['security'].append((name, str(value)))
+        elif name.startswith('X-'):
+            groups['x'].append((name, str(value)))
+        elif name not in SUMMARIZED_HEADERS:
+            groups['other'].append((name, str(value)))
+    return groups
+
+
+# --- Complete analysis --- #
+
+def analyze_mail(mail_data: str, geolocate: bool = True, render_chart: bool = True,
+                 max_bars: int = CHART_MAX_BARS, progress=None) -> dict:
+    """
+    Run the complete analysis of an email. The mail is parsed once and the result is shared by all stages.
+
+    :param mail_data: Raw email data
+    :param geolocate: Whether to look up the locations of the IP addresses
+    :param render_chart: Whether to render the delay chart
+    :param max_bars: Maximum number of bars in the chart
+    :param progress: Optional callable which is called with the name of every finished stage
+                     ('headers', 'geolocation' and 'messages')
+
+    :return: A dictionary with the hops ('data'), delay status, summary, parsed headers, chart,
+             locations, messages, and attachments
+    """
+    progress = progress or (lambda stage: None)
+
+    with metrics.stage('parse'):
+        msg = parse_mail(mail_data)
+    with metrics.stage('headers'):
+        data, delayed, summary, headers, chart = process_email_headers(mail_data, msg, max_bars, render_chart)
+    progress('headers')
+    with metrics.stage('geolocation'):
+        locations = extract_ip_geolocations(mail_data) if geolocate else []
+    progress('geolocation')
+    with metrics.stage('messages'):
+        messages, attachments = extract_message_data(mail_data, msg)
+    progress('messages')
+
+    return {
+        'data': data,
+        'delayed': delayed,
+        'summary': summary,
+        'headers': headers,
+        'chart': chart,
+        'locations': locations,
+        'messages': messages,
+        'attachments': attachments
+    }
+
+
+def serialize_analysis(result: dict, ips: list) -> dict:
+    """
+    Convert the result of analyze_mail into JSON-serializable data.
+
+    :param result: The result of analyze_mail
+    :param ips: The IP addresses found in the email
+
+    :return: A dictionary with hops, delays, summary, IP addresses, headers, messages and attachments
+    """
+    hops = []
+    for hop, info in sorted(result['data'].items()):
+        hops.append({
+            'hop': hop,
+            'from': info['Direction'][0],
+            'by': info['Direction'][1],
+            'with': info['Direction'][2],
+            'time': info['Timestamp'].isoformat(),
+            'delay': info['Delay'],
+            'from_country': info['Country'][0],
+            'by_country': info['Country'][1]
+        })
+
+    return {
+        'hops': hops,
+        'delayed': result['delayed'],
+        'total_delay': sum(hop['delay'] for hop in hops),
+        'summary': {key: str(value) if value is not None else None for key, value in result['summary'].items()},
+        'ips': sorted(ips),
+        'locations': result['locations'],
+        'headers': [[name, str(value)] for name, value in result['headers'].items()],
+        'messages': result['messages'],
+        'attachments': [
+            {key: value for key, value in attachment.items() if key != 'part'}
+            for attachment in result['attachments']
+        ]
     }
@@ -4,11 +4,15 @@ from mapy.app import create_app
 
 
 @pytest.fixture
-def app():
-    app = create_app()
+def app(tmp_path):
+    app = create_app({
+        'GEOLOCATION_CACHE_PATH': None,
+        'ATTACHMENT_SPOOL_DIR': str(tmp_path / 'attachments'),
+        'RESULT_SPOOL_DIR': str(tmp_path / 'results')
+    })
     app.config['TESTING'] = True
     return app
 
 @pytest.fixture()
 def client(app):
-    return app.test_client()
\ No newline at end of file
+    return app.test_client()
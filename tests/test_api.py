@@ -0,0 +1,87 @@
+from mapy.app import create_app
+
+mail = """Received: from client.example.com (client.example.com [192.168.0.1])
+    by mail.example.com with ESMTPS id j0siq34k2i; Fri, 23 Jul 2024 10:21:35 -0700 (PDT)
+Received: from sender.example.org (sender.example.org [192.168.0.2])
+    by client.example.com with SMTP id abc; Fri, 23 Jul 2024 10:20:35 -0700 (PDT)
+From: sender@example.com
+To: recipient@example.com
+Subject: Test Email
+
+This is the body of the email."""
+
+
+# Test a batch is analyzed and every message gets a result
+def test_analyze_batch(client):
+    response = client.post('/api/analyze', json={'messages': [mail, mail], 'geolocate': False})
+    assert response.status_code == 200
+
+    results = response.get_json()['results']
+    assert [result['index'] for result in results] == [0, 1]
+
+    result = results[0]
+    assert [hop['hop'] for hop in result['hops']] == [1, 2]
+    assert result['hops'][1]['from'] == 'client.example.com (client.example.com [192.168.0.1])'
+    assert result['hops'][1]['delay'] == 60
+    assert result['total_delay'] == 60
+    assert result['summary']['Subject'] == 'Test Email'
+    assert result['ips'] == ['192.168.0.1', '192.168.0.2']
+    assert result['messages'][0]['content'] == 'This is the body of the email.'
+    assert result['attachments'] == []
+
+
+# Test a bad message only fails its own entry
+def test_analyze_batch_with_errors(client):
+    response = client.post('/api/analyze', json={'messages': [mail, 42, ''], 'geolocate': False})
+    assert response.status_code == 200
+
+    results = response.get_json()['results']
+    assert 'hops' in results[0]
+    assert 'error' in results[1]
+    assert 'error' in results[2]
+
+
+# Test the stages of the analyses on the worker threads are added to the metrics
+def test_analyze_batch_metrics(client):
+    client.post('/api/analyze', json={'messages': [mail, mail + '\n\nSecond'], 'geolocate': False})
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert 'mapy_stage_duration_seconds_count{stage="headers"} 2\n' in text
+    assert 'mapy_stage_duration_seconds_count{stage="messages"} 2\n' in text
+    assert 'mapy_mail_hops_sum 4\n' in text
+    assert 'mapy_request_duration_seconds_count{endpoint="api.analyze"} 1\n' in text
+
+
+# Test invalid requests and batches which are too large are rejected
+def test_analyze_invalid_request(app, client):
+    assert client.post('/api/analyze', data='no json').status_code == 400
+    assert client.post('/api/analyze', json={'messages': mail}).status_code == 400
+
+    app.config['API_MAX_BATCH'] = 1
+    assert client.post('/api/analyze', json={'messages': [mail, mail]}).status_code == 413
+
+
+# Test the same mail is only analyzed once and the cache statistics are exposed
+def test_result_cache(client):
+    client.post('/api/analyze', json={'messages': [mail], 'geolocate': False})
+    client.post('/api/analyze', json={'messages': [mail.replace('\n', '\r\n')], 'geolocate': False})
+
+    stats = client.get('/api/stats').get_json()
+    assert stats['result_cache']['misses'] == 1
+    assert stats['result_cache']['hits'] == 1
+    assert stats['result_cache']['entries'] == 1
+    assert stats['geolocation_cache'] is None
+
+
+# Test the statistics of the geolocation cache are exposed
+def test_geolocation_cache_stats(tmp_path):
+    app = create_app({
+        'GEOLOCATION_CACHE_PATH': str(tmp_path / 'geo.sqlite3'),
+        'ATTACHMENT_SPOOL_DIR': str(tmp_path / 'attachments'),
+        'RESULT_SPOOL_DIR': str(tmp_path / 'results')
+    })
+    app.extensions['geolocation_cache'].set('192.0.2.1', {'ip': '192.0.2.1', 'latitude': 1.0, 'longitude': 2.0})
+    app.extensions['geolocation_cache'].get('192.0.2.1')
+
+    stats = app.test_client().get('/api/stats').get_json()['geolocation_cache']
+    assert stats == {'hits': 1, 'misses': 0, 'hit_rate': 1.0, 'entries': 1}
@@ -0,0 +1,79 @@
+import logging
+import subprocess
+import sys
+import tracemalloc
+
+from mapy.app import create_app, preload
+
+
+def make_app(tmp_path, **config):
+    return create_app({
+        'GEOLOCATION_CACHE_PATH': None,
+        'ATTACHMENT_SPOOL_DIR': str(tmp_path / 'attachments'),
+        'RESULT_SPOOL_DIR': str(tmp_path / 'results'),
+        **config
+    })
+
+
+# Test the secret key is read from the configuration, so all workers share it
+def test_secret_key(tmp_path):
+    assert make_app(tmp_path, SECRET_KEY='shared').secret_key == 'shared'
+
+
+# Test the secret key can be read from a file, e.g. a Docker secret
+def test_secret_key_file(tmp_path):
+    key_file = tmp_path / 'secret'
+    key_file.write_text('from-file\n')
+    assert make_app(tmp_path, SECRET_KEY_FILE=str(key_file)).secret_key == b'from-file'
+
+
+# Test a random secret key is generated without configuration
+def test_random_secret_key(tmp_path):
+    assert len(make_app(tmp_path).secret_key) == 24
+
+
+# Test the templates are compiled by the preload
+def test_preload(tmp_path):
+    app = make_app(tmp_path)
+    preload(app)
+    assert app.jinja_env.cache
+    assert any(key[1] == 'result.html' for key in app.jinja_env.cache.keys())
+
+
+# Test heavy dependencies are only imported when they are needed
+def test_lazy_imports():
+    code = (
+        "import sys, mapy.app, mapy.cli; "
+        "print(' '.join(m for m in ('dateutil', 'geoip2', 'requests', 'IPy') if m in sys.modules))"
+    )
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    assert output.strip() == ''
+
+
+# Test the dependencies which are imported lazily are loaded by the preload, before the workers are forked
+def test_preload_imports(tmp_path):
+    code = (
+        "import sys; from mapy.app import create_app, preload; "
+        f"app = create_app({{'GEOLOCATION_CACHE_PATH': None, 'ATTACHMENT_SPOOL_DIR': {str(tmp_path / 'a')!r}, "
+        f"'RESULT_SPOOL_DIR': {str(tmp_path / 'r')!r}, 'SECRET_KEY': 'test'}}); "
+        "preload(app); "
+        "print(' '.join(m for m in ('dateutil.parser', 'geoip2.database', 'requests', 'IPy') if m not in sys.modules))"
+    )
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    assert output.strip() == ''
+
+
+# Test the memory of the stages is accounted, sent with the timings and logged when enabled
+def test_memory_accounting(tmp_path, caplog):
+    app = make_app(tmp_path, MEMORY_ACCOUNTING=True, WTF_CSRF_ENABLED=False)
+    try:
+        assert tracemalloc.is_tracing()
+        with caplog.at_level(logging.INFO, logger=app.logger.name):
+            response = app.test_client().post('/', data={'headers': "From: sender@example.com\n\nBody"})
+    finally:
+        tracemalloc.stop()
+
+    assert response.status_code == 200
+    assert 'parse;dur=' in response.headers['Server-Timing']
+    assert 'desc="peak ' in response.headers['Server-Timing']
+    assert any(record.getMessage().startswith('Memory of POST /: parse peak') for record in caplog.records)
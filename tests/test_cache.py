@@ -0,0 +1,117 @@
+import threading
+import time
+
+import pytest
+
+from mapy.cache import ResultCache, estimate_size
+
+
+# Test the same mail with different line endings gets the same key
+def test_key_normalization():
+    assert ResultCache.key("Subject: a\r\nFrom: b\r\n") == ResultCache.key("  Subject: a\nFrom: b")
+    assert ResultCache.key("Subject: a") != ResultCache.key("Subject: b")
+    assert ResultCache.key("Subject: a", 'api', True) != ResultCache.key("Subject: a", 'api', False)
+
+
+# Test results are computed once and counted as hits afterwards
+def test_get_or_compute():
+    cache = ResultCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {'value': 42}
+
+    assert cache.get_or_compute('a', compute) == {'value': 42}
+    assert cache.get_or_compute('a', compute) == {'value': 42}
+    assert len(calls) == 1
+    assert cache.stats() == {
+        'hits': 1, 'misses': 1, 'coalesced': 0, 'hit_rate': 0.5,
+        'entries': 1, 'bytes': estimate_size({'value': 42})
+    }
+
+
+# Test the least recently used results are evicted when the cache is full
+def test_eviction_by_size():
+    value_size = estimate_size('x' * 1000)
+    cache = ResultCache(max_bytes=value_size * 2)
+
+    cache.get_or_compute('a', lambda: 'a' * 1000)
+    cache.get_or_compute('b', lambda: 'b' * 1000)
+    cache.get('a')  # 'b' is now the least recently used
+    cache.get_or_compute('c', lambda: 'c' * 1000)
+
+    assert cache.get('a') is not None
+    assert cache.get('b') is None
+    assert cache.get('c') is not None
+    assert cache.size <= cache.max_bytes
+
+    cache.get_or_compute('d', lambda: 'd' * 10000)  # Too large to be cached at all
+    assert cache.get('d') is None
+    assert cache.get('a') is not None
+
+
+# Test results expire after the TTL
+def test_expiry(monkeypatch):
+    cache = ResultCache(ttl=10)
+    now = time.monotonic()
+    cache.get_or_compute('a', lambda: 'value')
+
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 11)
+    assert cache.get('a') is None
+    assert cache.stats()['entries'] == 0
+    assert cache.size == 0
+
+
+# Test concurrent requests for the same key wait for the running computation
+def test_coalescing():
+    cache = ResultCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'result'
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(cache.get_or_compute('a', compute)))
+    first.start()
+    started.wait(5)
+
+    others = [threading.Thread(target=lambda: results.append(cache.get_or_compute('a', compute)))
+              for _ in range(3)]
+    for thread in others:
+        thread.start()
+    while cache.stats()['coalesced'] < 3:
+        time.sleep(0.001)
+    release.set()
+    for thread in [first] + others:
+        thread.join(5)
+
+    assert results == ['result'] * 4
+    assert len(calls) == 1
+    assert cache.stats()['coalesced'] == 3
+
+
+# Test failures are passed to waiting requests but not cached
+def test_failure_not_cached():
+    cache = ResultCache()
+
+    def fail():
+        raise ValueError("broken")
+
+    with pytest.raises(ValueError):
+        cache.get_or_compute('a', fail)
+    assert cache.get_or_compute('a', lambda: 'fixed') == 'fixed'
+
+
+# Test a result computed elsewhere replaces the cached one
+def test_put():
+    cache = ResultCache()
+    cache.get_or_compute('a', lambda: 'old')
+    cache.put('a', 'new')
+    assert cache.get('a') == 'new'
+    assert cache.stats()['entries'] == 1
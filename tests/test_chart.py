@@ -0,0 +1,24 @@
+from mapy.chart import downsample, render_horizontal_bar_chart
+
+
+def test_downsample():
+    bars = [('a', 1), ('b', 50), ('c', 2), ('d', 30), ('e', 3)]
+    assert downsample(bars, 10) == bars
+    assert downsample(bars, 3) == [('b', 50), ('d', 30), ('3 other hops', 6)]
+    assert downsample(bars, 1) == [('5 other hops', 86)]
+    assert downsample(bars, 0) == downsample(bars, -5) == [('5 other hops', 86)]
+
+
+def test_render_horizontal_bar_chart():
+    chart = render_horizontal_bar_chart('Total Delay is: 3 s', 'Delay in seconds.', (('From: <b>', 1), ('By: x', 2)))
+    assert chart.startswith('<svg')
+    assert 'Total Delay is: 3 s' in chart
+    assert 'From: &lt;b&gt;' in chart
+    assert '<b>' not in chart
+
+
+def test_render_horizontal_bar_chart_is_memoized():
+    render_horizontal_bar_chart.cache_clear()
+    bars = (('From: client.example.com', 120),)
+    assert render_horizontal_bar_chart('t', 'x', bars) is render_horizontal_bar_chart('t', 'x', bars)
+    assert render_horizontal_bar_chart.cache_info().hits == 1
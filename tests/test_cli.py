@@ -0,0 +1,104 @@
+import json
+
+from mapy import cli
+
+mail = """Received: from client.example.com (client.example.com [192.168.0.1])
+    by mail.example.com with ESMTPS id j0siq34k2i; Fri, 23 Jul 2024 10:21:35 -0700 (PDT)
+Received: from sender.example.org (sender.example.org [192.168.0.2])
+    by client.example.com with SMTP id abc; Fri, 23 Jul 2024 10:20:35 -0700 (PDT)
+From: sender@example.com
+To: recipient@example.com
+Subject: Test Email {n}
+
+This is the body of the email.
+"""
+
+
+def write_mbox(path, count):
+    """Write an mbox file and return the offsets of its messages."""
+    offsets = []
+    with open(path, 'wb') as f:
+        for n in range(count):
+            offsets.append(f.tell())
+            f.write(f"From sender@example.com Fri Jul 23 10:21:35 2024\n{mail.format(n=n)}\n".encode())
+    return offsets
+
+
+def read_output(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+# Test every message of an mbox file becomes one JSON line
+def test_mbox(tmp_path, capsys):
+    mbox = tmp_path / 'incident.mbox'
+    output = tmp_path / 'out.jsonl'
+    offsets = write_mbox(mbox, 3)
+
+    assert cli.main([str(mbox), '-o', str(output), '-j', '2']) == 0
+
+    records = sorted(read_output(output), key=lambda record: int(record['id'].rsplit(':', 1)[1]))
+    assert [record['id'] for record in records] == [f'{mbox}:{offset}' for offset in offsets]
+    assert records[2]['summary']['Subject'] == 'Test Email 2'
+    assert records[0]['total_delay'] == 60
+    assert records[0]['ips'] == ['192.168.0.1', '192.168.0.2']
+    assert 'messages/s' in capsys.readouterr().err
+
+
+# Test a Maildir tree with subfolders and a single message file
+def test_maildir_and_single_file(tmp_path, capsys):
+    maildir = tmp_path / 'Maildir'
+    for folder in (maildir, maildir / '.Archive'):
+        for subdir in ('cur', 'new', 'tmp'):
+            (folder / subdir).mkdir(parents=True)
+    (maildir / 'cur' / '1.host:2,S').write_text(mail.format(n=1))
+    (maildir / '.Archive' / 'new' / '2.host').write_text(mail.format(n=2))
+    (maildir / 'tmp' / '3.host').write_text(mail.format(n=3))  # Still being delivered
+    single = tmp_path / 'single.eml'
+    single.write_text(mail.format(n=4))
+    output = tmp_path / 'out.jsonl'
+
+    assert cli.main([str(maildir), str(single), '-o', str(output), '-j', '1']) == 0
+
+    subjects = sorted(record['summary']['Subject'] for record in read_output(output))
+    assert subjects == ['Test Email 1', 'Test Email 2', 'Test Email 4']
+
+
+# Test an aborted run is resumed without analyzing messages twice
+def test_resume(tmp_path, capsys):
+    mbox = tmp_path / 'incident.mbox'
+    output = tmp_path / 'out.jsonl'
+    offsets = write_mbox(mbox, 4)
+
+    done = cli.analyze_message(f'{mbox}:{offsets[1]}', mail.format(n=1).encode())[0]
+    output.write_text(done + '{"id": "' + f'{mbox}:{offsets[2]}')  # Killed while writing
+
+    assert cli.main([str(mbox), '-o', str(output), '-j', '1', '--resume']) == 0
+
+    ids = [record['id'] for record in read_output(output)]
+    assert sorted(ids) == sorted(f'{mbox}:{offset}' for offset in offsets)
+    assert '1 skipped' in capsys.readouterr().err
+
+
+# Test a message which can't be analyzed gets an error line
+def test_analyze_message_error(monkeypatch):
+    def fail(*args, **kwargs):
+        raise ValueError("broken")
+
+    monkeypatch.setattr(cli, 'analyze_mail', fail)
+    line, size, failed = cli.analyze_message('broken', b'Subject: x')
+    assert failed
+    assert size == 10
+    assert json.loads(line) == {'id': 'broken', 'error': "Analysis failed: broken"}
+
+
+# Test large mbox files are split into several tasks without losing messages
+def test_mbox_tasks(tmp_path):
+    mbox = tmp_path / 'incident.mbox'
+    offsets = write_mbox(mbox, 50)
+
+    tasks = list(cli.iter_tasks([str(mbox)], range_size=2000))
+    assert len(tasks) > 1
+
+    ids = [message_id for task in tasks for message_id, _ in cli.iter_task_messages(task)]
+    assert ids == [f'{mbox}:{offset}' for offset in offsets]
@@ -0,0 +1,67 @@
+import gzip
+import re
+
+from mapy.app import create_app
+
+mail = """Received: from client.example.com (client.example.com [192.168.0.1])
+    by mail.example.com with ESMTPS id j0siq34k2i; Fri, 23 Jul 2024 10:21:35 -0700 (PDT)
+From: sender@example.com
+Subject: Test Email
+
+This is the body of the email."""
+
+
+def submit(client, **kwargs):
+    response = client.get('/')
+    csrf_token = re.search(rb'name="csrf_token"\n\s*value="([^"]+)"', response.data).group(1)
+    return client.post('/', data={'headers': mail, 'csrf_token': csrf_token}, **kwargs)
+
+
+# Test the result page is compressed for clients which accept gzip
+def test_compressed_result_page(client):
+    response = submit(client, headers={'Accept-Encoding': 'br, gzip;q=0.8'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.vary
+    assert b'This is the body of the email.' in gzip.decompress(response.data)
+    assert 'compress;dur=' in response.headers['Server-Timing']
+
+
+# Test responses are sent uncompressed to clients without gzip support
+def test_uncompressed_result_page(client):
+    for accept_encoding in (None, 'identity', 'gzip;q=0'):
+        headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+        response = submit(client, headers=headers)
+        assert 'Content-Encoding' not in response.headers
+        assert 'Accept-Encoding' in response.vary
+        assert b'This is the body of the email.' in response.data
+
+
+# Test small, streamed and file responses are not compressed
+def test_not_compressed(app, client):
+    headers = {'Accept-Encoding': 'gzip'}
+
+    response = client.get('/api/stats', headers=headers)
+    assert len(response.data) < app.config['COMPRESS_MIN_SIZE']
+    assert 'Content-Encoding' not in response.headers
+
+    response = client.get('/static/js/job.js', headers=headers)
+    assert 'Content-Encoding' not in response.headers
+    response.close()
+
+    app.config['ASYNC_ANALYSIS'] = True
+    job_url = submit(client).headers['Location']
+    response = client.get(job_url + '/events', headers=headers)
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data(as_text=True).endswith('event: done\ndata: {}\n\n')
+
+
+# Test compression can be turned off
+def test_compression_disabled(tmp_path):
+    app = create_app({
+        'GEOLOCATION_CACHE_PATH': None,
+        'ATTACHMENT_SPOOL_DIR': str(tmp_path / 'attachments'),
+        'RESULT_SPOOL_DIR': str(tmp_path / 'results'),
+        'COMPRESS_LEVEL': 0
+    })
+    response = submit(app.test_client(), headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
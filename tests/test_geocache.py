@@ -0,0 +1,105 @@
+import time
+
+from types import SimpleNamespace
+
+import requests
+
+from mapy import geolocation
+from mapy.geocache import GeolocationCache
+from mapy.geolocation import HttpProvider
+
+location = {'ip': '192.0.2.1', 'latitude': 1.0, 'longitude': 2.0}
+
+
+def test_cache_hit_and_miss(tmp_path):
+    cache = GeolocationCache(str(tmp_path / 'geo.sqlite3'))
+
+    assert cache.get('192.0.2.1') == (False, None)
+    cache.set('192.0.2.1', location)
+    assert cache.get('192.0.2.1') == (True, location)
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['hit_rate'] == 0.5
+    assert stats['entries'] == 1
+
+
+def test_cache_negative_entries_expire(tmp_path):
+    cache = GeolocationCache(str(tmp_path / 'geo.sqlite3'), negative_ttl=0.1)
+
+    cache.set('192.0.2.1', None)
+    assert cache.get('192.0.2.1') == (True, None)
+
+    time.sleep(0.2)
+    assert cache.get('192.0.2.1') == (False, None)
+    assert cache.purge() == 1
+
+
+def test_cache_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'geo.sqlite3')
+    GeolocationCache(path).set('192.0.2.1', location)
+
+    assert GeolocationCache(path).get('192.0.2.1') == (True, location)
+
+
+def test_http_provider_uses_cache(tmp_path, monkeypatch):
+    calls = []
+
+    def fake_request(ip):
+        calls.append(ip)
+        return location
+
+    provider = HttpProvider(cache=GeolocationCache(str(tmp_path / 'geo.sqlite3')))
+    monkeypatch.setattr(provider, 'request', fake_request)
+
+    assert provider.lookup('192.0.2.1') == location
+    assert provider.lookup('192.0.2.1') == location
+    assert calls == ['192.0.2.1']
+
+
+def test_http_provider_does_not_cache_errors(tmp_path, monkeypatch):
+    calls = []
+
+    def fake_request(ip):
+        calls.append(ip)
+        if len(calls) == 1:
+            raise requests.ConnectionError('unreachable')
+        return location
+
+    cache = GeolocationCache(str(tmp_path / 'geo.sqlite3'))
+    provider = HttpProvider(cache=cache)
+    monkeypatch.setattr(provider, 'request', fake_request)
+
+    assert provider.lookup('192.0.2.1') is None
+    assert cache.stats()['entries'] == 0
+    assert provider.lookup('192.0.2.1') == location
+    assert calls == ['192.0.2.1', '192.0.2.1']
+
+
+def test_http_provider_does_not_cache_error_replies(tmp_path, monkeypatch):
+    def fake_response(status, body):
+        response = requests.Response()
+        response.status_code = status
+        response.reason = 'Too Many Requests' if status == 429 else 'OK'
+        response.url = 'https://ipapi.co/8.8.8.8/json/'
+        response._content = body
+        return response
+
+    replies = [
+        fake_response(429, b'{"error": true, "reason": "RateLimited", "message": "Visit https://ipapi.co"}'),
+        fake_response(200, b'{"error": true, "reason": "RateLimited", "message": "Visit https://ipapi.co"}'),
+        fake_response(200, b'{"latitude": 37.751, "longitude": -97.822}'),
+    ]
+    session = SimpleNamespace(get=lambda url, timeout: replies.pop(0))
+    monkeypatch.setattr(geolocation, 'get_http_session', lambda: session)
+
+    cache = GeolocationCache(str(tmp_path / 'geo.sqlite3'))
+    provider = HttpProvider(cache=cache)
+
+    assert provider.lookup('8.8.8.8') is None
+    assert cache.get('8.8.8.8') == (False, None)
+    assert provider.lookup('8.8.8.8') is None
+    assert cache.get('8.8.8.8') == (False, None)
+    assert provider.lookup('8.8.8.8') == {'ip': '8.8.8.8', 'latitude': 37.751, 'longitude': -97.822}
+    assert cache.get('8.8.8.8')[0]
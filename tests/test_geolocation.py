@@ -0,0 +1,113 @@
+from types import SimpleNamespace
+
+import geoip2.database
+import geoip2.errors
+import pytest
+
+from mapy import geolocation
+from mapy.geolocation import (GeolocationProvider, HttpProvider, MaxMindProvider, get_country_from_ip,
+                              get_geolocation_providers, lookup_country, lookup_geolocation, parse_asn,
+                              set_geolocation_providers)
+
+
+class FakeReader:
+    def __init__(self, path):
+        self.path = path
+
+    def city(self, ip):
+        if ip != '8.8.8.8':
+            raise geoip2.errors.AddressNotFoundError(ip)
+        return SimpleNamespace(
+            location=SimpleNamespace(latitude=37.751, longitude=-97.822),
+            country=SimpleNamespace(iso_code='US', name='United States')
+        )
+
+    def country(self, ip):
+        self.country_calls = getattr(self, 'country_calls', 0) + 1
+        return SimpleNamespace(country=SimpleNamespace(iso_code='US', name='United States'))
+
+    def asn(self, ip):
+        return SimpleNamespace(autonomous_system_number=15169, autonomous_system_organization='GOOGLE')
+
+
+class FakeProvider(GeolocationProvider):
+    def __init__(self, answer):
+        self.answer = answer
+        self.calls = []
+
+    def lookup(self, ip):
+        self.calls.append(ip)
+        return self.answer
+
+
+@pytest.fixture
+def restore_providers():
+    providers = get_geolocation_providers()
+    yield
+    set_geolocation_providers(providers)
+
+
+def test_maxmind_provider(monkeypatch):
+    monkeypatch.setattr(geoip2.database, 'Reader', FakeReader)
+    provider = MaxMindProvider('city.mmdb', 'asn.mmdb')
+
+    assert provider.lookup('8.8.8.8') == {
+        'ip': '8.8.8.8',
+        'latitude': 37.751,
+        'longitude': -97.822,
+        'country': 'United States',
+        'iso_code': 'us',
+        'asn': 15169,
+        'organization': 'GOOGLE'
+    }
+    assert provider.lookup('1.1.1.1') is None
+
+
+def test_http_provider_asn(monkeypatch):
+    data = {'latitude': 37.751, 'longitude': -97.822, 'country_name': 'United States', 'country_code': 'US',
+            'asn': 'AS15169', 'org': 'GOOGLE'}
+    response = SimpleNamespace(raise_for_status=lambda: None, json=lambda: data)
+    monkeypatch.setattr(geolocation, 'get_http_session', lambda: SimpleNamespace(get=lambda url, timeout: response))
+
+    # The number has the same type as in the MaxMind databases
+    location = HttpProvider().request('8.8.8.8')
+    assert location['asn'] == 15169
+    assert location['organization'] == 'GOOGLE'
+
+    assert parse_asn('as64500 ') == parse_asn(64500) == 64500
+    assert parse_asn(None) is None
+    assert parse_asn('unknown') is None
+
+
+def test_lookup_geolocation_falls_back(restore_providers):
+    location = {'ip': '8.8.8.8', 'latitude': 1.0, 'longitude': 2.0}
+    local, fallback = FakeProvider(None), FakeProvider(location)
+    set_geolocation_providers([local, fallback])
+
+    assert lookup_geolocation('8.8.8.8') == location
+    assert local.calls == fallback.calls == ['8.8.8.8']
+
+
+def test_lookup_geolocation_skips_private_addresses(restore_providers):
+    provider = FakeProvider({'ip': 'x', 'latitude': 1.0, 'longitude': 2.0})
+    set_geolocation_providers([provider])
+
+    assert lookup_geolocation('192.168.0.1') is None
+    assert lookup_geolocation('999.1.1.1') is None
+    assert provider.calls == []
+
+
+def test_get_country_from_ip_is_memoized(monkeypatch):
+    reader = FakeReader('country.mmdb')
+    monkeypatch.setattr(geolocation, 'get_country_reader', lambda: reader)
+    lookup_country.cache_clear()
+
+    line = "from mail.example.com (mail.example.com [8.8.8.8])"
+    expected = {'iso_code': 'us', 'country_name': 'United States'}
+    assert get_country_from_ip(line) == expected
+    assert get_country_from_ip(line) == expected
+    assert reader.country_calls == 1
+
+    # Private addresses are never looked up
+    assert get_country_from_ip("from client.example.com [192.168.0.1]") is None
+    lookup_country.cache_clear()
@@ -0,0 +1,94 @@
+import threading
+import time
+
+from mapy.jobs import JobQueue
+
+
+def wait_until_finished(job, timeout=5):
+    return list(event for event in job.iter_events(timeout=timeout) if event is not None)
+
+
+# Test a job runs in the background and records its progress
+def test_job_progress():
+    queue = JobQueue(max_workers=1)
+
+    def work(progress):
+        progress('headers')
+        progress('messages')
+        return {'answer': 42}
+
+    job = queue.submit(work)
+    events = wait_until_finished(job)
+
+    assert [name for name, _ in events] == ['progress', 'progress', 'progress', 'done']
+    assert [data['stage'] for name, data in events if name == 'progress'] == ['started', 'headers', 'messages']
+    assert job.state == 'done'
+    assert job.result == {'answer': 42}
+    assert queue.get(job.id) is job
+
+
+# Test a failed job reports its error
+def test_job_failure():
+    queue = JobQueue(max_workers=1)
+
+    def work(progress):
+        raise ValueError("broken")
+
+    job = queue.submit(work)
+    events = wait_until_finished(job)
+
+    assert events[-1] == ('failed', {'error': "Analysis failed: broken"})
+    assert job.state == 'failed'
+
+
+# Test the number of pending jobs is bounded
+def test_queue_full():
+    queue = JobQueue(max_workers=1, max_pending=2)
+    release = threading.Event()
+
+    jobs = [queue.submit(lambda progress: release.wait(5)) for _ in range(3)]
+    assert jobs[0] is not None and jobs[1] is not None
+    assert jobs[2] is None
+
+    release.set()
+    for job in jobs[:2]:
+        wait_until_finished(job)
+    assert queue.submit(lambda progress: None) is not None
+
+
+# Test finished jobs expire after the TTL
+def test_job_expiry(monkeypatch):
+    queue = JobQueue(max_workers=1, ttl=10)
+    job = queue.submit(lambda progress: 'result')
+    wait_until_finished(job)
+
+    now = time.monotonic()
+    monkeypatch.setattr(time, 'monotonic', lambda: now + 11)
+    assert queue.get(job.id) is None
+    assert queue.get('unknown') is None
+
+
+# Test only the most recently finished jobs are kept
+def test_max_finished_jobs():
+    queue = JobQueue(max_workers=1, max_finished=2)
+    jobs = []
+    for i in range(4):
+        jobs.append(queue.submit(lambda progress, i=i: i))
+        wait_until_finished(jobs[-1])
+
+    assert queue.get(jobs[0].id) is None
+    assert queue.get(jobs[1].id) is None
+    assert [queue.get(job.id).result for job in jobs[2:]] == [2, 3]
+
+
+# Test followers get keep-alives while nothing happens
+def test_keep_alive():
+    queue = JobQueue(max_workers=1)
+    release = threading.Event()
+    job = queue.submit(lambda progress: release.wait(5))
+
+    events = job.iter_events(timeout=0.01)
+    assert next(events) == ('progress', {'stage': 'started'})
+    assert next(events) is None
+    release.set()
+    assert [event for event in events if event is not None] == [('done', {})]
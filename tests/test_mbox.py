@@ -0,0 +1,64 @@
+from mapy.mbox import iter_messages, open_mbox, split_ranges
+
+mbox = (
+    b"From alice@example.com Fri Jul 23 10:21:35 2024\n"
+    b"Subject: First\n"
+    b"\n"
+    b"Hello\n"
+    b"\n"
+    b"From bob@example.com Fri Jul 23 10:22:35 2024\n"
+    b"Subject: Second\n"
+    b"\n"
+    b">From the body, quoted as it must be\n"
+    b"\n"
+    b"From carol@example.com Fri Jul 23 10:23:35 2024\n"
+    b"Subject: Third\n"
+    b"\n"
+    b"Bye\n"
+)
+
+
+def write(tmp_path, data):
+    path = tmp_path / 'test.mbox'
+    path.write_bytes(data)
+    return str(path)
+
+
+# Test the messages are found without their separator lines
+def test_iter_messages(tmp_path):
+    with open_mbox(write(tmp_path, mbox)) as mm:
+        messages = [(offset, bytes(view)) for offset, view in iter_messages(mm)]
+
+    assert [offset for offset, _ in messages] == [0, mbox.index(b'From bob'), mbox.index(b'From carol')]
+    assert messages[0][1] == b"Subject: First\n\nHello\n"
+    assert messages[1][1] == b"Subject: Second\n\n>From the body, quoted as it must be\n"
+    assert messages[2][1] == b"Subject: Third\n\nBye\n"
+
+
+# Test the messages are yielded as views into the mapped file
+def test_iter_messages_zero_copy(tmp_path):
+    with open_mbox(write(tmp_path, mbox)) as mm:
+        for _, view in iter_messages(mm):
+            assert isinstance(view, memoryview)
+            assert view.obj is mm
+            view.release()
+
+
+# Test every message is found by exactly one range
+def test_split_ranges(tmp_path):
+    data = mbox * 20
+    with open_mbox(write(tmp_path, data)) as mm:
+        all_offsets = [offset for offset, _ in iter_messages(mm)]
+        for parts in (1, 2, 3, 7, 100):
+            ranges = split_ranges(mm, parts)
+            assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+            assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+            offsets = [offset for start, end in ranges for offset, _ in iter_messages(mm, start, end)]
+            assert offsets == all_offsets
+
+
+# Test empty files have no messages
+def test_empty_mbox(tmp_path):
+    with open_mbox(write(tmp_path, b'')) as mm:
+        assert list(iter_messages(mm)) == []
+        assert split_ranges(mm, 4) == []
@@ -0,0 +1,94 @@
+import tracemalloc
+
+from mapy import metrics
+
+
+# Test stages are only timed while timings are collected
+def test_stage_without_collect():
+    with metrics.stage('parse'):
+        metrics.count('hops', 3)
+
+    with metrics.collect() as timings:
+        pass
+    assert timings.stages == {}
+    assert timings.counts == {}
+
+
+# Test nested and repeated stages and counts
+def test_collect_stages():
+    with metrics.collect() as timings:
+        with metrics.stage('messages'):
+            for _ in range(2):
+                with metrics.stage('html'):
+                    metrics.count('parts', 1)
+
+    assert list(timings.stages) == ['messages', 'html']
+    assert timings.stages['messages'] >= timings.stages['html'] > 0
+    assert timings.counts == {'parts': 2}
+
+
+# Test the Server-Timing header value
+def test_server_timing():
+    timings = metrics.Timings()
+    timings.stages = {'parse': 0.0012, 'headers': 0.25}
+    assert timings.server_timing(0.5) == 'parse;dur=1.2, headers;dur=250.0, total;dur=500.0'
+
+
+# Test the histograms are rendered in the Prometheus text format with cumulative buckets
+def test_render_metrics():
+    registry = metrics.Metrics()
+    for seconds, hops in ((0.003, 2), (0.3, 200)):
+        timings = metrics.Timings()
+        timings.stages = {'headers': seconds}
+        timings.counts = {'hops': hops}
+        registry.observe(timings, 'mapy.index', seconds)
+
+    text = registry.render()
+    assert '# TYPE mapy_stage_duration_seconds histogram' in text
+    assert 'mapy_stage_duration_seconds_bucket{stage="headers",le="0.005"} 1\n' in text
+    assert 'mapy_stage_duration_seconds_bucket{stage="headers",le="0.5"} 2\n' in text
+    assert 'mapy_stage_duration_seconds_bucket{stage="headers",le="+Inf"} 2\n' in text
+    assert 'mapy_stage_duration_seconds_count{stage="headers"} 2\n' in text
+    assert 'mapy_request_duration_seconds_count{endpoint="mapy.index"} 2\n' in text
+    assert 'mapy_mail_hops_bucket{le="5"} 1\n' in text
+    assert 'mapy_mail_hops_sum 202\n' in text
+
+
+# Test the peak and retained memory of nested stages while tracemalloc is tracing
+def test_memory_accounting():
+    tracemalloc.start()
+    try:
+        with metrics.collect() as timings:
+            with metrics.stage('messages'):
+                with metrics.stage('html'):
+                    temporary = bytearray(4 * 1024 ** 2)
+                    del temporary
+                kept = bytearray(1024 ** 2)
+    finally:
+        tracemalloc.stop()
+
+    html_peak, html_retained = timings.memory['html']
+    messages_peak, messages_retained = timings.memory['messages']
+    assert html_peak >= 4 * 1024 ** 2
+    assert html_retained < 1024 ** 2
+    # The peak of the inner stage counts for the outer one as well
+    assert messages_peak >= html_peak
+    assert messages_retained >= len(kept)
+    assert 'html;dur=' in timings.server_timing()
+    assert 'desc="peak 4.0 MB, retained 0.0 MB"' in timings.server_timing()
+
+    registry = metrics.Metrics()
+    registry.observe(timings)
+    text = registry.render()
+    assert 'mapy_stage_memory_peak_bytes_bucket{stage="html",le="16777216"} 1\n' in text
+    assert 'mapy_stage_memory_retained_bytes_count{stage="messages"} 1\n' in text
+
+
+# Test no memory is accounted without tracemalloc
+def test_no_memory_accounting():
+    with metrics.collect() as timings:
+        with metrics.stage('parse'):
+            pass
+    assert timings.memory is None
+    assert 'desc' not in timings.server_timing()
+    assert 'mapy_stage_memory' not in metrics.Metrics().render()
@@ -0,0 +1,74 @@
+import pstats
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from mapy import profiling
+
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+    return 'done'
+
+
+# Test a function is profiled with cProfile and the profile can be loaded by pstats
+def test_run_profiled_pstats(tmp_path):
+    path = profiling.profile_path(str(tmp_path / 'profiles'), 'mail', 'pstats')
+    assert path.endswith('-mail.pstats')
+
+    assert profiling.run_profiled(lambda: busy(0.01), path) == 'done'
+
+    functions = {name for _, _, name in pstats.Stats(path).stats}
+    assert 'busy' in functions
+
+
+# Test sampled stacks are written in the collapsed format, starting at the profiled function
+def test_run_profiled_stacks(tmp_path):
+    path = str(tmp_path / 'mail.collapsed')
+
+    assert profiling.run_profiled(lambda: busy(0.1), path, 'stacks') == 'done'
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert lines
+    stack, count = lines[0].rsplit(' ', 1)
+    assert stack.startswith('tests.test_profiling:<lambda>;tests.test_profiling:busy')
+    assert int(count) > 0
+
+
+# Test functions handed to a worker pool through wrap are profiled in both modes
+def test_run_profiled_worker_threads(tmp_path):
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit():
+        return executor.submit(profiling.wrap(busy), 0.1).result()
+
+    path = str(tmp_path / 'mail.pstats')
+    assert profiling.run_profiled(submit, path) == 'done'
+    assert 'busy' in {name for _, _, name in pstats.Stats(path).stats}
+
+    path = str(tmp_path / 'mail.collapsed')
+    assert profiling.run_profiled(submit, path, 'stacks') == 'done'
+    with open(path) as f:
+        stacks = [line.rsplit(' ', 1)[0] for line in f.read().splitlines()]
+    assert 'tests.test_profiling:submit;tests.test_profiling:busy' in stacks
+
+    # Outside of a profiled call the function isn't wrapped
+    assert profiling.wrap(busy) is busy
+    executor.shutdown()
+
+
+# Test the profile is saved when the function fails
+def test_run_profiled_error(tmp_path):
+    path = tmp_path / 'failed.pstats'
+
+    def fail():
+        raise ValueError("broken")
+
+    with pytest.raises(ValueError):
+        profiling.run_profiled(fail, str(path))
+    assert path.exists()
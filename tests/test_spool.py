@@ -0,0 +1,62 @@
+import base64
+import hashlib
+import os
+import time
+
+from mapy.spool import AttachmentSpool
+
+
+def test_put_and_path(tmp_path):
+    spool = AttachmentSpool(str(tmp_path))
+    key = spool.put(b'Test attachment data.')
+
+    assert key == hashlib.sha256(b'Test attachment data.').hexdigest()
+    with open(spool.path(key), 'rb') as f:
+        assert f.read() == b'Test attachment data.'
+
+    # Identical content is only stored once
+    assert spool.put(b'Test attachment data.') == key
+    assert os.listdir(tmp_path) == [key]
+
+
+def test_encoded_entries_are_decoded_on_download(tmp_path):
+    spool = AttachmentSpool(str(tmp_path))
+    data = b'Test attachment data.' * 100
+    key = hashlib.sha256(data).hexdigest()
+
+    assert spool.put_encoded(key, [base64.encodebytes(data)], 'base64', len(data))
+    assert os.listdir(tmp_path) == [f'{key}.base64']
+
+    with open(spool.path(key), 'rb') as f:
+        assert f.read() == data
+    assert os.listdir(tmp_path) == [key]
+
+
+def test_invalid_and_unknown_keys(tmp_path):
+    spool = AttachmentSpool(str(tmp_path))
+
+    assert spool.path('../../etc/passwd') is None
+    assert spool.path('0' * 64) is None
+
+
+def test_entries_expire(tmp_path):
+    spool = AttachmentSpool(str(tmp_path), ttl=0.1)
+    key = spool.put(b'data')
+
+    time.sleep(0.2)
+    assert spool.path(key) is None
+    spool.cleanup()
+    assert os.listdir(tmp_path) == []
+
+
+def test_oldest_entries_are_evicted(tmp_path):
+    spool = AttachmentSpool(str(tmp_path), max_bytes=10)
+    first = spool.put(b'123456')
+    os.utime(spool.path(first), (time.time() - 10, time.time() - 10))
+    second = spool.put(b'abcdef')
+
+    assert spool.path(first) is None
+    assert spool.path(second) is not None
+
+    # Attachments larger than the whole spool are not stored at all
+    assert spool.put(b'x' * 11) is None
@@ -1,6 +1,12 @@
+import base64
+import hashlib
+import quopri
+import random
+
 import pytest
 from mapy.utils import *
 from datetime import datetime, timedelta, timezone
+from email import message_from_string
 from email.parser import HeaderParser
 from email.message import Message
 
@@ -84,6 +90,31 @@ def test_parse_date():
     assert parse_date(fuzzy_date_str) == fuzzy_expected_date
 
 
+def test_parse_rfc5322_date():
+    # Test dates in RFC 5322 format give the same result as the fuzzy parser
+    for date_str in [
+        "Thu,  4 Jul 2024 10:42:48 +0200 (CEST)",
+        "Fri, 23 Jul 2024 10:21:35 -0700",
+        "1 Jan 2023 00:00:00 GMT",
+        "Mon, 5 Feb 2024 3:04:05.123 +0000",
+        "Tue, 06 Feb 2024 13:04 -0330",
+        "Wed, 7 Feb 2024 13:04:05",
+    ]:
+        assert parse_rfc5322_date(date_str) == parse_date_fuzzy(date_str)
+
+    # Test other formats are left to the fuzzy parser
+    assert parse_rfc5322_date("2024-07-04 10:42:48 +0200") is None
+    assert parse_rfc5322_date("Received: from example.com (Fri, 23 Jul 2024 10:21:35)") is None
+    assert parse_rfc5322_date("Sat, 31 Feb 2024 10:00:00 +0000") is None
+
+
+def test_parse_date_is_memoized():
+    parse_date.cache_clear()
+    date_str = "Fri, 23 Jul 2024 10:21:35 -0700 (PDT)"
+    assert parse_date(date_str) == parse_date(date_str)
+    assert parse_date.cache_info().hits == 1
+
+
 def test_get_header_value():
     header_data = """From: sender@example.com
     To: recipient@example.com
@@ -102,6 +133,28 @@ def test_get_header_value():
     assert get_header_value('Cc', header_data) is None
 
 
+def test_build_header_index():
+    header_data = "Received: from a.example.com\n\tby b.example.com;\n Fri, 23 Jul 2024 10:21:35 -0700\n" \
+                  "Received: by c.example.com\nSUBJECT: Test Email\nDelivered-To: other@example.com\n" \
+                  "\nTo: body@example.com\n"
+    index = build_header_index(header_data)
+
+    assert index['received'] == [
+        'from a.example.com by b.example.com; Fri, 23 Jul 2024 10:21:35 -0700',
+        'by c.example.com'
+    ]
+    assert index['subject'] == ['Test Email']
+
+    # Test the body is never indexed and similar header names don't match
+    assert 'to' not in index
+    assert get_header_value('To', index) is None
+
+    # Test the header block also ends at a line with only whitespace, with CRLF line endings
+    index = build_header_index("Subject: Test\r\n Email\r\n \t\r\nTo: body@example.com\r\n")
+    assert index == {'subject': ['Test Email']}
+    assert build_header_index("\nSubject: body") == {}
+
+
 def test_parse_received_headers():
     received_headers = parse_received_headers(mail_data)
     assert len(received_headers) == 1
@@ -112,41 +165,50 @@ def test_parse_received_headers():
     assert parse_received_headers(no_received_mail_data) == []
 
 
-def test_parse_header_line():
-    header_line = "from client.example.com (client.example.com [192.168.0.1]); Fri, 23 Jul 2024 10:21:35 -0700"
-    parsed_line = parse_header_line(header_line)
-    assert parsed_line == [
-        "from client.example.com (client.example.com [192.168.0.1])",
-        "Fri, 23 Jul 2024 10:21:35 -0700"
-    ]
-
-    # Test header line without semicolon
-    no_semicolon_line = "from client.example.com (client.example.com [192.168.0.1])\r\nFri, 23 Jul 2024 10:21:35 -0700"
-    parsed_no_semicolon_line = parse_header_line(no_semicolon_line)
-    assert parsed_no_semicolon_line == [
-        "from client.example.com (client.example.com [192.168.0.1])",
-        "Fri, 23 Jul 2024 10:21:35 -0700"
-    ]
+def test_tokenize_received():
+    received = "from mail.example.org (mail.example.org [203.0.113.5])\n" \
+               "        by mx.example.com (Postfix, from userid 1000) with ESMTPS id 4WF2kT0xyz\n" \
+               "        for <recipient@example.com>; Thu,  4 Jul 2024 10:42:48 +0200 (CEST)"
+    assert tokenize_received(received) == {
+        'from': 'mail.example.org (mail.example.org [203.0.113.5])',
+        'by': 'mx.example.com (Postfix, from userid 1000)',
+        'via': '',
+        'with': 'ESMTPS',
+        'id': '4WF2kT0xyz',
+        'for': '<recipient@example.com>',
+        'date': 'Thu, 4 Jul 2024 10:42:48 +0200 (CEST)'
+    }
 
+    # Test a folded header without a semicolon takes the date from the last line
+    assert tokenize_received("by mail.example.com\n Fri, 23 Jul 2024 10:21:35 -0700")['date'] == \
+        'Fri, 23 Jul 2024 10:21:35 -0700'
 
-def test_get_next_line():
-    received = [
-        "from client.example.com (client.example.com [192.168.0.1]); Fri, 23 Jul 2024 10:21:35 -0700",
-        "by mail.example.com with ESMTPS id j0siq34k2i for <recipient@example.com>;"
-    ]
+    # Test an unterminated comment or angle bracket doesn't swallow the date
+    for received in ["from a.example.com (unterminated by b.example.com; Fri, 23 Jul 2024 10:21:35 -0700",
+                     "from a.example.com by b.example.com for <recipient@example.com; Fri, 23 Jul 2024 10:21:35 -0700"]:
+        result = tokenize_received(received)
+        assert result['from'].startswith('a.example.com')
+        assert result['date'] == 'Fri, 23 Jul 2024 10:21:35 -0700'
+    assert tokenize_received("from a.example.com by b.example.com for <recipient@example.com; "
+                             "Fri, 23 Jul 2024 10:21:35 -0700")['for'] == '<recipient@example.com'
 
-    # Update the expected value to match the function's actual output
-    next_line = get_next_line(received, 0)
-    assert next_line == ["by mail.example.com with ESMTPS id j0siq34k2i for <recipient@example.com>", ""]
 
-    # Test with no next line
-    assert get_next_line(received, 1) is None
+def test_tokenize_received_fuzz():
+    rnd = random.Random(1337)
+    alphabet = ['from', 'by', 'via', 'with', 'id', 'for', ';', '(', ')', '<', '>', '"', '\\', ' ', '\n', 'x', '[1.2.3.4]']
+    for _ in range(500):
+        value = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 60)))
+        result = tokenize_received(value)
+        assert set(result) == {'from', 'by', 'via', 'with', 'id', 'for', 'date'}
+        assert all(isinstance(v, str) for v in result.values())
 
 
-def test_extract_direction_info():
-    header_line_from = ["from client.example.com (client.example.com [192.168.0.1]) by mail.example.com"]
-    direction_info_from = extract_direction_info(header_line_from)
-    assert direction_info_from == [('client.example.com (client.example.com [192.168.0.1])', 'mail.example.com', '')]
+def test_tokenize_received_worst_case():
+    # Inputs which made the old regular expressions backtrack for seconds
+    for value in ['from ' * 20000, 'Received: x\n ' * 20000, 'from ' + '(' * 20000 + 'by ' * 20000]:
+        start = time.perf_counter()
+        tokenize_received(value)
+        assert time.perf_counter() - start < 1
 
 
 def test_calculate_delay():
@@ -222,11 +284,27 @@ def test_process_email_headers():
     assert delayed is False
     assert 'Direction' in processed_data[1]
     assert 'Delay' in processed_data[1]
+    assert processed_data[1]['Country'] == [None, None]
     assert 'sender@example.com' in summary['From']
     assert isinstance(headers, Message)
     assert "Total Delay is" in chart
 
 
+def test_process_email_headers_with_parsed_message():
+    test_mail = """Received: from client.example.com (client.example.com [192.168.0.1])
+    by mail.example.com with ESMTPS id j0siq34k2i; Fri, 23 Jul 2024 10:21:35 -0700 (PDT)
+Subject: Test Email
+
+This is the body of the email."""
+
+    msg = parse_mail(test_mail)
+    processed_data, delayed, summary, headers, chart = process_email_headers(test_mail, msg)
+
+    assert headers is msg
+    assert processed_data == process_email_headers(test_mail)[0]
+    assert summary['Subject'] == 'Test Email'
+
+
 def test_extract_ip_addresses():
     ip_addresses = extract_ip_addresses(mock_ip_data)
     assert ip_addresses == ['192.0.2.1']
@@ -236,6 +314,31 @@ def test_extract_ip_addresses():
     assert extract_ip_addresses(no_ip_data) == []
 
 
+def test_extract_ip_geolocations(monkeypatch):
+    def fake_fetch_geolocation(ip):
+        if ip == '192.0.2.2':
+            return None
+        return {'ip': ip, 'latitude': 1.0, 'longitude': 2.0}
+
+    monkeypatch.setattr('mapy.utils.fetch_geolocation', fake_fetch_geolocation)
+    geolocations = extract_ip_geolocations("from 192.0.2.1 by 192.0.2.2;")
+    assert geolocations == [{'ip': '192.0.2.1', 'latitude': 1.0, 'longitude': 2.0}]
+
+    # No lookups are made if there are no IP addresses
+    assert extract_ip_geolocations("Received: from example.com by mail.example.com;") == []
+
+
+def test_extract_ip_geolocations_timeout(monkeypatch):
+    def slow_fetch_geolocation(ip):
+        if ip == '192.0.2.2':
+            time.sleep(1)
+        return {'ip': ip, 'latitude': 1.0, 'longitude': 2.0}
+
+    monkeypatch.setattr('mapy.utils.fetch_geolocation', slow_fetch_geolocation)
+    geolocations = extract_ip_geolocations("from 192.0.2.1 by 192.0.2.2;", timeout=0.2)
+    assert geolocations == [{'ip': '192.0.2.1', 'latitude': 1.0, 'longitude': 2.0}]
+
+
 def test_extract_message_data():
     # Test extracting message and attachment data
     multipart_email = Message()
@@ -255,8 +358,10 @@ def test_extract_message_data():
 def test_process_attachment():
     attachment_info = process_attachment(attachment_part)
     assert attachment_info['filename'] == 'test.txt'
-    assert base64.b64decode(attachment_info['data']) == b'Test attachment data.'
     assert attachment_info['length'] == 21
+    assert attachment_info['sha256'] == hashlib.sha256(b'Test attachment data.').hexdigest()
+    assert attachment_info['md5'] == hashlib.md5(b'Test attachment data.').hexdigest()
+    assert attachment_info['part'] is attachment_part
 
     # Test with an empty attachment
     empty_attachment = Message()
@@ -272,6 +377,66 @@ def test_process_attachment():
     assert no_attachment_info is None
 
 
+def test_decode_payload():
+    data = bytes(range(256)) * 1000
+    for encoding, encoded in [
+        ('base64', base64.encodebytes(data)),
+        ('quoted-printable', quopri.encodestring(data)),
+        ('raw', data),
+    ]:
+        chunks = [encoded[i:i + 1000] for i in range(0, len(encoded), 1000)]
+        assert b''.join(decode_payload(chunks, encoding)) == data
+
+    # Test missing base64 padding is tolerated like in the email package
+    assert b''.join(decode_payload([b'YWJjZA'], 'base64')) == b'abcd'
+
+
+def test_process_attachment_base64():
+    part = Message()
+    part.add_header('Content-Disposition', 'attachment', filename='big.bin')
+    part.add_header('Content-Transfer-Encoding', 'base64')
+    data = bytes(range(256)) * 1000
+    part.set_payload(base64.encodebytes(data).decode())
+
+    attachment_info = process_attachment(part)
+    assert attachment_info['length'] == len(data)
+    assert attachment_info['sha256'] == hashlib.sha256(data).hexdigest()
+
+
+# Test a forwarded mail is hashed as the serialized mail, not as empty data
+def test_process_attachment_forwarded_mail():
+    mail = message_from_string("""Content-Type: multipart/mixed; boundary="b"
+
+--b
+Content-Type: text/plain
+
+See below.
+--b
+Content-Type: message/rfc822
+Content-Disposition: attachment; filename="forwarded.eml"
+
+From: sender@example.com
+Subject: Invoice
+
+Pay now.
+--b--
+""")
+    part = mail.get_payload(1)
+    data = part.get_payload(0).as_bytes()
+    assert b'Subject: Invoice' in data
+
+    attachment_info = process_attachment(part)
+    assert attachment_info['filename'] == 'forwarded.eml'
+    assert attachment_info['length'] == len(data)
+    assert attachment_info['sha256'] == hashlib.sha256(data).hexdigest()
+    assert attachment_info['sha256'] != hashlib.sha256(b'').hexdigest()
+
+    # Test a multipart part with a file name is no attachment of its own
+    container = message_from_string('Content-Type: multipart/mixed; boundary="c"\n'
+                                    'Content-Disposition: attachment; filename="parts"\n\n--c\n\nx\n--c--\n')
+    assert process_attachment(container) is None
+
+
 def test_process_message_part():
     email_date = "Fri, 23 Jul 2024 10:21:35 -0700"
     content_type = 'text/plain'
@@ -282,7 +447,30 @@ def test_process_message_part():
 
 def test_extract_text_from_html():
     extracted_text = extract_text_from_html(html_content)
-    assert extracted_text == '\n\nTest Email\n\nThis is a test email.\n\n\n'
+    assert extracted_text == 'Test Email\n\nThis is a test email.'
+
+
+# Test scripts and styles are dropped and whitespace is collapsed
+def test_extract_text_from_html_cleanup():
+    html = """<style>p { color: red; }</style>
+    <p>First   line<br>second\tline</p><script>document.write('<p>hidden</p>');</script>
+    <ul><li>One &amp; two</li><li>Three</li></ul>"""
+    assert extract_text_from_html(html) == 'First line\nsecond line\n\nOne & two\nThree'
+
+
+# Test an unclosed noscript or template only hides the text up to the end of its parent
+def test_extract_text_from_html_unclosed_skipped_tag():
+    html = '<div><p>Before</p><noscript><p>Enable JavaScript</p></div><p>After</p><template>x'
+    assert extract_text_from_html(html) == 'Before\n\nAfter'
+    assert extract_text_from_html('<body>Hi<noscript>hidden</body> there') == 'Hi there'
+
+
+# Test the extraction stops at the size limit, even for input larger than a feed
+def test_extract_text_from_html_limit():
+    html = '<p>' + 'word ' * 100000 + '</p>'
+    text = extract_text_from_html(html, max_chars=100)
+    assert len(text) == 101
+    assert text.endswith('…')
 
 
 def test_filter_duplicate_messages():
@@ -375,3 +563,21 @@ def test_filter_duplicate_messages_text_preferred():
     # as it gets formatted better than the HTML message
     assert filtered_messages[0]['content'] == 'This is a plain text message.'
     assert filtered_messages[0]['content_type'] == 'text/plain'
+
+
+# Test the headers are sorted into the groups of the result page
+def test_group_headers():
+    headers = HeaderParser().parsestr(
+        "Received: from a by b; Fri, 23 Jul 2024 10:21:35 -0700\n"
+        "Subject: Test\n"
+        "DKIM-Signature: v=1; a=rsa-sha256\n"
+        "X-Mailer: Test Mailer\n"
+        "X-Spam-Score: 0.1\n"
+        "List-Unsubscribe: <mailto:unsubscribe@example.com>\n"
+        "Received-SPF: pass\n"
+    )
+    assert group_headers(headers) == {
+        'security': [('DKIM-Signature', 'v=1; a=rsa-sha256'), ('Received-SPF', 'pass')],
+        'x': [('X-Mailer', 'Test Mailer'), ('X-Spam-Score', '0.1')],
+        'other': [('List-Unsubscribe', '<mailto:unsubscribe@example.com>')]
+    }
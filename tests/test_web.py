@@ -1,3 +1,5 @@
+import hashlib
+import pstats
 import re
 
 
@@ -72,3 +74,224 @@ def test_multiple_requests(client):
         response = client.get('/')
         assert response.status_code == 200
         assert b'<title>MAPy | E-Mail Analyzer</title>' in response.data
+
+
+# Test spooled attachments can be downloaded, also partially
+def test_download_attachment(app, client):
+    key = app.extensions['attachment_spool'].put(b'Test attachment data.')
+
+    response = client.get(f'/attachments/{key}?filename=test.txt')
+    assert response.status_code == 200
+    assert response.data == b'Test attachment data.'
+    assert 'filename=test.txt' in response.headers['Content-Disposition']
+
+    response = client.get(f'/attachments/{key}', headers={'Range': 'bytes=5-14'})
+    assert response.status_code == 206
+    assert response.data == b'attachment'
+
+
+# Test unknown attachments are not found
+def test_download_unknown_attachment(client):
+    response = client.get('/attachments/' + '0' * 64)
+    assert response.status_code == 404
+
+
+# Test attachments are linked with their hashes and can be downloaded after the analysis
+def test_attachment_submission(client):
+    response = client.get('/')
+    csrf_token = re.search(rb'name="csrf_token"\n\s*value="([^"]+)"', response.data).group(1)
+    mail = """Received: from client.example.com (client.example.com [192.168.0.1])
+    by mail.example.com with ESMTPS id j0siq34k2i; Fri, 23 Jul 2024 10:21:35 -0700 (PDT)
+From: sender@example.com
+Subject: Test Email
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="XXXX"
+
+--XXXX
+Content-Type: text/plain
+
+This is the body of the email.
+--XXXX
+Content-Type: application/octet-stream
+Content-Disposition: attachment; filename="test.txt"
+Content-Transfer-Encoding: base64
+
+VGVzdCBhdHRhY2htZW50IGRhdGEu
+--XXXX--
+"""
+    response = client.post('/', data={'headers': mail, 'csrf_token': csrf_token})
+    assert response.status_code == 200
+    assert b'data:application/octet-stream' not in response.data
+
+    sha256 = hashlib.sha256(b'Test attachment data.').hexdigest()
+    assert sha256.encode() in response.data
+    download_url = re.search(rb'href="(/attachments/[^"]+)"', response.data).group(1).decode()
+
+    response = client.get(download_url.replace('&amp;', '&'))
+    assert response.data == b'Test attachment data.'
+
+
+# Test submissions are analyzed in the background in async mode
+def test_async_submission(app, client):
+    app.config['ASYNC_ANALYSIS'] = True
+    response = client.get('/')
+    csrf_token = re.search(rb'name="csrf_token"\n\s*value="([^"]+)"', response.data).group(1)
+    mail = """Received: from client.example.com (client.example.com [192.168.0.1])
+    by mail.example.com with ESMTPS id j0siq34k2i; Fri, 23 Jul 2024 10:21:35 -0700 (PDT)
+From: sender@example.com
+Subject: Test Email
+
+This is the body of the email."""
+
+    response = client.post('/', data={'headers': mail, 'csrf_token': csrf_token})
+    assert response.status_code == 303
+    job_url = response.headers['Location']
+    assert job_url.startswith('/jobs/')
+
+    response = client.get(job_url + '/events')
+    assert response.mimetype == 'text/event-stream'
+    stream = response.get_data(as_text=True)
+    assert 'data: {"stage": "headers"}' in stream
+    assert stream.endswith('event: done\ndata: {}\n\n')
+
+    response = client.get(job_url)
+    assert response.status_code == 200
+    assert b'This is the body of the email.' in response.data
+
+
+# Test unknown jobs are not found
+def test_unknown_job(client):
+    assert client.get('/jobs/unknown').status_code == 404
+    assert client.get('/jobs/unknown/events').status_code == 404
+
+
+# Test large header groups and bodies are cut off and the rest can be loaded
+def test_bounded_result_page(app, client):
+    app.config.update(PAGE_HEADER_ROWS=10, PAGE_MESSAGE_CHARS=100)
+    response = client.get('/')
+    csrf_token = re.search(rb'name="csrf_token"\n\s*value="([^"]+)"', response.data).group(1)
+    x_headers = ''.join(f'X-Custom-{n}: value {n}\n' for n in range(25))
+    body = 'word ' * 100
+    mail = f"""Received: from client.example.com (client.example.com [192.168.0.1])
+    by mail.example.com with ESMTPS id j0siq34k2i; Fri, 23 Jul 2024 10:21:35 -0700 (PDT)
+From: sender@example.com
+Subject: Test Email
+{x_headers}
+{body}"""
+
+    response = client.post('/', data={'headers': mail, 'csrf_token': csrf_token})
+    page = response.get_data(as_text=True)
+    assert 'X-Custom-9' in page
+    assert 'X-Custom-10:' not in page and '<th>X-Custom-10</th>' not in page
+    assert 'word ' * 20 in page and body.strip() not in page
+
+    headers_url = re.search(r'data-url="(/results/[^"]+/headers/x[^"]*)"', page).group(1).replace('&amp;', '&')
+    data = client.get(headers_url + '&offset=10').get_json()
+    assert data['rows'][0] == ['X-Custom-10', 'value 10']
+    assert data['next'] == 20
+    data = client.get(headers_url + '&offset=20').get_json()
+    assert [name for name, _ in data['rows']] == [f'X-Custom-{n}' for n in range(20, 25)]
+    assert data['next'] is None
+
+    message_url = re.search(r'data-url="(/results/[^"]+/messages/0[^"]*)"', page).group(1).replace('&amp;', '&')
+    data = client.get(message_url + '&offset=100').get_json()
+    assert data['content'] == body.strip()[100:]
+    assert data['next'] is None
+
+
+# Test cut off content can be loaded by another worker process and without the result cache
+def test_bounded_result_page_without_cache(app, client):
+    app.config.update(PAGE_HEADER_ROWS=10, PAGE_MESSAGE_CHARS=100)
+    app.extensions['result_cache'].max_bytes = 0
+    response = client.get('/')
+    csrf_token = re.search(rb'name="csrf_token"\n\s*value="([^"]+)"', response.data).group(1)
+    x_headers = ''.join(f'X-Custom-{n}: value {n}\n' for n in range(25))
+    body = 'word ' * 100
+    mail = f"""Received: from client.example.com (client.example.com [192.168.0.1])
+    by mail.example.com with ESMTPS id j0siq34k2i; Fri, 23 Jul 2024 10:21:35 -0700 (PDT)
+From: sender@example.com
+Subject: Test Email
+{x_headers}
+{body}"""
+
+    response = client.post('/', data={'headers': mail, 'csrf_token': csrf_token})
+    page = response.get_data(as_text=True)
+    assert app.extensions['result_cache'].stats()['entries'] == 0
+
+    headers_url = re.search(r'data-url="(/results/[^"]+/headers/x[^"]*)"', page).group(1).replace('&amp;', '&')
+    data = client.get(headers_url + '&offset=20').get_json()
+    assert [name for name, _ in data['rows']] == [f'X-Custom-{n}' for n in range(20, 25)]
+
+    message_url = re.search(r'data-url="(/results/[^"]+/messages/0[^"]*)"', page).group(1).replace('&amp;', '&')
+    data = client.get(message_url + '&offset=100').get_json()
+    assert data['content'] == body.strip()[100:]
+
+
+# Test content of unknown results can't be loaded
+def test_unknown_result(client):
+    assert client.get('/results/unknown/headers/x').status_code == 404
+    assert client.get('/results/unknown/messages/0').status_code == 404
+
+
+# Test the stages of an analysis are sent in the Server-Timing header and served as metrics
+def test_server_timing_and_metrics(client):
+    response = client.get('/')
+    csrf_token = re.search(rb'name="csrf_token"\n\s*value="([^"]+)"', response.data).group(1)
+    mail = """Received: from client.example.com (client.example.com [192.168.0.1])
+    by mail.example.com with ESMTPS id j0siq34k2i; Fri, 23 Jul 2024 10:21:35 -0700 (PDT)
+From: sender@example.com
+Subject: Test Email
+
+This is the body of the email."""
+
+    response = client.post('/', data={'headers': mail, 'csrf_token': csrf_token})
+    server_timing = response.headers['Server-Timing']
+    for name in ('parse', 'headers', 'dates', 'chart', 'geolocation', 'messages', 'render', 'total'):
+        assert f'{name};dur=' in server_timing
+
+    response = client.get('/metrics')
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    text = response.get_data(as_text=True)
+    assert 'mapy_stage_duration_seconds_count{stage="headers"} 1\n' in text
+    assert 'mapy_request_duration_seconds_count{endpoint="mapy.index"} 2\n' in text
+    assert 'mapy_mail_hops_sum 1\n' in text
+
+
+# Test metrics can be turned off
+def test_metrics_disabled(app, client):
+    app.config['METRICS_ENABLED'] = False
+    assert client.get('/metrics').status_code == 404
+
+
+# Test an analysis is profiled on request when profiling is enabled
+def test_profiled_submission(app, client, tmp_path):
+    mail = """Received: from client.example.com (client.example.com [192.168.0.1])
+    by mail.example.com with ESMTPS id j0siq34k2i; Fri, 23 Jul 2024 10:21:35 -0700 (PDT)
+From: sender@example.com
+Subject: Test Email
+
+This is the body of the email."""
+    response = client.get('/')
+    csrf_token = re.search(rb'name="csrf_token"\n\s*value="([^"]+)"', response.data).group(1)
+
+    # Ignored while profiling is disabled
+    response = client.post('/?profile=pstats', data={'headers': mail, 'csrf_token': csrf_token})
+    assert 'X-Mapy-Profile' not in response.headers
+
+    app.config.update(PROFILING_ENABLED=True, PROFILE_DIR=str(tmp_path / 'profiles'))
+    response = client.post('/', data={'headers': mail, 'csrf_token': csrf_token},
+                           headers={'X-Mapy-Profile': 'stacks'})
+    assert response.status_code == 200
+    assert b'This is the body of the email.' in response.data
+    assert response.headers['X-Mapy-Profile'].endswith('.collapsed')
+
+    response = client.post('/?profile=1', data={'headers': mail, 'csrf_token': csrf_token})
+    profile = tmp_path / 'profiles' / response.headers['X-Mapy-Profile']
+    assert profile.suffix == '.pstats'
+    assert 'analyze_mail' in {name for _, _, name in pstats.Stats(str(profile)).stats}
+
+    # Values which don't name a mode or turn profiling on are ignored
+    for value in ('0', 'false', 'off', 'flamegraph'):
+        response = client.post(f'/?profile={value}', data={'headers': mail, 'csrf_token': csrf_token})
+        assert response.status_code == 200
+        assert 'X-Mapy-Profile' not in response.headers
@@ -0,0 +1,9 @@
+"""
+WSGI entry point for production servers, e.g.:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from mapy.app import create_app, preload
+
+app = create_app()
+preload(app)